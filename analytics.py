@@ -0,0 +1,472 @@
+"""
+Cross-user cohort analytics.
+
+Daily curves (bottle ml, diapers, sleep minutes) grouped by baby age in days
+and by feeding mode, with mean and percentiles per group:
+
+    python manage.py cohort --out cohort.csv
+    python manage.py cohort --format json --max-age 180
+
+The shard files are read directly, so pending journal ops must be folded
+in first (`manage.py cohort` checkpoints the store before it starts).
+Every shard file is cut into byte ranges, RANGES_PER_WORKER per worker
+process (so one big shard - the default TINYDB_PATH layout - is shared by
+all workers), and each user belongs to the range its entry starts in. A
+worker streams its range READ_CHUNK bytes at a time with an incremental
+parser and flattens the users into columnar NumPy arrays BATCH_USERS at a
+time, so no process ever holds more than one batch of docs as dicts.
+Everything after that is vectorized.
+
+A range other than the first starts at the first `, "<doc id>": {` after its
+offset whose value has an "id". That text can also be a nested dict of a
+doc, so the ranges are checked against each other: each one must start exactly where the one
+before stopped, and a range that doesn't is read again from there.
+
+A user-day counts once the user logged anything that day: the local day of
+the event's epoch in the user's zone (KEY_TZ), or of its timestamp for legacy
+events without one. A day without a bottle is 0 ml, not missing. Sleep
+sessions with start/end are split at the user's local midnight, on epochs,
+like summarize_day(), so a night across a DST change counts its real length;
+unlike there, overlapping sessions are summed, not merged. Legacy
+duration-only entries count on the day they were logged.
+"""
+import codecs
+import csv
+import datetime as dt
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import numpy as np
+
+# same doc fields as app.KEY_DOB / KEY_FEEDING_MODE / KEY_EVENTS / KEY_TZ
+DOB_FIELD = "dob"
+MODE_FIELD = "feeding_mode"
+EVENTS_FIELD = "events"
+TZ_FIELD = "tz"
+DEFAULT_TZ = "Asia/Jerusalem"  # app.DEFAULT_TZ_NAME: users registered before KEY_TZ
+
+MODES = ["breast", "bottle", "mixed", "pumping", "unknown"]
+MODE_CODES = {m: i for i, m in enumerate(MODES)}
+ALL_MODES = "all"
+
+METRICS = ["bottle_ml", "diapers", "sleep_min"]
+M_BOTTLE, M_DIAPER, M_SLEEP, M_OTHER = 0, 1, 2, 3
+
+PERCENTILES = (10, 50, 90)
+DEFAULT_MAX_AGE = 365
+
+READ_CHUNK = 1 << 20        # bytes read at a time
+BATCH_USERS = 200           # users flattened into arrays at a time
+RANGES_PER_WORKER = 4       # smaller ranges even out the workers
+MIN_RANGE_BYTES = 8 << 20
+
+EPOCH = dt.datetime(1970, 1, 1)
+
+def _amount(val) -> float:
+    try:
+        if isinstance(val, str):
+            val = re.sub(r"[^\d]", "", val)
+        return float(val)
+    except:
+        return 0.0
+
+def _to_seconds(stamps):
+    """'YYYY-MM-DD HH:MM:SS' strings -> datetime64[s] (NaT for anything unparsable)."""
+    try:
+        return np.array(stamps, dtype="datetime64[s]")
+    except ValueError:
+        out = np.full(len(stamps), np.datetime64("NaT"), dtype="datetime64[s]")
+        for i, s in enumerate(stamps):
+            try:
+                out[i] = np.datetime64(s, "s")
+            except (ValueError, TypeError):
+                pass
+        return out
+
+@lru_cache(maxsize=512)
+def _zone_name(name, default: str) -> str:
+    # unknown names fall back to the default zone, like app.get_zone()
+    try:
+        ZoneInfo(name)
+        return name
+    except (ZoneInfoNotFoundError, ValueError, TypeError):
+        return default
+
+def _hourly(secs, offset):
+    """offset(s) for every value of secs, looked up once per hour (per value only in an hour where it changes)."""
+    hours, inv = np.unique(secs // 3600, return_inverse=True)
+    first = np.array([offset(h * 3600) for h in hours], np.int64)[inv]
+    last = np.array([offset(h * 3600 + 3599) for h in hours], np.int64)[inv]
+    mixed = np.flatnonzero(first != last)
+    first[mixed] = [offset(s) for s in secs[mixed]]
+    return first
+
+def _local_epochs(wall, tz_name: str):
+    """Naive local times (datetime64[s]) in a zone -> unix seconds, read like app.parse_local_ts() (fold=0)."""
+    zone = ZoneInfo(tz_name)
+    secs = wall.astype(np.int64)
+    return secs - _hourly(secs, lambda s: int(
+        (EPOCH + dt.timedelta(seconds=int(s))).replace(tzinfo=zone).utcoffset().total_seconds()))
+
+def _local_days(epochs, tz_name: str):
+    """Unix seconds -> local dates (datetime64[D]) in a zone."""
+    zone = ZoneInfo(tz_name)
+    secs = epochs.astype(np.int64)
+    secs = secs + _hourly(secs, lambda s: int(dt.datetime.fromtimestamp(int(s), zone).utcoffset().total_seconds()))
+    return secs.astype("datetime64[s]").astype("datetime64[D]")
+
+def _empty_columns():
+    return {
+        "mode": np.zeros(0, np.int8),
+        "age": np.zeros(0, np.int32),
+        **{m: np.zeros(0, np.float64) for m in METRICS},
+    }
+
+def _concat(parts):
+    parts = parts or [_empty_columns()]
+    return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+# ---------- streaming a TinyDB file ----------
+_HEADER = re.compile(r'\s*\{\s*"_default"\s*:\s*\{\s*')
+_KEY = re.compile(r'"\d+"\s*:\s*')
+_NEXT = re.compile(r'\s*([,}])\s*')
+_ENTRY = re.compile(rb',\s*(?="\d+"\s*:\s*\{)')
+_decoder = json.JSONDecoder()
+
+def _next_match(path: str, offset: int):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        buf, base = b"", offset
+        while True:
+            data = f.read(READ_CHUNK)
+            buf += data
+            m = _ENTRY.search(buf)
+            if m:
+                return base + m.end()
+            if not data:
+                return None
+            keep = min(len(buf), 64)  # a match cut by the read boundary
+            base += len(buf) - keep
+            buf = buf[-keep:]
+
+def next_entry(path: str, offset: int):
+    """
+    Byte offset of the first `"<doc id>": {` after a comma, at or after offset,
+    whose value looks like a user doc (has an "id"); None when there is none.
+    """
+    while True:
+        start = _next_match(path, offset)
+        if start is None:
+            return None
+        try:
+            doc = next(iter(TableReader(path, start)), None)
+        except ValueError:
+            doc = None
+        if isinstance(doc, dict) and "id" in doc:
+            return start
+        offset = start + 1
+
+class TableReader:
+    """
+    The docs of a TinyDB file's default table, streamed: from byte `start`
+    (0, or the offset of an entry) up to the first entry at or after byte
+    `end`. After iterating, `stop` is that entry's offset, or None when the
+    table ended first; `count` is the number of docs read.
+    """
+
+    def __init__(self, path: str, start: int = 0, end: int = None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.stop = None
+        self.count = 0
+
+    def _more(self) -> bool:
+        data = self._f.read(READ_CHUNK)
+        self._eof = not data
+        self._text = self._text[self._pos:] + self._decode(data, final=self._eof)
+        self._pos = 0
+        return not self._eof
+
+    def _skip(self, to: int):
+        self._offset += len(self._text[self._pos:to].encode("utf-8"))
+        self._pos = to
+
+    def _match(self, pattern, what: str):
+        if len(self._text) - self._pos < 256 and not self._eof:
+            self._more()
+        m = pattern.match(self._text, self._pos)
+        if not m:
+            raise ValueError(f"{self.path}: expected {what} at byte {self._offset}")
+        self._skip(m.end())
+        return m
+
+    def __iter__(self):
+        self._decode = codecs.getincrementaldecoder("utf-8")().decode
+        self._text, self._pos, self._offset, self._eof = "", 0, self.start, False
+        with open(self.path, "rb") as self._f:
+            self._f.seek(self.start)
+            if self.start == 0:
+                self._more()
+                if not self._text.strip():
+                    return  # a store that was never written
+                self._match(_HEADER, "the default table")
+                if self._text.startswith("}", self._pos):
+                    return
+            while True:
+                if self.end is not None and self._offset >= self.end:
+                    self.stop = self._offset
+                    return
+                self._match(_KEY, "a doc id")
+                while True:
+                    try:
+                        doc, to = _decoder.raw_decode(self._text, self._pos)
+                        break
+                    except json.JSONDecodeError:
+                        if not self._more():
+                            raise
+                self._skip(to)
+                self.count += 1
+                yield doc
+                if self._match(_NEXT, "',' or '}'").group(1) == "}":
+                    return
+
+# ---------- docs -> columns ----------
+def docs_columns(docs, max_age: int = DEFAULT_MAX_AGE, default_tz: str = DEFAULT_TZ):
+    """
+    Docs -> one row per (user, age day):
+    {"mode", "age", "bottle_ml", "diapers", "sleep_min"} as equal-length arrays.
+    """
+    user_dob, user_mode, user_zone = [], [], []
+    zones = {}
+    ev_user, ev_ts, ev_epoch, ev_metric, ev_value = [], [], [], [], []
+    sl_user, sl_start, sl_end = [], [], []
+
+    for doc in docs:
+        dob = doc.get(DOB_FIELD)
+        if not dob:
+            continue
+        u = len(user_dob)
+        user_dob.append(dob)
+        user_mode.append(MODE_CODES.get(doc.get(MODE_FIELD), MODE_CODES["unknown"]))
+        zone = doc.get(TZ_FIELD)
+        zone = _zone_name(zone if isinstance(zone, str) and zone else default_tz, default_tz)
+        user_zone.append(zones.setdefault(zone, len(zones)))
+
+        for e in doc.get(EVENTS_FIELD) or []:
+            ts = e.get("timestamp")
+            if not ts:
+                continue
+            kind = e.get("type")
+            details = e.get("details") or {}
+            if kind == "bottle":
+                metric, value = M_BOTTLE, _amount(details.get("amount", 0))
+            elif kind == "diaper":
+                metric, value = M_DIAPER, 1.0
+            elif kind == "sleep" and details.get("start_ts") and details.get("end_ts"):
+                sl_user.append(u)
+                sl_start.append(details["start_ts"])
+                sl_end.append(details["end_ts"])
+                continue
+            elif kind == "sleep":
+                metric, value = M_SLEEP, _amount(details.get("duration_min", 0))
+            else:
+                metric, value = M_OTHER, 0.0
+            ev_user.append(u)
+            ev_ts.append(ts)
+            ep = e.get("epoch")
+            ev_epoch.append(ep if isinstance(ep, (int, float)) else np.nan)
+            ev_metric.append(metric)
+            ev_value.append(value)
+
+    if not user_dob:
+        return _empty_columns()
+
+    dob_day = _to_seconds(user_dob).astype("datetime64[D]")
+    users = np.array(ev_user, np.int64)
+    days = _to_seconds(ev_ts).astype("datetime64[D]")
+    metric = np.array(ev_metric, np.int8)
+    value = np.array(ev_value, np.float64)
+    zone_codes = np.array(user_zone, np.int32)
+
+    # an event with an epoch is on the local day of that instant (the timestamp string
+    # is ambiguous in the hour repeated when DST ends), like summarize_day()
+    epoch = np.array(ev_epoch, np.float64)
+    has_epoch = ~np.isnan(epoch)
+    if has_epoch.any():
+        ev_zone = zone_codes[users]
+        for name, code in zones.items():
+            m = has_epoch & (ev_zone == code)
+            if m.any():
+                days[m] = _local_days(epoch[m], name)
+
+    # sleep sessions: the part before local midnight on the start day, the rest on the next
+    if sl_user:
+        s_user = np.array(sl_user, np.int64)
+        start = _to_seconds(sl_start)
+        end = _to_seconds(sl_end)
+        ok = ~np.isnat(start) & ~np.isnat(end)
+        s_user, start, end = s_user[ok], start[ok], end[ok]
+        start_day = start.astype("datetime64[D]")
+        # wall clock -> epochs in each user's own zone: a DST night is 23 or 25 hours long
+        s_zone = zone_codes[s_user]
+        t0, t1, midnight = (np.zeros(len(s_user), np.int64) for _ in range(3))
+        for name, code in zones.items():
+            m = s_zone == code
+            if m.any():
+                t0[m] = _local_epochs(start[m], name)
+                t1[m] = _local_epochs(end[m], name)
+                midnight[m] = _local_epochs((start_day[m] + 1).astype("datetime64[s]"), name)
+        ok = t1 > t0
+        s_user, start_day, t0, t1, midnight = s_user[ok], start_day[ok], t0[ok], t1[ok], midnight[ok]
+        cut = np.minimum(t1, midnight)
+        first = (cut - t0) / 60.0
+        rest = (t1 - cut) / 60.0
+        users = np.concatenate([users, s_user, s_user])
+        days = np.concatenate([days, start_day, start_day + 1])
+        metric = np.concatenate([metric, np.full(2 * len(s_user), M_SLEEP, np.int8)])
+        value = np.concatenate([value, first, rest])
+        # an empty tail is not activity on the next day
+        keep = np.ones(len(users), bool)
+        keep[len(keep) - len(s_user):] = rest > 0
+        users, days, metric, value = users[keep], days[keep], metric[keep], value[keep]
+
+    ok = ~np.isnat(days)
+    users, days, metric, value = users[ok], days[ok], metric[ok], value[ok]
+    age = (days - dob_day[users]).astype(np.int64)
+    ok = (age >= 0) & (age <= max_age)
+    users, age, metric, value = users[ok], age[ok], metric[ok], value[ok]
+
+    # (user, age) -> one row, metrics summed per row
+    key = users * (max_age + 1) + age
+    keys, row = np.unique(key, return_inverse=True)
+    out = {
+        "mode": np.array(user_mode, np.int8)[keys // (max_age + 1)],
+        "age": (keys % (max_age + 1)).astype(np.int32),
+    }
+    for code, name in enumerate(METRICS):
+        out[name] = np.bincount(row, weights=np.where(metric == code, value, 0.0), minlength=len(keys))
+    return out
+
+def range_columns(path: str, lo: int, hi=None, max_age: int = DEFAULT_MAX_AGE,
+                  default_tz: str = DEFAULT_TZ, exact: bool = False):
+    """
+    The users whose entries start in bytes [lo, hi) of a shard file ->
+    (start, stop, columns): start is the offset of the first entry read
+    (None: no entry after lo), stop the offset of the first entry at or after
+    hi (None: the table ended). Unless `exact` (lo is 0 or a known entry), lo
+    is moved to the next entry first; when that guess turns out not to be an
+    entry, start is -1 and the caller reads the range again.
+    """
+    try:
+        start = lo if exact else next_entry(path, lo)
+        if start is None:
+            return None, None, _empty_columns()
+        reader = TableReader(path, start, hi)
+        docs = iter(reader)
+        parts = []
+        while True:
+            before = reader.count
+            parts.append(docs_columns(islice(docs, BATCH_USERS), max_age, default_tz))
+            if reader.count - before < BATCH_USERS:
+                break
+        return start, reader.stop, _concat(parts)
+    except ValueError:
+        if exact:
+            raise
+        return -1, None, _empty_columns()
+
+def shard_columns(path: str, max_age: int = DEFAULT_MAX_AGE, default_tz: str = DEFAULT_TZ):
+    """One whole shard file, in this process."""
+    if not os.path.exists(path):
+        return _empty_columns()
+    return range_columns(path, 0, None, max_age, default_tz, exact=True)[2]
+
+def _range_task(task):
+    return range_columns(*task)
+
+def grouped_stats(group, values, percentiles=PERCENTILES):
+    """
+    Per-group count, mean and percentiles (numpy's default linear interpolation)
+    without a Python loop over groups.
+    """
+    order = np.lexsort((values, group))
+    g, v = group[order], values[order]
+    keys, start, count = np.unique(g, return_index=True, return_counts=True)
+    stats = {"mean": np.add.reduceat(v, start) / count}
+    for p in percentiles:
+        pos = start + (count - 1) * (p / 100.0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        stats[f"p{p}"] = v[lo] + (v[hi] - v[lo]) * (pos - lo)
+    return keys, count, stats
+
+def collect(paths, workers: int | None = None, max_age: int = DEFAULT_MAX_AGE,
+            default_tz: str = DEFAULT_TZ, range_bytes: int | None = None):
+    """Columns of every user in the shard files, byte ranges read in parallel when workers > 1."""
+    workers = workers or os.cpu_count() or 1
+    sizes = {p: os.path.getsize(p) for p in paths if os.path.exists(p)}
+    if range_bytes is None:
+        total = sum(sizes.values())
+        range_bytes = max(MIN_RANGE_BYTES, -(-total // (workers * RANGES_PER_WORKER))) if workers > 1 else total
+    range_bytes = max(range_bytes, 1)
+    tasks = []
+    for p, size in sizes.items():
+        offsets = list(range(0, size, range_bytes)) or [0]
+        for i, lo in enumerate(offsets):
+            hi = offsets[i + 1] if i + 1 < len(offsets) else None
+            tasks.append((p, lo, hi, max_age, default_tz, lo == 0))
+    if workers == 1 or len(tasks) <= 1:
+        results = [_range_task(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            results = list(pool.map(_range_task, tasks))
+
+    parts, expected = [], None
+    for (p, lo, hi, *_), (start, stop, columns) in zip(tasks, results):
+        if lo == 0:
+            expected = 0
+        elif expected is None:
+            continue  # the table ended in an earlier range
+        elif start != expected:
+            # the guessed entry was a nested dict (or the previous range ran past this one's): reread from there
+            start, stop, columns = range_columns(p, expected, hi, max_age, default_tz, exact=True)
+        parts.append(columns)
+        expected = stop
+    return _concat(parts)
+
+def cohort_rows(columns):
+    """Columns from collect() -> list of output rows, per feeding mode + 'all'."""
+    rows = []
+    for label, mask in [(ALL_MODES, None)] + [(m, columns["mode"] == c) for m, c in MODE_CODES.items()]:
+        age = columns["age"] if mask is None else columns["age"][mask]
+        if not len(age):
+            continue
+        per_metric = {}
+        for name in METRICS:
+            vals = columns[name] if mask is None else columns[name][mask]
+            keys, count, stats = grouped_stats(age.astype(np.int64), vals)
+            per_metric[name] = stats
+        for i, a in enumerate(keys):
+            row = {"feeding_mode": label, "age_days": int(a), "users": int(count[i])}
+            for name, stats in per_metric.items():
+                for stat, arr in stats.items():
+                    row[f"{name}_{stat}"] = round(float(arr[i]), 1)
+            rows.append(row)
+    return rows
+
+def write_rows(rows, fmt: str, out):
+    if fmt == "json":
+        json.dump(rows, out, ensure_ascii=False, indent=1)
+        out.write("\n")
+        return
+    if not rows:
+        return
+    writer = csv.DictWriter(out, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
@@ -1,13 +1,62 @@
+import time
+STARTUP_T0 = time.perf_counter()  # `python app.py --startup-report` measures from here
+
 import os
 import re
+import sys
+import hmac
+import json
+import zlib
+import base64
+import bisect
+import heapq
+import hashlib
 import random
+import threading
 import datetime as dt
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from datetime import timedelta
-from zoneinfo import ZoneInfo
-
-from flask import Flask, request
-from twilio.twiml.messaging_response import MessagingResponse
-from tinydb import TinyDB, Query
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+
+# ----------------------------------------------------
+# Startup timing (cold starts on Render are user-visible)
+# ----------------------------------------------------
+STARTUP_PHASES = []            # [(phase, ms)] in order
+_startup_last = STARTUP_T0
+
+def startup_mark(phase: str):
+    """Close an import-time phase that started at the previous mark."""
+    global _startup_last
+    now = time.perf_counter()
+    STARTUP_PHASES.append((phase, (now - _startup_last) * 1000))
+    _startup_last = now
+
+# `--startup-report` sends one real request: it gets its own throwaway store and limiter,
+# set before the config below reads the environment
+STARTUP_REPORT_DIR = None
+if __name__ == "__main__" and "--startup-report" in sys.argv:
+    import tempfile
+    STARTUP_REPORT_DIR = tempfile.mkdtemp(prefix="bili-startup-")
+    for name in ("TINYDB_SHARDS", "TINYDB_SHARDS_PREVIOUS", "TINYDB_DIRECTORY_PATH", "RATE_LIMIT_STORE",
+                 "SQL_STORE_URL", "SHADOW_STATUS_DIR"):
+        os.environ.pop(name, None)
+    os.environ["TINYDB_PATH"] = os.path.join(STARTUP_REPORT_DIR, "users.json")
+    os.environ["SHADOW_MIN_CLEAN_HOURS"] = "0"  # an empty status dir would refuse STORE_PRIMARY=sql
+
+@contextmanager
+def startup_phase(phase: str):
+    """Time a lazy, first-use phase (store open, twilio import, ...)."""
+    t0 = time.perf_counter()
+    yield
+    STARTUP_PHASES.append((phase, (time.perf_counter() - t0) * 1000))
+
+startup_mark("stdlib imports")
+
+from flask import Flask, request, g, has_request_context, stream_with_context
+
+startup_mark("flask import")
 
 # ====================================================
 # 0) Flask + DB
@@ -15,8 +64,77 @@ from tinydb import TinyDB, Query
 app = Flask(__name__)
 
 DB_PATH = os.environ.get("TINYDB_PATH", "users_data.json")
-db = TinyDB(DB_PATH)
-User = Query()
+
+def env_paths(name: str):
+    return [p.strip() for p in os.environ.get(name, "").split(",") if p.strip()]
+
+# TINYDB_SHARDS="a.json,b.json,..." spreads users over several files (default: just DB_PATH).
+# TINYDB_SHARDS_PREVIOUS is the old layout while `manage.py rebalance` runs.
+SHARD_PATHS = env_paths("TINYDB_SHARDS") or [DB_PATH]
+PREVIOUS_SHARD_PATHS = env_paths("TINYDB_SHARDS_PREVIOUS") or None
+DIRECTORY_PATH = os.environ.get("TINYDB_DIRECTORY_PATH") or os.path.splitext(SHARD_PATHS[0])[0] + ".directory.json"
+
+# The store (and tinydb) is opened on first use, or by a warm-up thread started at the
+# end of this module, so importing the app does not wait on storage.
+STORE_WARMUP = os.environ.get("STORE_WARMUP", "1") == "1"
+
+# Backend migration (see shadow.py): STORE_PRIMARY serves, STORE_SHADOW ("tinydb" / "sql")
+# gets every write replayed and compared in the background. Switching STORE_PRIMARY away
+# from tinydb is refused until the new backend, still running as a shadow, matched without
+# a divergence or a lost write for SHADOW_MIN_CLEAN_HOURS.
+STORE_PRIMARY = os.environ.get("STORE_PRIMARY", "tinydb")
+STORE_SHADOW = os.environ.get("STORE_SHADOW", "")
+SQL_STORE_URL = os.environ.get("SQL_STORE_URL") or "sqlite:///" + os.path.abspath(os.path.splitext(SHARD_PATHS[0])[0] + ".sqlite3")
+SHADOW_STATUS_DIR = os.environ.get("SHADOW_STATUS_DIR") or os.path.splitext(SHARD_PATHS[0])[0] + ".shadow"
+SHADOW_READ_SAMPLE = float(os.environ.get("SHADOW_READ_SAMPLE", "0.1"))
+SHADOW_MIN_CLEAN_HOURS = float(os.environ.get("SHADOW_MIN_CLEAN_HOURS", "72"))
+
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+def open_backend(name: str):
+    common = dict(partner_field=KEY_PARTNER_PHONE, version_field=KEY_VERSION, undo_field=KEY_UNDO,
+                  volatile_fields=(KEY_PENDING, KEY_DAY_MILESTONE), indexes=STORE_INDEXES)
+    if name == "tinydb":
+        from storage import ShardedStore
+        return ShardedStore(SHARD_PATHS, DIRECTORY_PATH, previous_paths=PREVIOUS_SHARD_PATHS, **common)
+    if name == "sql":
+        from sqlstore import SQLStore
+        return SQLStore(SQL_STORE_URL, index_types=STORE_INDEX_TYPES, **common)
+    raise ValueError(f"unknown store backend {name!r} (tinydb / sql)")
+
+def get_store():
+    global _store, _store_pid
+    # re-open after fork (gunicorn --preload): file handles must not be shared
+    if _store is None or _store_pid != os.getpid():
+        with _store_lock:
+            if _store is None or _store_pid != os.getpid():
+                with startup_phase("store open"):
+                    if STORE_PRIMARY != "tinydb" and SHADOW_MIN_CLEAN_HOURS > 0:
+                        from shadow import ready_to_switch, mark_switched
+                        ok, reason = ready_to_switch(SHADOW_STATUS_DIR, STORE_PRIMARY, SHADOW_MIN_CLEAN_HOURS)
+                        if not ok:
+                            raise RuntimeError(f"STORE_PRIMARY={STORE_PRIMARY} refused: {reason} "
+                                               "(SHADOW_MIN_CLEAN_HOURS=0 switches anyway)")
+                        mark_switched(SHADOW_STATUS_DIR, STORE_PRIMARY)
+                    s = open_backend(STORE_PRIMARY)
+                    if STORE_SHADOW and STORE_SHADOW != STORE_PRIMARY:
+                        from shadow import ShadowStore
+                        s = ShadowStore(s, open_backend(STORE_SHADOW), names=(STORE_PRIMARY, STORE_SHADOW),
+                                        status_dir=SHADOW_STATUS_DIR, read_sample=SHADOW_READ_SAMPLE,
+                                        report=shadow_reports)
+                    s.warm()
+                _store, _store_pid = s, os.getpid()
+    return _store
+
+def messaging_response():
+    # twilio is only needed once a reply is built
+    if "twilio.twiml.messaging_response" not in sys.modules:
+        with startup_phase("twilio import"):
+            import twilio.twiml.messaging_response  # noqa: F401
+    from twilio.twiml.messaging_response import MessagingResponse
+    return MessagingResponse()
 
 # ====================================================
 # 1) Keys
@@ -35,105 +153,155 @@ KEY_SLEEP_START = "sleep_start_time"   # ISO datetime
 KEY_BF_TIMER = "bf_timer"              # {'side': 'ימין/שמאל/לא צוין', 'start_ts': 'YYYY-MM-DD HH:MM:SS'}
 
 KEY_PENDING = "pending_action"         # dict describing what's missing
+KEY_FEED_STATS = "feed_stats"          # incremental feeding stats (see feed_stats_apply)
+KEY_STASH = "milk_stash"               # {'next_id': int, 'batches': [[expiry, id, created, location, ml], ...]} (min-heap)
 KEY_PARTNER_PHONE = "partner_phone"
+KEY_VERSION = "version"                # bumped by the store on every save (API ETags)
+KEY_UNDO = "undo"                      # undo stack, kept by the store: [{'id', 'label', 'inv': [diff, ...]}, ...]
+KEY_TZ = "tz"                          # IANA zone name; set at registration from the phone's country code
 
 # Milestones (feel non-mechanical)
 KEY_DAY_MILESTONE = "day_milestone"    # dict: { 'YYYY-MM-DD': {'next': int, 'last_sent': int} }
 
+REGISTRATION_DONE = 5                  # KEY_STAGE once registration is complete
+
+# Secondary indexes kept by the store on every save (manage.py users / sweep)
+def index_last_event(doc):
+    events = doc.get(KEY_EVENTS)
+    if not isinstance(events, list) or not events or not isinstance(events[-1], dict):
+        return None
+    ep = events[-1].get("epoch")
+    return int(ep) if isinstance(ep, (int, float)) else None
+
+STORE_INDEXES = {
+    "stage": lambda doc: to_int(doc.get(KEY_STAGE, 0)),
+    "last": index_last_event,                          # epoch of the latest logged event
+    "dob": lambda doc: doc.get(KEY_DOB) or None,       # 'YYYY-MM-DD' sorts as a date
+}
+STORE_INDEX_TYPES = {"stage": "int", "last": "int", "dob": "str"}  # column types in the SQL store
+
 # ====================================================
 # 2) Help Topics
 # ====================================================
 LEGAL_DISCLAIMER = "\n\n---\n_המידע כאן כללי ולא מחליף ייעוץ מקצועי._"
 
-HELP_TOPICS = {
-    "menu": (
+# Help articles are data files (data/help/*.txt) behind an inverted keyword index, see helpkb.py.
+# Articles with a "menu" number are listed in the menu and answer to that number.
+HELP_DIR = os.environ.get("HELP_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "help")
+HELP_MIN_HITS = 2  # a line must hold at least this many of one article's keywords to count as a question
+
+from helpkb import HelpKB
+
+HELP_KB = HelpKB(HELP_DIR, footer=LEGAL_DISCLAIMER)
+
+def help_menu_text() -> str:
+    # keycap digits for 1-9, "10." etc. after that
+    lines = [f"{n}\ufe0f\u20e3 {title}" if len(n) == 1 else f"{n}. {title}" for n, title in HELP_KB.menu_entries()]
+    return (
         "איך אפשר לעזור? 🌱\n\n"
         "בחרי נושא (או כתבי את המספר):\n"
-        "1️⃣ טיפול בחלב אם (שאוב)\n"
-        "2️⃣ דברים שחשוב לשים לב בהנקה\n"
-        "3️⃣ נורות אזהרה\n"
-        "4️⃣ המלצות כלליות להנקה\n"
-        "5️⃣ איך משתמשים בי\n\n"
+        + "\n".join(lines) + "\n\n"
         "(אפשר לבחור במילים או במספר)"
-    ),
-    "1": {
-        "keywords": ["חלב", "טיפול", "אחסון", "שאוב", "שאיבה", "הקפאה", "מקרר"],
-        "text": (
-            "כמה דברים חשובים על אחסון וטיפול בחלב אם 🍼\n\n"
-            "❄️ זמני אחסון (לחלב שנשאב בתנאים נקיים מאוד):\n"
-            "• בטמפרטורת החדר: מומלץ 3-4 שעות (אפשרי עד 6 שעות).\n"
-            "• חלב טרי במקרר: מומלץ 3 ימים (אפשרי עד 8 ימים).\n"
-            "• מקפיא (דלת נפרדת): מומלץ 3 חודשים (אפשרי עד 12 חודשים).\n"
-            "• צידנית + קרחונים: עד 24 שעות בצידנית, במגע עם הקרחונים.\n"
-            "• חלב קפוא שהופשר במקרר: מההפשרה 24 שעות בקירור. אין להקפיא שוב.\n"
-            "• חלב קפוא שהופשר בטמפרטורת החדר: אין להקפיא שוב ואין להחזיר למקרר.\n\n"
-            "🌡️ הפשרה וחימום:\n"
-            "• אופן ההפשרה: מומלץ להפשיר במקרר או בטמפרטורת החדר.\n"
-            "• אופן החימום: ניתן לחמם בכלי עם מים חמימים. לא רותחים ולא במיקרוגל.\n\n"
-            "*כל הנתונים הינם עבור חלב שנשאב בתנאים נקיים מאוד.*"
-        ),
-    },
-    "2": {
-        "keywords": ["הנקה", "תפיסה", "בליעה", "שד", "כאב", "סדקים"],
-        "text": (
-            "דברים קטנים שעושים הבדל בהנקה 🤱\n\n"
-            "• לחפש בליעות (ולא רק מציצה).\n"
-            "• להצמיד כך שהפה יהיה גדול ועמוק, ושפתיים 'פונות החוצה'.\n"
-            "• בסיום – השד לרוב מרגיש רך יותר.\n"
-            "• אם יש כאב חד/מתמשך – שווה לבדוק הצמדה/תנוחה."
-        ),
-    },
-    "3": {
-        "keywords": ["אזהרה", "נורות", "חום", "אודם", "דלקת", "ישנוניות", "התייבשות"],
-        "text": (
-            "🚨 נורות אזהרה – שווה להתייעץ בהקדם:\n"
-            "• חום גבוה.\n"
-            "• אודם/כאב משמעותי בשד.\n"
-            "• פחות משמעותית בהרטבת חיתולים מהרגיל.\n"
-            "• ישנוניות חריגה / קושי להעיר.\n"
-            "• הקאות חוזרות או סימני התייבשות."
-        ),
-    },
-    "4": {
-        "keywords": ["טיפים", "המלצות", "מים", "שתייה", "מנוחה"],
-        "text": (
-            "המלצות כלליות להנקה 💛\n\n"
-            "• לשתות לפי צמא (ולזכור לאכול משהו קטן).\n"
-            "• להחליף צדדים לאורך היום.\n"
-            "• לנוח כשאפשר.\n"
-            "• אם משהו מרגיש לא נכון – מותר לעצור ולבדוק מחדש."
-        ),
-    },
-    "5": {
-        "keywords": ["איך", "משתמשים", "איך משתמשים", "פקודות", "דוגמאות"],
-        "text": (
-            "איך משתמשים בי 🌿\n\n"
-            "תיעוד מהיר:\n"
-            "• הנקה: 'ימין' / 'שמאל' (אפשר גם עם זמן: 'ימין 10')\n"
-            "  אפשר גם ריבוי שורות:\n"
-            "  ימין 10\n"
-            "  שמאל 8\n"
-            "• בקבוק: 'בקבוק 120'\n"
-            "• שאיבה: 'שאיבה 200'\n"
-            "• חיתול: 'פיפי' / 'קקי' / 'חיתול מלא'\n"
-            "• שינה: 'הלך לישון' או 'הלך לישון 22:30'  |  'התעורר' או 'התעורר 06:10'\n\n"
-            "דוחות:\n"
-            "• 'סטטוס' – תמונת מצב מהיום\n"
-            "• 'סיכום' – כמו סטטוס\n"
-            "• 'השוואה' / 'השוואה 7' / 'השוואה שבוע' – מול ימים קודמים\n\n"
-            "תיקון:\n"
-            "• 'בטל' / 'מחק' – מוחק את הרישום האחרון\n"
-        ),
-    },
-}
+    )
+
+HELP_MENU = help_menu_text()
+
+startup_mark("keys + help topics")
 
 # ====================================================
 # 3) Time / Utils
 # ====================================================
-TZ = ZoneInfo("Asia/Jerusalem")
+DEFAULT_TZ_NAME = "Asia/Jerusalem"
+
+# country calling code -> zone new users start with (multi-zone countries get their most populous one);
+# 'אזור זמן <name>' changes it
+PHONE_ZONES = {
+    "972": "Asia/Jerusalem",
+    "1": "America/New_York",
+    "44": "Europe/London",
+    "33": "Europe/Paris",
+    "49": "Europe/Berlin",
+    "39": "Europe/Rome",
+    "34": "Europe/Madrid",
+    "31": "Europe/Amsterdam",
+    "32": "Europe/Brussels",
+    "41": "Europe/Zurich",
+    "43": "Europe/Vienna",
+    "7": "Europe/Moscow",
+    "380": "Europe/Kyiv",
+    "48": "Europe/Warsaw",
+    "30": "Europe/Athens",
+    "90": "Europe/Istanbul",
+    "61": "Australia/Sydney",
+    "64": "Pacific/Auckland",
+    "27": "Africa/Johannesburg",
+    "55": "America/Sao_Paulo",
+    "54": "America/Argentina/Buenos_Aires",
+    "52": "America/Mexico_City",
+    "971": "Asia/Dubai",
+    "91": "Asia/Kolkata",
+}
+
+@lru_cache(maxsize=512)
+def get_zone(name: str) -> ZoneInfo:
+    """ZoneInfo by IANA name, built once per process; unknown names fall back to the default zone."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError, TypeError):
+        return ZoneInfo(DEFAULT_TZ_NAME)
+
+TZ = get_zone(DEFAULT_TZ_NAME)  # default zone (and the zone of users registered before KEY_TZ)
+
+@lru_cache(maxsize=1)
+def zone_names():
+    return {n.lower(): n for n in available_timezones()}
+
+def resolve_zone_name(text: str):
+    """'europe/london' / 'Europe/London' / 'UTC' -> canonical IANA name, or None."""
+    key = re.sub(r"\s+", "_", (text or "").strip()).lower()
+    return zone_names().get(key) if key else None
+
+def zone_for_phone(phone: str) -> str:
+    for n in (3, 2, 1):
+        name = PHONE_ZONES.get(phone[:n])
+        if name:
+            return name
+    return DEFAULT_TZ_NAME
+
+def user_tz_name(user) -> str:
+    name = (user or {}).get(KEY_TZ)
+    return name if isinstance(name, str) and name else DEFAULT_TZ_NAME
+
+def user_tz(user) -> ZoneInfo:
+    return get_zone(user_tz_name(user))
+
+def use_user_tz(user):
+    """The user's zone becomes the request's zone (now_local, today_str, time-of-day parsing)."""
+    if has_request_context():
+        g.tz = user_tz(user)
+
+def current_tz() -> ZoneInfo:
+    if has_request_context():
+        return g.get("tz") or TZ
+    return TZ
+
+@lru_cache(maxsize=8192)
+def day_bounds(tz_name: str, day: dt.date) -> tuple[int, int]:
+    """
+    [start, end) of a local calendar day as unix seconds. Days are 23h/25h
+    on DST changes; a midnight that falls in a spring-forward gap maps to
+    the transition itself.
+    """
+    zone = get_zone(tz_name)
+    start = dt.datetime.combine(day, dt.time(0, 0), tzinfo=zone)
+    end = dt.datetime.combine(day + timedelta(days=1), dt.time(0, 0), tzinfo=zone)
+    return int(start.timestamp()), int(end.timestamp())
 
 def now_local() -> dt.datetime:
-    return dt.datetime.now(tz=TZ)
+    # one clock per request: every handler in a webhook call agrees on "now"
+    if has_request_context() and "now" in g:
+        return g.now.astimezone(current_tz())
+    return dt.datetime.now(tz=current_tz())
 
 def today_str() -> str:
     return now_local().strftime("%Y-%m-%d")
@@ -156,6 +324,12 @@ def to_int(val) -> int:
     except:
         return 0
 
+def to_float(val) -> float:
+    try:
+        return float(val)
+    except:
+        return 0.0
+
 def parse_time_hhmm(text: str):
     m = re.search(r"\b([01]?\d|2[0-3])[:\.]([0-5]\d)\b", text)
     if not m:
@@ -211,10 +385,16 @@ def validate_and_format_dob(dob_str: str):
 # 4) DB helpers
 # ====================================================
 def get_user_by_any(uid: str):
-    u = db.get(User.id == uid)
-    if u:
-        return u
-    return db.get(User[KEY_PARTNER_PHONE] == uid)
+    return get_store().get_by_any(uid)
+
+def save_user(user):
+    get_store().save(user, action=current_action())
+
+def current_action():
+    """The undoable action (one message line) the webhook is handling, if any."""
+    if has_request_context():
+        return g.get("action")
+    return None
 
 def safe_events(user):
     ev = user.get(KEY_EVENTS)
@@ -229,21 +409,325 @@ def add_event(user_id: str, event_type: str, details: dict, timestamp: str | Non
     if not user:
         return None
 
-    ts = timestamp or now_local().strftime("%Y-%m-%d %H:%M:%S")
-    event = {"type": event_type, "timestamp": ts, "details": details or {}}
+    zone = user_tz(user)
+    if timestamp:
+        event = {"type": event_type, "timestamp": timestamp, "details": details or {}}
+        ep = event_epoch(event, zone)
+    else:
+        # straight from the clock: the string alone is ambiguous in the hour repeated when DST ends
+        now = now_local()
+        event = {"type": event_type, "timestamp": now.strftime("%Y-%m-%d %H:%M:%S"), "details": details or {}}
+        ep = now.timestamp()
+    if ep is not None:
+        event["epoch"] = int(ep)
 
     events = safe_events(user)
+    # stats first: a first-time rebuild must not already contain this event
+    stats = feed_stats(user) if event_type in FEED_TYPES else None
+    # the doc is rewritten anyway: backfill epochs on legacy events once
+    for e in events:
+        if "epoch" not in e:
+            legacy = event_epoch(e, zone)
+            if legacy is not None:
+                e["epoch"] = int(legacy)
     events.append(event)
     user[KEY_EVENTS] = events
-    db.upsert(user, User.id == user["id"])
+    if stats is not None:
+        feed_stats_apply(stats, event, zone)
+    save_user(user)
     return event
 
 def last_event(user, types: list[str]):
-    events = safe_events(user)
-    filtered = [e for e in events if e.get("type") in types]
-    if not filtered:
+    hit = user_index(user).last_of(types)
+    return hit[1] if hit else None
+
+# ----------------------------------------------------
+# Per-user event index (day buckets, latest events, sleep/breastfeeding sessions)
+# Built from the events list on demand and cached per user; appended events
+# are folded in, anything else (undo) rebuilds.
+# ----------------------------------------------------
+TS_FMT = "%Y-%m-%d %H:%M:%S"
+
+def parse_local_ts(ts_str, tz=None):
+    """'YYYY-MM-DD HH:MM:SS' (local to tz, default: the request's zone) -> aware datetime, or None."""
+    try:
+        return dt.datetime.strptime(ts_str, TS_FMT).replace(tzinfo=tz or current_tz())
+    except (TypeError, ValueError):
+        return None
+
+def local_midnight(day: dt.date, tz=None) -> dt.datetime:
+    return dt.datetime.combine(day, dt.time(0, 0), tzinfo=tz or current_tz())
+
+class IntervalIndex:
+    """
+    Static interval index: sessions sorted by start, plus a max-end segment
+    tree over that order. overlapping(t1, t2) bisects the start array and
+    walks only subtrees whose max end reaches past t1 -> O(log n + k) for
+    the usual non-overlapping sessions of one baby.
+    """
+
+    def __init__(self, sessions):
+        # sessions: iterable of (start_epoch, end_epoch, event)
+        items = sorted((s for s in sessions if s[1] > s[0]), key=lambda s: (s[0], s[1]))
+        self.items = items
+        self.starts = [s[0] for s in items]
+        n = len(items)
+        self.size = 1
+        while self.size < max(1, n):
+            self.size *= 2
+        self.maxend = [float("-inf")] * (2 * self.size)
+        for i, s in enumerate(items):
+            self.maxend[self.size + i] = s[1]
+        for i in range(self.size - 1, 0, -1):
+            self.maxend[i] = max(self.maxend[2 * i], self.maxend[2 * i + 1])
+
+    def __len__(self):
+        return len(self.items)
+
+    def overlapping(self, t1: float, t2: float):
+        """Sessions with start < t2 and end > t1, ordered by start."""
+        hi = bisect.bisect_left(self.starts, t2)
+        out = []
+        if hi == 0:
+            return out
+        stack = [(1, 0, self.size)]
+        while stack:
+            node, lo, width_end = stack.pop()
+            if lo >= hi or self.maxend[node] <= t1:
+                continue
+            if node >= self.size:
+                out.append(self.items[node - self.size])
+                continue
+            mid = (lo + width_end) // 2
+            # push right first so results come out in start order
+            stack.append((2 * node + 1, mid, width_end))
+            stack.append((2 * node, lo, mid))
+        return out
+
+    def minutes_between(self, t1: float, t2: float) -> int:
+        """Covered minutes inside [t1, t2); duplicate/overlapping sessions are merged."""
+        total, cur_s, cur_e = 0.0, None, None
+        for s, e, _ in self.overlapping(t1, t2):
+            s, e = max(s, t1), min(e, t2)
+            if cur_e is not None and s <= cur_e:
+                cur_e = max(cur_e, e)
+                continue
+            if cur_e is not None:
+                total += cur_e - cur_s
+            cur_s, cur_e = s, e
+        if cur_e is not None:
+            total += cur_e - cur_s
+        return int(total // 60)
+
+def session_bounds(event, tz=None):
+    d = event.get("details", {}) or {}
+    start = parse_local_ts(d.get("start_ts"), tz)
+    end = parse_local_ts(d.get("end_ts"), tz)
+    if not start or not end:
         return None
-    return sorted(filtered, key=lambda x: x.get("timestamp", ""))[-1]
+    return start.timestamp(), end.timestamp()
+
+def event_epoch(event, tz=None):
+    """Unix seconds of an event; stored on write, parsed once for legacy events."""
+    ep = event.get("epoch")
+    if isinstance(ep, (int, float)):
+        return ep
+    ts = parse_local_ts(event.get("timestamp"), tz)
+    return ts.timestamp() if ts else None
+
+def parsed_epoch(ts_str, tz=None):
+    ts = parse_local_ts(ts_str, tz)
+    return ts.timestamp() if ts else None
+
+def event_key(event):
+    return (event.get("timestamp"), event.get("type"), repr(event.get("details")))
+
+class UserIndex:
+    """
+    Everything the reports need from one user's events, parsed once (in the
+    user's zone): latest event per type, latest sleep start/end, the session
+    interval indexes and a timeline ordered by (epoch, seq), seq being the
+    event's position in the events list. A local day is an epoch range of
+    the timeline (day_bounds), so day queries are two bisects. Appends are
+    folded in incrementally.
+    """
+
+    def __init__(self, events=(), tz_name: str = DEFAULT_TZ_NAME):
+        self.tz_name = tz_name
+        self.zone = get_zone(tz_name)
+        self.count = 0
+        self.tail_key = None
+        self.last_by_type = {}    # type -> (epoch, event)
+        self.last_sleep_start = None  # (start_ts, epoch, event)
+        self.last_sleep_end = None    # (end_ts, epoch, event)
+        self._sessions = {"sleep": [], "breastfeeding": []}
+        self.timeline_keys = []   # sorted (epoch, seq)
+        self.timeline = []        # events, same order
+        self.sleep = IntervalIndex(())
+        self.breastfeeding = IntervalIndex(())
+        self.extend(events)
+
+    def extend(self, events):
+        sessions_changed = False
+        for e in events:
+            seq = self.count
+            self.count += 1
+            self.tail_key = event_key(e)
+            ep = event_epoch(e, self.zone)
+            if ep is None:
+                continue
+            key = (ep, seq)
+            if not self.timeline_keys or key > self.timeline_keys[-1]:
+                self.timeline_keys.append(key)
+                self.timeline.append(e)
+            else:  # back-dated log ("נרדם 21:00" sent later)
+                pos = bisect.bisect(self.timeline_keys, key)
+                self.timeline_keys.insert(pos, key)
+                self.timeline.insert(pos, e)
+            t = e.get("type")
+            prev = self.last_by_type.get(t)
+            if not prev or e.get("timestamp", "") >= prev[1].get("timestamp", ""):
+                self.last_by_type[t] = (ep, e)
+
+            d = e.get("details", {}) or {}
+            if t == "sleep":
+                s, en = d.get("start_ts"), d.get("end_ts")
+                if s and (not self.last_sleep_start or s >= self.last_sleep_start[0]):
+                    self.last_sleep_start = (s, parsed_epoch(s, self.zone), e)
+                if en and (not self.last_sleep_end or en >= self.last_sleep_end[0]):
+                    self.last_sleep_end = (en, parsed_epoch(en, self.zone), e)
+            if t in self._sessions:
+                b = session_bounds(e, self.zone)
+                if b:
+                    self._sessions[t].append((b[0], b[1], e))
+                    sessions_changed = True
+        if sessions_changed:
+            self.sleep = IntervalIndex(self._sessions["sleep"])
+            self.breastfeeding = IntervalIndex(self._sessions["breastfeeding"])
+
+    def last_of(self, types):
+        """(epoch, event) of the latest event among types, or None."""
+        found = [self.last_by_type[t] for t in types if t in self.last_by_type]
+        if not found:
+            return None
+        return max(found, key=lambda x: x[1].get("timestamp", ""))
+
+    def day_bounds(self, day: dt.date):
+        return day_bounds(self.tz_name, day)
+
+    def day_events(self, day: dt.date):
+        """Events of one local day, in time order."""
+        t1, t2 = day_bounds(self.tz_name, day)
+        lo = bisect.bisect_left(self.timeline_keys, (t1, -1))
+        hi = bisect.bisect_left(self.timeline_keys, (t2, -1), lo)
+        return self.timeline[lo:hi]
+
+    def between(self, t1: float, t2: float, after=None, limit: int = 100):
+        """Up to `limit` ((epoch, seq), event) with t1 <= epoch < t2, strictly after the `after` key."""
+        lo = bisect.bisect_left(self.timeline_keys, (t1, -1))
+        if after is not None:
+            lo = max(lo, bisect.bisect_right(self.timeline_keys, tuple(after)))
+        hi = bisect.bisect_left(self.timeline_keys, (t2, -1), lo)
+        hi = min(hi, lo + limit)
+        return list(zip(self.timeline_keys[lo:hi], self.timeline[lo:hi]))
+
+USER_INDEX_CACHE_SIZE = 2000
+_user_index_cache = OrderedDict()  # uid -> UserIndex
+_user_index_lock = threading.Lock()
+
+def user_index(user) -> UserIndex:
+    uid = user.get("id", "")
+    events = safe_events(user)
+    tz_name = user_tz_name(user)
+    with _user_index_lock:
+        idx = _user_index_cache.get(uid)
+        # reuse while the cached prefix is intact (appends only) and the zone is the same; anything else rebuilds
+        if (
+            idx is None
+            or idx.tz_name != tz_name
+            or len(events) < idx.count
+            or (idx.count and event_key(events[idx.count - 1]) != idx.tail_key)
+        ):
+            idx = UserIndex(events, tz_name)
+        elif len(events) > idx.count:
+            idx.extend(events[idx.count:])
+        _user_index_cache[uid] = idx
+        _user_index_cache.move_to_end(uid)
+        while len(_user_index_cache) > USER_INDEX_CACHE_SIZE:
+            _user_index_cache.popitem(last=False)
+    return idx
+
+# ----------------------------------------------------
+# Feeding statistics, maintained incrementally by add_event
+#   user[KEY_FEED_STATS] = {
+#     "last_epoch": int, "last_bucket": str,
+#     "interval": {bucket: {"mean": min, "dev": min, "n": int}},   # EWMA per time-of-day bucket
+#     "bottle_ml": [last N amounts], "bf_min": [last N durations],
+#   }
+# Everything here can be rebuilt from the events list (rebuild_feed_stats).
+# ----------------------------------------------------
+FEED_TYPES = ("bottle", "breastfeeding")
+FEED_EWMA_ALPHA = 0.3
+FEED_SESSION_GAP_MIN = 30          # closer than this = same feed (e.g. "ימין 10" + "שמאל 8")
+FEED_MAX_INTERVAL_MIN = 8 * 60     # longer gaps are missing logs, not intervals
+FEED_ROLLING_N = 20
+FEED_BUCKET_HOURS = 6              # 00-06 / 06-12 / 12-18 / 18-24
+
+def feed_bucket(epoch: float, tz=None) -> str:
+    return str(dt.datetime.fromtimestamp(epoch, tz=tz or current_tz()).hour // FEED_BUCKET_HOURS)
+
+def empty_feed_stats():
+    return {"last_epoch": None, "last_bucket": None, "interval": {}, "bottle_ml": [], "bf_min": []}
+
+def ewma_update(slot, x: float):
+    if not slot.get("n"):
+        slot.update({"mean": x, "dev": x / 4, "n": 1})
+        return
+    err = x - slot["mean"]
+    slot["mean"] += FEED_EWMA_ALPHA * err
+    slot["dev"] += FEED_EWMA_ALPHA * (abs(err) - slot["dev"])
+    slot["n"] += 1
+
+def feed_stats_apply(stats, event, tz=None):
+    """O(1) update of stats with one new feed event (buckets are hours in tz, the user's zone)."""
+    ep = event.get("epoch")
+    if ep is None or event.get("type") not in FEED_TYPES:
+        return stats
+    d = event.get("details", {}) or {}
+    if event["type"] == "bottle" and to_int(d.get("amount", 0)) > 0:
+        stats["bottle_ml"] = (stats["bottle_ml"] + [to_int(d["amount"])])[-FEED_ROLLING_N:]
+    if event["type"] == "breastfeeding" and to_int(d.get("duration") or 0) > 0:
+        stats["bf_min"] = (stats["bf_min"] + [to_int(d["duration"])])[-FEED_ROLLING_N:]
+
+    last = stats.get("last_epoch")
+    if last is not None and ep < last:
+        return stats  # back-dated entry: keep amounts, don't break the interval chain
+    if last is not None:
+        gap = (ep - last) / 60
+        if gap < FEED_SESSION_GAP_MIN:
+            return stats  # same feed continues; keep its start as the reference
+        if gap <= FEED_MAX_INTERVAL_MIN:
+            ewma_update(stats["interval"].setdefault(stats["last_bucket"], {}), gap)
+            ewma_update(stats["interval"].setdefault("all", {}), gap)
+    stats["last_epoch"] = int(ep)
+    stats["last_bucket"] = feed_bucket(ep, tz)
+    return stats
+
+def rebuild_feed_stats(user):
+    zone = user_tz(user)
+    feeds = [(event_epoch(e, zone), e) for e in safe_events(user) if e.get("type") in FEED_TYPES]
+    feeds = sorted((f for f in feeds if f[0] is not None), key=lambda f: f[0])
+    stats = empty_feed_stats()
+    for ep, e in feeds:
+        feed_stats_apply(stats, dict(e, epoch=ep), zone)
+    user[KEY_FEED_STATS] = stats
+    return stats
+
+def feed_stats(user):
+    stats = user.get(KEY_FEED_STATS)
+    if not isinstance(stats, dict):
+        stats = rebuild_feed_stats(user)
+    return stats
 
 # ====================================================
 # 5) UX text (confirmations only)
@@ -283,9 +767,9 @@ def maybe_milestone(user):
     - choose next target per day with a deterministic random (by user+date),
     - after firing, push next target forward by 2-4 events.
     """
-    d = today_str()
-    events = safe_events(user)
-    today_count = sum(1 for e in events if str(e.get("timestamp", "")).startswith(d))
+    today = now_local().date()
+    d = today.isoformat()
+    today_count = len(user_index(user).day_events(today))
 
     state = user.get(KEY_DAY_MILESTONE, {})
     day_state = state.get(d)
@@ -311,29 +795,36 @@ def maybe_milestone(user):
         day_state["next"] = next_target + advance
         state[d] = day_state
         user[KEY_DAY_MILESTONE] = state
-        db.upsert(user, User.id == user["id"])
+        save_user(user)
         return msg
 
     # persist state if new
     if d not in state:
         state[d] = day_state
         user[KEY_DAY_MILESTONE] = state
-        db.upsert(user, User.id == user["id"])
+        save_user(user)
     return None
 
 # ====================================================
 # 7) Reports: status + comparison
 # ====================================================
 def summarize_day(user, day: dt.date):
-    events = safe_events(user)
-    day_str = day.strftime("%Y-%m-%d")
-    day_events = [e for e in events if str(e.get("timestamp", "")).startswith(day_str)]
+    idx = user_index(user)
+    day_start, day_end = idx.day_bounds(day)
+    day_events = idx.day_events(day)
 
     bottles_ml = sum(to_int(e.get("details", {}).get("amount", 0)) for e in day_events if e.get("type") == "bottle")
     pumps_ml = sum(to_int(e.get("details", {}).get("amount", 0)) for e in day_events if e.get("type") == "pump")
     bf_count = len([e for e in day_events if e.get("type") == "breastfeeding"])
     diapers = len([e for e in day_events if e.get("type") == "diaper"])
-    sleep_mins = sum(to_int(e.get("details", {}).get("duration_min", 0)) for e in day_events if e.get("type") == "sleep")
+    # sleep: sessions are split at local midnight (overnight sleep counts on both days);
+    # legacy entries without start/end keep crediting their duration to the logged day
+    sleep_mins = idx.sleep.minutes_between(day_start, day_end)
+    sleep_mins += sum(
+        to_int(e.get("details", {}).get("duration_min", 0))
+        for e in day_events
+        if e.get("type") == "sleep" and not session_bounds(e, idx.zone)
+    )
 
     return {
         "bottles_ml": bottles_ml,
@@ -348,17 +839,13 @@ def get_status_text(user):
     s = summarize_day(user, now_local().date())
 
     # optional “smart cue” (no scheduling; computed now)
-    last_feed = last_event(user, ["bottle", "breastfeeding"])
+    last_feed = user_index(user).last_of(["bottle", "breastfeeding"])
     cue = ""
     if last_feed:
-        try:
-            ts = dt.datetime.strptime(last_feed["timestamp"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=TZ)
-            delta = now_local() - ts
-            # show only if meaningful
-            if delta.total_seconds() >= 2.5 * 3600:
-                cue = f"\n\n💡 עברו {format_timedelta(delta).replace('לפני ', '')} מאז האכילה האחרונה."
-        except:
-            pass
+        delta = timedelta(seconds=now_local().timestamp() - last_feed[0])
+        # show only if meaningful
+        if delta.total_seconds() >= 2.5 * 3600:
+            cue = f"\n\n💡 עברו {format_timedelta(delta).replace('לפני ', '')} מאז האכילה האחרונה."
 
     res = (
         f"📌 סטטוס להיום עבור {baby}:\n"
@@ -399,6 +886,246 @@ def get_comparison_text(user, days: int = 7):
     )
     return res
 
+# ----------------------------------------------------
+# Trends ('מגמה'): weekly curves over 8-26 weeks. The range's events are
+# pulled from the user index once; the per-day series math is in trends.py.
+# ----------------------------------------------------
+TREND_WEEKS_DEFAULT = 8
+TREND_WEEKS_MIN = 8
+TREND_WEEKS_MAX = 26
+NIGHT_START_HOUR = 19
+NIGHT_END_HOUR = 7
+TREND_STABLE_SHARE = 0.05  # a total change under 5% of the mean reads as "stable"
+
+# (series, label, format, unit suffix)
+TREND_LINES = [
+    ("bottle_ml", "🍼 בקבוקים", "ml", " ליום"),
+    ("feeds", "🤱 האכלות", "count", " ביום"),
+    ("sleep_min", "😴 שינה", "time", " ביממה"),
+    ("night_min", "🌙 מתוכה בלילה", "time", ""),
+    ("day_min", "☀️ מתוכה ביום", "time", ""),
+    ("longest_min", "💤 רצף השינה הארוך", "time", ""),
+]
+
+@lru_cache(maxsize=8192)
+def day_marks(tz_name: str, day: dt.date):
+    """(midnight, night end, night start, next midnight) of a local day, as unix seconds."""
+    zone = get_zone(tz_name)
+    start, end = day_bounds(tz_name, day)
+    night_end = dt.datetime.combine(day, dt.time(NIGHT_END_HOUR, 0), tzinfo=zone).timestamp()
+    night_start = dt.datetime.combine(day, dt.time(NIGHT_START_HOUR, 0), tzinfo=zone).timestamp()
+    return start, int(night_end), int(night_start), end
+
+def lazy_module(name: str):
+    # the numpy-backed helpers (trends, growth) are imported on first use, not at startup
+    if name not in sys.modules:
+        with startup_phase(f"{name} import"):
+            __import__(name)
+    return sys.modules[name]
+
+def trend_series(user, weeks: int):
+    """Per-day series of the `weeks` full weeks up to yesterday."""
+    tr = lazy_module("trends")
+    import numpy as np
+    idx = user_index(user)
+    last = now_local().date() - timedelta(days=1)
+    days = [last - timedelta(days=i) for i in range(weeks * 7 - 1, -1, -1)]
+    marks = np.array([day_marks(idx.tz_name, d) for d in days], dtype=np.float64)
+    t1, t2 = marks[0, 0], marks[-1, 3]
+
+    ev_epoch, ev_metric, ev_value, legacy_epoch, legacy_min = [], [], [], [], []
+    lo = bisect.bisect_left(idx.timeline_keys, (t1, -1))
+    hi = bisect.bisect_left(idx.timeline_keys, (t2, -1), lo)
+    for (ep, _), e in zip(idx.timeline_keys[lo:hi], idx.timeline[lo:hi]):
+        t = e.get("type")
+        d = e.get("details", {}) or {}
+        if t == "sleep" and not (d.get("start_ts") and d.get("end_ts")):
+            legacy_epoch.append(ep)
+            legacy_min.append(to_int(d.get("duration_min", 0)))
+        ev_epoch.append(ep)
+        if t == "bottle":
+            ev_metric.append(tr.M_BOTTLE)
+            ev_value.append(to_int(d.get("amount", 0)))
+        else:
+            ev_metric.append(tr.M_BREAST if t == "breastfeeding" else tr.M_OTHER)
+            ev_value.append(0)
+    sessions = idx.sleep.overlapping(t1, t2)
+
+    return tr.daily_series(
+        marks,
+        np.array(ev_epoch, np.float64), np.array(ev_metric, np.int8), np.array(ev_value, np.float64),
+        np.array([s[0] for s in sessions], np.float64), np.array([s[1] for s in sessions], np.float64),
+        np.array(legacy_epoch, np.float64), np.array(legacy_min, np.float64),
+    )
+
+def format_trend_value(value: float, kind: str) -> str:
+    if kind == "ml":
+        return f"{round(value)} מ״ל"
+    if kind == "time":
+        mins = int(round(value))
+        return f"{mins // 60}:{mins % 60:02d} שע׳"
+    return f"{value:.1f}"
+
+def get_trend_text(user, weeks: int = TREND_WEEKS_DEFAULT):
+    baby = user.get(KEY_BABY_NAME, "הבייבי")
+    tr = lazy_module("trends")
+    import numpy as np
+    series = trend_series(user, weeks)
+    active = series["active"]
+    if active.sum() < 7:
+        return "אין עדיין מספיק נתונים למגמה – צריך לפחות שבוע של תיעוד 🙏"
+
+    lines = [
+        f"📈 מגמה עבור {baby} – {weeks} שבועות (עד אתמול)",
+        "כל תו = ממוצע יומי של שבוע, מהישן (שמאל) לחדש (ימין)",
+    ]
+    for key, label, kind, per in TREND_LINES:
+        values = series[key]
+        if not values[active].any():
+            continue
+        per_week = tr.weekly(values, active)
+        known = np.flatnonzero(~np.isnan(per_week))
+        then, now = per_week[known[0]], per_week[known[-1]]
+        ago = weeks - known[0]
+        slope = tr.slope_per_week(values, active)
+        mean = values[active].mean()
+        if abs(slope) * weeks < TREND_STABLE_SHARE * mean:
+            direction = "→ יציב"
+        else:
+            direction = f"{'↗ +' if slope > 0 else '↘ -'}{format_trend_value(abs(slope), kind)} בשבוע"
+        lines.append("")
+        lines.append(f"{label}: {format_trend_value(now, kind)}{per}, {direction} "
+                     f"(לפני {ago} שבועות: {format_trend_value(then, kind)})")
+        # LRM: keep the sparkline left-to-right inside the RTL message
+        lines.append("‎" + tr.sparkline(per_week))
+    return "\n".join(lines)
+
+# ----------------------------------------------------
+# Growth ('משקל 4.2' / 'אורך 55' / 'גדילה'): measurements are plain events;
+# percentiles come from the WHO LMS tables in growth.py, looked up for all of
+# a user's measurements at once.
+# ----------------------------------------------------
+# event type -> (WHO indicator, details key, unit, label, valid range)
+GROWTH_TYPES = {
+    "weight": ("wfa", "kg", "ק״ג", "⚖️ משקל", (1.0, 30.0)),
+    "length": ("lhfa", "cm", "ס״מ", "📏 אורך", (35.0, 120.0)),
+}
+GROWTH_MAJOR_LINES = (3, 15, 50, 85, 97)
+GROWTH_REPORT_ROWS = 6
+
+def growth_value(kind: str, value: float):
+    """Parsed number -> value in the event's unit, or None when out of range ('משקל 4200' is grams)."""
+    lo, hi = GROWTH_TYPES[kind][4]
+    if kind == "weight" and value > 100:
+        value = value / 1000.0
+    if not lo <= value <= hi:
+        return None
+    return round(value, 3 if kind == "weight" else 1)
+
+def baby_dob(user):
+    try:
+        return dt.datetime.strptime(user.get(KEY_DOB) or "", "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+def age_text(age_days: int) -> str:
+    if age_days < 14:
+        return f"{age_days} ימים"
+    if age_days < 13 * 7:
+        return f"{age_days // 7} שבועות"
+    months = int(age_days / 30.4375)
+    return "שנה" if months == 12 else f"{months} חודשים"
+
+def format_percentile(p: float) -> str:
+    if p < 1:
+        return "מתחת ל-1"
+    if p > 99:
+        return "מעל 99"
+    return str(int(round(p)))
+
+def handle_growth(user, kind: str, value: float):
+    indicator, key, unit, label, (lo, hi) = GROWTH_TYPES[kind]
+    v = growth_value(kind, value)
+    if v is None:
+        if kind == "weight":
+            return ["לא הבנתי את המשקל 🤔 כתבי למשל 'משקל 4.2' (ק״ג) או 'משקל 4200' (גרם)."]
+        return [f"לא הבנתי את האורך 🤔 כתבי למשל 'אורך 55' (בס״מ, בין {int(lo)} ל-{int(hi)})."]
+    event = add_event(user["id"], kind, {key: v})
+    text = f"{label} {v:g} {unit} נרשם ✅"
+
+    dob, sex = baby_dob(user), user.get(KEY_BABY_SEX)
+    if event and dob and sex in ("m", "f"):
+        age = (now_local().date() - dob).days
+        p = lazy_module("growth").percentile(indicator, sex, age, v)
+        if p is not None:
+            text += f"\nאחוזון {format_percentile(p)} לגיל {age_text(age)} (לפי WHO)"
+    return [text + "\nלמעקב: 'גדילה'"]
+
+def get_growth_text(user):
+    baby = user.get(KEY_BABY_NAME, "הבייבי")
+    zone = user_tz(user)
+    rows = {kind: ([], []) for kind in GROWTH_TYPES}  # kind -> (epochs, values)
+    for e in safe_events(user):
+        kind = e.get("type")
+        if kind not in rows:
+            continue
+        ep = e.get("epoch") or event_epoch(e, zone)
+        v = to_float((e.get("details") or {}).get(GROWTH_TYPES[kind][1]))
+        if ep is not None and v:
+            rows[kind][0].append(ep)
+            rows[kind][1].append(v)
+    if not any(epochs for epochs, _ in rows.values()):
+        return "עדיין לא נרשמו מדידות 📏\nכתבי למשל 'משקל 4.2' או 'אורך 55' אחרי ביקור בטיפת חלב."
+
+    dob, sex = baby_dob(user), user.get(KEY_BABY_SEX)
+    lines = [f"📈 גדילה של {baby}"]
+    warn = False
+    for kind, (epochs, values) in rows.items():
+        if not epochs:
+            continue
+        indicator, _, unit, label, _ = GROWTH_TYPES[kind]
+        order = sorted(range(len(epochs)), key=epochs.__getitem__)
+        epochs = [epochs[i] for i in order]
+        values = [values[i] for i in order]
+        days = [dt.datetime.fromtimestamp(ep, zone).date() for ep in epochs]
+        pct = None
+        if dob and sex in ("m", "f"):
+            growth = lazy_module("growth")
+            pct = growth.percentiles(growth.z_scores(indicator, sex, [(d - dob).days for d in days], values))
+
+        lines.append("")
+        lines.append(f"{label}:")
+        for i in range(max(0, len(values) - GROWTH_REPORT_ROWS), len(values)):
+            row = f"{days[i].strftime('%d/%m')} – {values[i]:g} {unit}"
+            if pct is not None and pct[i] == pct[i]:
+                row += f" – אחוזון {format_percentile(pct[i])}"
+            lines.append(row)
+
+        known = [i for i in range(len(values)) if pct is not None and pct[i] == pct[i]]
+        if len(known) >= 2:
+            first, last = pct[known[0]], pct[known[-1]]
+            crossed = sum(1 for line in GROWTH_MAJOR_LINES if min(first, last) < line < max(first, last))
+            lines.append(f"מגמה: אחוזון {format_percentile(first)} ← {format_percentile(last)}")
+            warn = warn or crossed >= 2
+
+    if not (dob and sex in ("m", "f")):
+        lines.append("\n(אחוזונים מחושבים לפי תאריך הלידה ומין התינוק/ת)")
+    if warn:
+        lines.append("\n⚠️ העקומה חצתה שני קווי אחוזון או יותר – כדאי להראות לרופא/ת הילדים או בטיפת חלב.")
+    return "\n".join(lines) + LEGAL_DISCLAIMER
+
+def shadow_reports(user, now: float):
+    """What the bot would answer from this doc at `now`: the shadow store's checker compares it between backends."""
+    with app.test_request_context():
+        g.now = dt.datetime.fromtimestamp(now, tz=TZ)
+        use_user_tz(user)
+        yesterday = now_local().date() - timedelta(days=1)
+        return {
+            "status": get_status_text(user),
+            "comparison": get_comparison_text(user, days=7),
+            "yesterday": summarize_day(user, yesterday),
+        }
+
 # ====================================================
 # 8) Parser (supports multi-line, pending, timers, times)
 # ====================================================
@@ -417,37 +1144,81 @@ def clean_msg(s: str) -> str:
 def parse_help(msg: str):
     if msg in ["עזרה", "help", "menu", "תפריט"]:
         return {"type": "help_menu"}
-    if msg in ["1", "2", "3", "4", "5"]:
-        return {"type": "help_item", "id": msg}
-    # smart help by keywords
-    best_id, best_score = None, 0
-    for tid, content in HELP_TOPICS.items():
-        if tid in ["menu"]:
-            continue
-        if isinstance(content, dict):
-            score = sum(1 for kw in content.get("keywords", []) if kw in msg)
-            if score > best_score:
-                best_score, best_id = score, tid
-    if best_id and best_score >= 2:
-        return {"type": "help_item", "id": best_id}
+    if msg in HELP_KB.menu:
+        return {"type": "help_item", "id": HELP_KB.menu[msg]}
+    # smart help by keywords: only the postings of the message's own words are read
+    aid = HELP_KB.match(msg, HELP_MIN_HITS)
+    if aid:
+        return {"type": "help_item", "id": aid}
     return None
 
+# Keyword tables used by parse_single (also the vocabulary of the fuzzy index below)
+KW_RESET = ["אפס", "reset"]
+KW_UNDO = ["בטל", "מחק", "טעות", "undo"]
+KW_STATUS = ["סטטוס", "מצב", "סיכום"]
+KW_TIMEZONE = ["אזור זמן", "timezone"]
+KW_COMPARISON = ["השוואה", "השווא"]
+KW_WEEK = ["שבוע"]
+KW_TREND = ["מגמה", "מגמות", "טרנד"]
+KW_MONTH = ["חודש"]
+KW_HALF_YEAR = ["חצי שנה"]
+KW_BF_TIMER_START = ["התחל הנקה", "התחילי הנקה", "טיימר הנקה", "התחלתי הנקה"]
+KW_BF_TIMER_STOP = ["סיים הנקה", "סיימתי הנקה", "עצור הנקה", "סיום הנקה"]
+KW_SLEEP_START = ["הלך לישון", "נרדם", "נכנס לישון"]
+KW_SLEEP_END = ["התעורר", "קם", "סיים לישון"]
+KW_WHEN = ["מתי"]
+KW_WHEN_NEXT = ["הבא", "הבאה", "יאכל", "תאכל"]
+KW_NEXT_FEED = ["האכלה הבאה", "הארוחה הבאה", "האוכל הבא"]
+KW_WHEN_FEED = ["אכל", "אכלה", "בקבוק", "הנקה", "אכילה"]
+KW_WHEN_PUMP = ["שאיבה", "שאבתי"]
+KW_WHEN_DIAPER = ["חיתול", "החלפנו", "קקי", "פיפי"]
+KW_WHEN_WAKE = ["התעורר", "קם", "יקיצה"]
+KW_WHEN_SLEEP = ["נרדם", "ישן", "הלך לישון"]
+KW_AWAKE = ["כמה זמן ער", "חלון ערות", "זמן ערות"]
+KW_PUMP = ["שאיבה", "שאבתי", "שואבת"]
+KW_BOTTLE = ["בקבוק"]
+KW_DIAPER = ["חיתול", "קקי", "פיפי"]
+KW_BREASTFEEDING = ["ימין", "שמאל", "הנקה", "ינק", "ינקה"]
+KW_STASH = ["מלאי", "מלאי חלב", "כמה חלב יש"]
+KW_LOC_FREEZER = ["מקפיא", "הקפאה", "הקפאתי", "להקפאה"]
+KW_LOC_COOLER = ["צידנית"]
+KW_LOC_ROOM = ["בחוץ", "טמפרטורת החדר"]
+KW_LOC_FRIDGE = ["מקרר"]
+KW_WEIGHT = ["משקל", "שוקל", "שוקלת"]
+KW_LENGTH = ["אורך", "גובה"]
+KW_GROWTH = ["גדילה", "מעקב גדילה", "עקומת גדילה", "אחוזון", "אחוזונים"]
+
 def parse_single(line: str, user):
     msg = clean_msg(line)
-
+    parsed = parse_clean(msg, user)
+    if parsed["type"] != "unknown":
+        return parsed
+
+    # exact matching failed: retry once with typo-corrected keywords
+    corrected = FUZZY_INDEX.correct(msg)
+    if corrected != msg:
+        parsed = parse_clean(corrected, user)
+        if parsed["type"] != "unknown":
+            parsed["fuzzy"] = corrected
+    return parsed
+
+def parse_clean(msg: str, user):
     # system commands
-    if msg in ["אפס", "reset"]:
+    if msg in KW_RESET:
         return {"type": "reset"}
 
-    if any(w in msg for w in ["בטל", "מחק", "טעות", "undo"]):
+    if any(w in msg for w in KW_UNDO):
         return {"type": "undo"}
 
-    if msg in ["סטטוס", "מצב", "סיכום"]:
+    if msg in KW_STATUS:
         return {"type": "status"}
 
-    if msg.startswith("השוואה") or msg == "השווא":
+    if msg.startswith(tuple(KW_TIMEZONE)):
+        return {"type": "timezone"}
+
+    if msg.startswith(KW_COMPARISON[0]) or msg == KW_COMPARISON[1]:
         # allow: "השוואה 7" or "השוואה שבוע"
-        if "שבוע" in msg:
+        if any(w in msg for w in KW_WEEK):
             return {"type": "comparison", "days": 7}
         m = re.search(r"\b(\d+)\b", msg)
         if m:
@@ -455,8 +1226,34 @@ def parse_single(line: str, user):
             return {"type": "comparison", "days": d}
         return {"type": "comparison", "days": 7}
 
-    # help
-    h = parse_help(msg)
+    if msg.startswith(tuple(KW_TREND)):
+        # "מגמה" / "מגמה 12" (weeks) / "מגמה 3 חודשים" / "מגמה חצי שנה"
+        m = re.search(r"\b(\d+)\b", msg)
+        n = to_int(m.group(1)) if m else 0
+        if any(w in msg for w in KW_HALF_YEAR):
+            weeks = TREND_WEEKS_MAX
+        elif any(w in msg for w in KW_MONTH):
+            weeks = round((n or 2) * 30.4 / 7)
+        else:
+            weeks = n or TREND_WEEKS_DEFAULT
+        return {"type": "trend", "weeks": max(TREND_WEEKS_MIN, min(TREND_WEEKS_MAX, weeks))}
+
+    if msg in KW_STASH:
+        return {"type": "stash_report"}
+
+    # growth: "משקל 4.2" / "משקל 4200" (grams) / "אורך 55"; the word alone shows the report
+    kind = "weight" if msg.startswith(tuple(KW_WEIGHT)) else "length" if msg.startswith(tuple(KW_LENGTH)) else None
+    if kind:
+        m = re.search(r"\d+(?:\.\d+)?", msg)
+        if not m:
+            return {"type": "growth_report"}
+        return {"type": "growth", "kind": kind, "value": float(m.group())}
+    if msg in KW_GROWTH:
+        return {"type": "growth_report"}
+
+    # help (but "שאיבה 150 למקרר" is a log line, not a question about milk storage)
+    is_amount_log = any(w in msg for w in KW_PUMP + KW_BOTTLE) and re.search(r"\b\d{1,4}\b", msg)
+    h = None if is_amount_log else parse_help(msg)
     if h:
         return h
 
@@ -475,49 +1272,55 @@ def parse_single(line: str, user):
             return {"type": "pending_choice", "value": to_int(msg)}
 
     # breastfeeding timer start/stop
-    if any(k in msg for k in ["התחל הנקה", "התחילי הנקה", "טיימר הנקה", "התחלתי הנקה"]):
+    if any(k in msg for k in KW_BF_TIMER_START):
         side = "ימין" if "ימין" in msg else "שמאל" if "שמאל" in msg else "לא צוין"
         return {"type": "bf_timer_start", "side": side}
 
-    if any(k in msg for k in ["סיים הנקה", "סיימתי הנקה", "עצור הנקה", "סיום הנקה"]):
+    if any(k in msg for k in KW_BF_TIMER_STOP):
         return {"type": "bf_timer_stop"}
 
+    # ask: "מתי התעורר?" / "מתי אכל?" / "מתי הבא?"
+    # (before the sleep/wake logs: "מתי התעורר" is a question, not a wake-up)
+    if any(w in msg for w in KW_NEXT_FEED):
+        return {"type": "next_feed"}
+    if any(w in msg for w in KW_WHEN):
+        # whole words: "הבא" is also the start of "הבאנו" ("מתי הבאנו בקבוק" asks about the last bottle)
+        if set(msg.split()) & set(KW_WHEN_NEXT):
+            return {"type": "next_feed"}
+        if any(w in msg for w in KW_WHEN_FEED):
+            return {"type": "query_last", "targets": ["bottle", "breastfeeding"], "label": "האכילה"}
+        if any(w in msg for w in KW_WHEN_PUMP):
+            return {"type": "query_last", "targets": ["pump"], "label": "השאיבה"}
+        if any(w in msg for w in KW_WHEN_DIAPER):
+            return {"type": "query_last", "targets": ["diaper"], "label": "החיתול"}
+        if any(w in msg for w in KW_WHEN_WAKE):
+            return {"type": "query_last", "targets": ["sleep"], "sub": "end", "label": "היקיצה"}
+        if any(w in msg for w in KW_WHEN_SLEEP):
+            return {"type": "query_last", "targets": ["sleep"], "sub": "start", "label": "השינה"}
+
     # sleep with optional explicit time: "הלך לישון 22:30"
-    if any(w in msg for w in ["הלך לישון", "נרדם", "נכנס לישון"]):
+    if any(w in msg for w in KW_SLEEP_START):
         hhmm = parse_time_hhmm(msg)
         return {"type": "sleep_start", "hhmm": hhmm}
 
     # wake with optional explicit time
-    if any(w in msg for w in ["התעורר", "קם", "סיים לישון"]):
+    if any(w in msg for w in KW_SLEEP_END):
         hhmm = parse_time_hhmm(msg)
         return {"type": "sleep_end", "hhmm": hhmm}
 
-    # ask: "מתי התעורר?" / "מתי אכל?"
-    if "מתי" in msg:
-        if any(w in msg for w in ["אכל", "אכלה", "בקבוק", "הנקה", "אכילה"]):
-            return {"type": "query_last", "targets": ["bottle", "breastfeeding"], "label": "האכילה"}
-        if any(w in msg for w in ["שאיבה", "שאבתי"]):
-            return {"type": "query_last", "targets": ["pump"], "label": "השאיבה"}
-        if any(w in msg for w in ["חיתול", "החלפנו", "קקי", "פיפי"]):
-            return {"type": "query_last", "targets": ["diaper"], "label": "החיתול"}
-        if any(w in msg for w in ["התעורר", "קם", "יקיצה"]):
-            return {"type": "query_last", "targets": ["sleep"], "sub": "end", "label": "היקיצה"}
-        if any(w in msg for w in ["נרדם", "ישן", "הלך לישון"]):
-            return {"type": "query_last", "targets": ["sleep"], "sub": "start", "label": "השינה"}
-
-    if any(w in msg for w in ["כמה זמן ער", "חלון ערות", "זמן ערות"]):
+    if any(w in msg for w in KW_AWAKE):
         return {"type": "query_awake"}
 
     # pump
-    if any(w in msg for w in ["שאיבה", "שאבתי", "שואבת"]):
+    if any(w in msg for w in KW_PUMP):
         amt = 0
         m = re.search(r"\b(\d{1,4})\b", msg)
         if m:
             amt = to_int(m.group(1))
-        return {"type": "pump", "amount": amt}
+        return {"type": "pump", "amount": amt, "location": parse_stash_location(msg)}
 
     # bottle
-    if "בקבוק" in msg:
+    if any(w in msg for w in KW_BOTTLE):
         amt = 0
         m = re.search(r"\b(\d{1,4})\b", msg)
         if m:
@@ -525,7 +1328,7 @@ def parse_single(line: str, user):
         return {"type": "bottle", "amount": amt}
 
     # diaper
-    if any(w in msg for w in ["חיתול", "קקי", "פיפי"]):
+    if any(w in msg for w in KW_DIAPER):
         if "קקי" in msg and "פיפי" in msg:
             t = "חיתול מלא"
         elif "קקי" in msg:
@@ -538,7 +1341,7 @@ def parse_single(line: str, user):
 
     # breastfeeding: allow WITHOUT duration
     # examples: "ימין 10", "שמאל", "הנקה ימין", "ינק 12"
-    if any(w in msg for w in ["ימין", "שמאל", "הנקה", "ינק", "ינקה"]):
+    if any(w in msg for w in KW_BREASTFEEDING):
         side = "ימין" if "ימין" in msg else "שמאל" if "שמאל" in msg else "לא צוין"
         m = re.search(r"\b(\d{1,3})\b", msg)
         dur = to_int(m.group(1)) if m else None
@@ -550,78 +1353,267 @@ def parse_single(line: str, user):
 
     return {"type": "unknown"}
 
+# ----------------------------------------------------
+# Typo tolerance: SymSpell-style deletion index over every keyword above
+# (+ the help articles' keywords). Built once at import; a lookup only touches the
+# delete-variants of the typed token, never the whole vocabulary.
+# ----------------------------------------------------
+FUZZY_MIN_TOKEN_LEN = 3
+FUZZY_MAX_DISTANCE = 2
+
+# the keyword tables a typo may be corrected to; a new KW_ table is exact-match only until listed here
+FUZZY_TABLES = (
+    KW_STATUS, KW_TIMEZONE, KW_COMPARISON, KW_WEEK, KW_TREND, KW_MONTH, KW_HALF_YEAR,
+    KW_BF_TIMER_START, KW_BF_TIMER_STOP, KW_SLEEP_START, KW_SLEEP_END,
+    KW_WHEN, KW_WHEN_NEXT, KW_NEXT_FEED, KW_WHEN_FEED, KW_WHEN_PUMP, KW_WHEN_DIAPER, KW_WHEN_WAKE,
+    KW_WHEN_SLEEP, KW_AWAKE, KW_PUMP, KW_BOTTLE, KW_DIAPER, KW_BREASTFEEDING,
+    KW_STASH, KW_LOC_FREEZER, KW_LOC_COOLER, KW_LOC_ROOM, KW_LOC_FRIDGE,
+    KW_WEIGHT, KW_LENGTH, KW_GROWTH,
+)
+
+# destructive commands stay exact-match only
+FUZZY_EXCLUDED = set(KW_RESET) | set(KW_UNDO)
+
+# final letters compare as their regular forms: "נרדמה" is one edit from "נרדם", not two
+FINAL_LETTERS = str.maketrans("םןץףך", "מנצפכ")
+
+# ordinary words one edit away from a keyword ("מלאה" / "מלאי"): never "corrected"
+FUZZY_PLAIN_WORDS = {"מלא", "מלאה", "מלאים", "מלאות"}
+
+def fuzzy_max_distance(word: str) -> int:
+    # short words are too close to each other to guess safely
+    if len(word) < 4:
+        return 0
+    if len(word) < 7:
+        return 1
+    return 2
+
+def word_deletes(word: str, depth: int) -> set:
+    out = {word}
+    frontier = {word}
+    for _ in range(depth):
+        nxt = set()
+        for w in frontier:
+            for i in range(len(w)):
+                nxt.add(w[:i] + w[i + 1:])
+        out |= nxt
+        frontier = nxt
+    return out
+
+def edit_distance(a: str, b: str) -> int:
+    # optimal string alignment (Levenshtein + adjacent transposition)
+    prev2, prev = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if prev2 is not None and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        prev2, prev = prev, cur
+    return prev[len(b)]
+
+class FuzzyKeywordIndex:
+    def __init__(self, phrases):
+        self.words = set()
+        self.forms = {}    # keyword with regular letters only -> {keyword}
+        self.deletes = {}  # delete-variant of a form -> {form}
+        for phrase in phrases:
+            for w in phrase.split():
+                if w in self.words:
+                    continue
+                self.words.add(w)
+                form = w.translate(FINAL_LETTERS)
+                self.forms.setdefault(form, set()).add(w)
+                for v in word_deletes(form, fuzzy_max_distance(w)):
+                    self.deletes.setdefault(v, set()).add(form)
+
+    def lookup(self, token: str):
+        """Closest keyword for a token, or None if nothing/ambiguous."""
+        if token in self.words:
+            return token
+        if token in FUZZY_PLAIN_WORDS:
+            return None
+        if len(token) < FUZZY_MIN_TOKEN_LEN:
+            return None
+        # both lengths gate the distance: "מלא" must not become "מלאי"
+        max_d = fuzzy_max_distance(token)
+        if max_d == 0:
+            return None
+        token = token.translate(FINAL_LETTERS)
+        best, best_d = set(), FUZZY_MAX_DISTANCE + 1
+        for v in word_deletes(token, max_d):
+            for form in self.deletes.get(v, ()):
+                d = edit_distance(token, form)
+                if d > min(max_d, fuzzy_max_distance(form)) or d > best_d:
+                    continue
+                if d < best_d:
+                    best, best_d = {form}, d
+                else:
+                    best.add(form)
+        words = set().union(*(self.forms[form] for form in best))
+        if len(words) == 1:
+            return next(iter(words))
+        return None
+
+    def correct(self, msg: str) -> str:
+        out = []
+        for tok in msg.split(" "):
+            if tok in self.words or not re.fullmatch(r"[^\W\d_]+", tok):
+                out.append(tok)
+                continue
+            out.append(self.lookup(tok) or tok)
+        return " ".join(out)
+
+def fuzzy_vocabulary():
+    phrases = [p for table in FUZZY_TABLES for p in table]
+    phrases.extend(HELP_KB.vocabulary())
+    return [p for p in phrases if p not in FUZZY_EXCLUDED]
+
+FUZZY_INDEX = FuzzyKeywordIndex(fuzzy_vocabulary())
+
+startup_mark("helpers + parser tables + fuzzy index")
+
 # ====================================================
 # 9) Actions
 # ====================================================
+UNDO_LABELS = {
+    "bottle": "בקבוק",
+    "pump": "שאיבה",
+    "breastfeeding": "הנקה",
+    "diaper": "חיתול",
+    "bf_timer_start": "התחלת טיימר הנקה",
+    "bf_timer_stop": "עצירת טיימר הנקה",
+    "sleep_start": "הלך/ה לישון",
+    "sleep_end": "התעורר/ה",
+    "timezone": "אזור זמן",
+    "growth": "מדידת גדילה",
+}
+
 def handle_undo(user):
     if user.get(KEY_PENDING):
         user[KEY_PENDING] = None
-        db.upsert(user, User.id == user["id"])
+        save_user(user)
         return ["בוטל."]
 
+    # every 'בטל' rolls back one more action (event, timer, sleep state...) from the journal's undo stack
+    label = get_store().undo(user["id"])
+    if label is not None:
+        # the rolled-back stash may hold batches that have expired since
+        stash_expire(get_user_by_any(user["id"]))
+        return [f"נמחק. ({UNDO_LABELS.get(label, 'הפעולה האחרונה')})"]
+
+    # docs from before the journal have no undo stack: drop the last event like before
     events = safe_events(user)
     if events:
         removed = events.pop()
         user[KEY_EVENTS] = events
-        db.upsert(user, User.id == user["id"])
+        stash_unlog(user, removed)
+        if removed.get("type") in FEED_TYPES:
+            rebuild_feed_stats(user)
+        save_user(user)
+        stash_expire(user)
         # confirmation only (but show what was removed succinctly)
         return [f"נמחק. ({removed.get('type')})"]
     return ["אין מה למחוק."]
 
+def handle_timezone(user, line: str):
+    # the zone name is taken from the raw line: clean_msg() drops the '/' in 'Europe/London'
+    arg = line.strip()
+    for kw in KW_TIMEZONE:
+        if arg.lower().startswith(kw):
+            arg = arg[len(kw):].strip(" :-")
+            break
+    if not arg:
+        return [f"🕰️ אזור הזמן שלך: {user_tz_name(user)} (השעה אצלך עכשיו {now_local().strftime('%H:%M')}).\n"
+                f"לשינוי: 'אזור זמן Europe/London'"]
+
+    name = resolve_zone_name(arg)
+    if not name:
+        return ["לא מכירה את אזור הזמן הזה 🤔\nנסי למשל: 'אזור זמן Europe/London' או 'אזור זמן America/New_York'"]
+
+    user[KEY_TZ] = name
+    save_user(user)
+    use_user_tz(user)
+    return [f"🕰️ עודכן: {name} (השעה אצלך עכשיו {now_local().strftime('%H:%M')})."]
+
 def handle_query_last(user, parsed):
     sub = parsed.get("sub")
     targets = parsed.get("targets", [])
     label = parsed.get("label", "הפעולה")
 
-    evs = [e for e in safe_events(user) if e.get("type") in targets]
-    if not evs:
+    idx = user_index(user)
+    last = idx.last_of(targets)
+    if not last:
         return [f"לא מצאתי תיעוד של {label}."]
 
+    # start/end sub-queries only exist for sleep sessions
     if sub == "start":
-        evs = [e for e in evs if e.get("details", {}).get("start_ts")]
-        if not evs:
+        if not idx.last_sleep_start:
             return [f"לא מצאתי תיעוד של {label} (התחלה)."]
-        last = sorted(evs, key=lambda x: x["details"]["start_ts"])[-1]
-        ts_str = last["details"]["start_ts"]
+        ts_str, epoch, _ = idx.last_sleep_start
     elif sub == "end":
-        evs = [e for e in evs if e.get("details", {}).get("end_ts")]
-        if not evs:
+        if not idx.last_sleep_end:
             return [f"לא מצאתי תיעוד של {label} (סיום)."]
-        last = sorted(evs, key=lambda x: x["details"]["end_ts"])[-1]
-        ts_str = last["details"]["end_ts"]
+        ts_str, epoch, _ = idx.last_sleep_end
     else:
-        last = sorted(evs, key=lambda x: x.get("timestamp", ""))[-1]
-        ts_str = last.get("timestamp")
+        epoch, ev = last
+        ts_str = ev.get("timestamp")
 
-    try:
-        ts = dt.datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S").replace(tzinfo=TZ)
-        diff = now_local() - ts
-        return [f"{label} האחרונה הייתה {format_timedelta(diff)} ({ts.strftime('%H:%M')})."]
-    except:
+    if epoch is None:
         return [f"{label} האחרונה: {ts_str}"]
+    ts = dt.datetime.fromtimestamp(epoch, tz=user_tz(user))
+    diff = now_local() - ts
+    return [f"{label} האחרונה הייתה {format_timedelta(diff)} ({ts.strftime('%H:%M')})."]
+
+def handle_next_feed(user):
+    stats = feed_stats(user)
+    last = stats.get("last_epoch")
+    if last is None:
+        return ["אין לי עדיין תיעוד של האכלות. אפשר לרשום: 'בקבוק 120' או 'ימין'."]
+
+    slot = stats["interval"].get(stats.get("last_bucket")) or {}
+    if slot.get("n", 0) < 3:
+        slot = stats["interval"].get("all") or {}
+    if slot.get("n", 0) < 3:
+        return ["צריך עוד כמה האכלות מתועדות כדי להעריך מתי האכלה הבאה 🙏"]
+
+    spread = max(10.0, slot["dev"])
+    zone = user_tz(user)
+    earliest = dt.datetime.fromtimestamp(last + (slot["mean"] - spread) * 60, tz=zone)
+    latest = dt.datetime.fromtimestamp(last + (slot["mean"] + spread) * 60, tz=zone)
+    hours, minutes = divmod(int(round(slot["mean"])), 60)
+    lines = [
+        f"🍼 האכלה הבאה צפויה בערך בין {earliest.strftime('%H:%M')} ל-{latest.strftime('%H:%M')}.",
+        f"(בשעות האלה האכלות מגיעות בערך כל {hours}:{minutes:02d} שעות)",
+    ]
+    if stats["bottle_ml"]:
+        lines.append(f"ממוצע בקבוק לאחרונה: {round(sum(stats['bottle_ml']) / len(stats['bottle_ml']))} מ״ל")
+    if stats["bf_min"]:
+        lines.append(f"ממוצע הנקה לאחרונה: {round(sum(stats['bf_min']) / len(stats['bf_min']))} דק׳")
+    if latest < now_local():
+        lines.append("⏰ כבר עבר הזמן הצפוי – כנראה ממש בקרוב.")
+    return ["\n".join(lines)]
 
 def handle_query_awake(user):
     baby = user.get(KEY_BABY_NAME, "הבייבי")
     pr = baby_pronouns(user)
 
-    sleeps = [e for e in safe_events(user) if e.get("type") == "sleep" and e.get("details", {}).get("end_ts")]
-    if not sleeps:
+    last = user_index(user).last_sleep_end
+    if not last:
         return ["אין לי תיעוד של יקיצה אחרונה."]
-    last = sorted(sleeps, key=lambda x: x["details"]["end_ts"])[-1]
-    try:
-        end_dt = dt.datetime.strptime(last["details"]["end_ts"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=TZ)
-        diff_str = format_timedelta(now_local() - end_dt).replace("לפני ", "")
-        return [f"{baby} {pr['awake']} כבר {diff_str}."]
-    except:
+    if last[1] is None:
         return ["אין לי תיעוד תקין של יקיצה."]
+    diff_str = format_timedelta(timedelta(seconds=now_local().timestamp() - last[1])).replace("לפני ", "")
+    return [f"{baby} {pr['awake']} כבר {diff_str}."]
 
 def set_pending(user, pending_dict):
     user[KEY_PENDING] = pending_dict
-    db.upsert(user, User.id == user["id"])
+    save_user(user)
 
 def clear_pending(user):
     user[KEY_PENDING] = None
-    db.upsert(user, User.id == user["id"])
+    save_user(user)
 
 def handle_number_only(user, value: int):
     # Ask what this number refers to
@@ -638,11 +1630,9 @@ def handle_pending_choice(user, choice: int):
     clear_pending(user)
 
     if choice == 1:
-        add_event(user["id"], "bottle", {"amount": value})
-        return [ack_text(user, "bottle")]
+        return handle_bottle(user, value)
     if choice == 2:
-        add_event(user["id"], "pump", {"amount": value})
-        return [ack_text(user, "pump")]
+        return handle_pump(user, value)
     if choice == 3:
         # need side? ask optional side, default not specified
         add_event(user["id"], "breastfeeding", {"side": "לא צוין", "duration": value})
@@ -656,9 +1646,9 @@ def handle_bf_timer_start(user, side):
         set_pending(user, {"type": "bf_timer_overwrite", "expect": "choice", "side": side})
         return ["יש כבר טיימר הנקה פעיל.\n1) להתחיל מחדש\n2) לבטל"]
 
-    start_ts = now_local().strftime("%Y-%m-%d %H:%M:%S")
-    user[KEY_BF_TIMER] = {"side": side, "start_ts": start_ts}
-    db.upsert(user, User.id == user["id"])
+    start = now_local()
+    user[KEY_BF_TIMER] = {"side": side, "start_ts": start.strftime("%Y-%m-%d %H:%M:%S"), "start_epoch": int(start.timestamp())}
+    save_user(user)
     return [ack_text(user, "breastfeeding")]
 
 def handle_bf_timer_stop(user):
@@ -669,20 +1659,30 @@ def handle_bf_timer_stop(user):
     if not start_ts:
         return ["אין טיימר פעיל."]
 
-    try:
-        start_dt = dt.datetime.strptime(start_ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=TZ)
+    # clear first: add_event saves its own copy of the user (see handle_sleep_end)
+    user[KEY_BF_TIMER] = None
+    save_user(user)
+
+    start_epoch = running.get("start_epoch")
+    if start_epoch is None:
+        start_epoch = parsed_epoch(start_ts, user_tz(user))
+    if start_epoch is not None:
         end_dt = now_local()
-        mins = int((end_dt - start_dt).total_seconds() / 60)
+        mins = int((end_dt.timestamp() - start_epoch) / 60)
         mins = max(1, mins)
 
         add_event(user["id"], "breastfeeding", {"side": side, "duration": mins, "start_ts": start_ts, "end_ts": end_dt.strftime("%Y-%m-%d %H:%M:%S")})
-    except:
+    else:
         add_event(user["id"], "breastfeeding", {"side": side, "duration": None})
 
-    user[KEY_BF_TIMER] = None
-    db.upsert(user, User.id == user["id"])
     return [ack_text(user, "breastfeeding")]
 
+def sleep_overlap_text(event) -> str:
+    d = event.get("details", {})
+    start_hm = str(d.get("start_ts", ""))[11:16]
+    end_hm = str(d.get("end_ts", ""))[11:16]
+    return f"⚠️ שימי לב: כבר רשומה שינה {start_hm}–{end_hm} שחופפת לזמן הזה.\nאם השעה לא נכונה – אפשר לכתוב שוב 'הלך לישון' עם השעה הנכונה."
+
 def handle_sleep_start(user, hhmm):
     # if already sleeping, avoid ambiguous double "הלך לישון"
     if user.get(KEY_SLEEP_START):
@@ -697,9 +1697,15 @@ def handle_sleep_start(user, hhmm):
         if start_dt > now_local():
             start_dt = start_dt - timedelta(days=1)
 
+    # a start time inside (or before the end of) a recorded sleep double-counts that sleep
+    clashes = user_index(user).sleep.overlapping(start_dt.timestamp(), now_local().timestamp())
+
     user[KEY_SLEEP_START] = start_dt.isoformat()
-    db.upsert(user, User.id == user["id"])
-    return [ack_text(user, "sleep_start")]
+    save_user(user)
+    replies = [ack_text(user, "sleep_start")]
+    if clashes:
+        replies.append(sleep_overlap_text(clashes[-1][2]))
+    return replies
 
 def handle_sleep_end(user, hhmm):
     end_dt = now_local()
@@ -710,11 +1716,16 @@ def handle_sleep_end(user, hhmm):
             end_dt = end_dt - timedelta(days=1)
 
     start_str = user.get(KEY_SLEEP_START)
+    # clear the running state before add_event: it saves its own fresh copy of the user,
+    # and upserting this (older) dict afterwards would drop the new event
+    user[KEY_SLEEP_START] = None
+    save_user(user)
+
     if start_str:
         try:
             start_dt = dt.datetime.fromisoformat(start_str)
             if start_dt.tzinfo is None:
-                start_dt = start_dt.replace(tzinfo=TZ)
+                start_dt = start_dt.replace(tzinfo=user_tz(user))
         except:
             start_dt = None
 
@@ -732,22 +1743,163 @@ def handle_sleep_end(user, hhmm):
     else:
         add_event(user["id"], "sleep", {"action": "wake_up", "end_ts": end_dt.strftime("%Y-%m-%d %H:%M:%S")})
 
-    user[KEY_SLEEP_START] = None
-    db.upsert(user, User.id == user["id"])
     return [ack_text(user, "sleep_end")]
 
+# ----------------------------------------------------
+# Milk stash (pumped milk inventory)
+# Stored as a per-user min-heap keyed by expiry:
+#   user[KEY_STASH] = {"next_id": int, "batches": [[expiry_epoch, id, created_epoch, location, ml], ...]}
+# Pumps push a batch; bottles take from the soonest-to-expire usable batches;
+# expired batches are swept off the top of the heap. The sweep is saved on its
+# own, outside any undoable action (stash_expire), and runs again after an
+# undo: rolling back a pump or bottle never brings expired milk back.
+# ----------------------------------------------------
+# recommended lifetimes from the milk storage help article (data/help/milk-storage.txt)
+STASH_LIFETIME = {
+    "room": timedelta(hours=4),
+    "cooler": timedelta(hours=24),
+    "fridge": timedelta(days=3),
+    "freezer": timedelta(days=90),
+}
+STASH_LOCATION_LABELS = {"room": "בחוץ", "cooler": "בצידנית", "fridge": "במקרר", "freezer": "במקפיא"}
+STASH_DEFAULT_LOCATION = "fridge"
+STASH_SOON = timedelta(hours=12)
+
+def parse_stash_location(msg: str):
+    if any(w in msg for w in KW_LOC_FREEZER):
+        return "freezer"
+    if any(w in msg for w in KW_LOC_COOLER):
+        return "cooler"
+    if any(w in msg for w in KW_LOC_ROOM):
+        return "room"
+    if any(w in msg for w in KW_LOC_FRIDGE):
+        return "fridge"
+    return None
+
+def get_stash(user):
+    stash = user.get(KEY_STASH)
+    if not isinstance(stash, dict):
+        stash = {"next_id": 1, "batches": []}
+        user[KEY_STASH] = stash
+    return stash
+
+def stash_sweep(stash, now_epoch: float) -> int:
+    """Drop expired batches from the top of the heap; returns ml discarded."""
+    heap = stash["batches"]
+    dropped = 0
+    while heap and heap[0][0] <= now_epoch:
+        dropped += heapq.heappop(heap)[4]
+    return dropped
+
+def stash_expire(user) -> int:
+    """Sweep expired batches and save that as a non-action write; returns ml discarded."""
+    stash = user.get(KEY_STASH)
+    if not isinstance(stash, dict):
+        return 0
+    dropped = stash_sweep(stash, now_local().timestamp())
+    if dropped:
+        get_store().save(user)  # no action: not part of this line's undo step
+    return dropped
+
+def stash_add(user, ml: int, location: str) -> int:
+    stash = get_stash(user)
+    now = now_local()
+    batch_id = stash["next_id"]
+    stash["next_id"] = batch_id + 1
+    expiry = now + STASH_LIFETIME.get(location, STASH_LIFETIME[STASH_DEFAULT_LOCATION])
+    heapq.heappush(stash["batches"], [int(expiry.timestamp()), batch_id, int(now.timestamp()), location, ml])
+    return batch_id
+
+def stash_take(user, ml: int):
+    """Take up to ml from usable batches (stash_expire first), soonest expiry first. Returns the taken parts (for undo)."""
+    stash = get_stash(user)
+    heap = stash["batches"]
+    taken = []
+    while ml > 0 and heap:
+        batch = heap[0]
+        part = min(ml, batch[4])
+        taken.append(batch[:4] + [part])
+        ml -= part
+        if part == batch[4]:
+            heapq.heappop(heap)
+        else:
+            batch[4] -= part  # key (expiry) unchanged -> heap stays valid
+    return taken
+
+def stash_unlog(user, event) -> bool:
+    """Reverse the stash effect of a removed pump/bottle event. Returns True if the stash changed."""
+    stash = user.get(KEY_STASH)
+    if not isinstance(stash, dict):
+        return False
+    d = event.get("details", {}) or {}
+    heap = stash["batches"]
+    if event.get("type") == "pump" and d.get("batch_id"):
+        kept = [b for b in heap if b[1] != d["batch_id"]]
+        if len(kept) == len(heap):
+            return False
+        heapq.heapify(kept)
+        stash["batches"] = kept
+        return True
+    if event.get("type") == "bottle" and d.get("stash"):
+        by_id = {b[1]: b for b in heap}
+        for expiry, batch_id, created, location, part in d["stash"]:
+            if batch_id in by_id:
+                by_id[batch_id][4] += part
+            else:
+                heapq.heappush(heap, [expiry, batch_id, created, location, part])
+        return True
+    return False
+
+def handle_stash_report(user):
+    dropped = stash_expire(user)
+    stash = get_stash(user)
+    now = now_local()
+
+    batches = sorted(stash["batches"])  # expiry order; the stash is small, the pump history is not touched
+    lines = []
+    if not batches:
+        lines.append("אין כרגע חלב שאוב במלאי.")
+    else:
+        totals = {}
+        for b in batches:
+            ml, count = totals.get(b[3], (0, 0))
+            totals[b[3]] = (ml + b[4], count + 1)
+        lines.append("🧊 מלאי חלב שאוב:")
+        for loc in ("fridge", "freezer", "cooler", "room"):
+            if loc in totals:
+                ml, count = totals[loc]
+                lines.append(f"• {STASH_LOCATION_LABELS[loc]}: {ml} מ״ל ({count} מנות)")
+        soon = [b for b in batches if b[0] - now.timestamp() <= STASH_SOON.total_seconds()]
+        if soon:
+            lines.append("\n⏳ כדאי להשתמש בקרוב:")
+            for expiry, _, _, loc, ml in soon:
+                until = dt.datetime.fromtimestamp(expiry, tz=user_tz(user)).strftime("%d/%m %H:%M")
+                lines.append(f"• {ml} מ״ל {STASH_LOCATION_LABELS[loc]} – עד {until}")
+    if dropped:
+        lines.append(f"\n🗑️ {dropped} מ״ל עברו את זמן האחסון והוסרו מהמלאי.")
+    return ["\n".join(lines)]
+
 def handle_bottle(user, amount: int | None):
     if not amount or amount <= 0:
         set_pending(user, {"type": "bottle_amount", "expect": "number"})
         return ["כמה מ״ל?"]
-    add_event(user["id"], "bottle", {"amount": amount})
+    details = {"amount": amount}
+    stash_expire(user)
+    taken = stash_take(user, amount)
+    if taken:
+        details["stash"] = taken
+        save_user(user)
+    add_event(user["id"], "bottle", details)
     return [ack_text(user, "bottle")]
 
-def handle_pump(user, amount: int | None):
+def handle_pump(user, amount: int | None, location: str | None = None):
     if not amount or amount <= 0:
-        set_pending(user, {"type": "pump_amount", "expect": "number"})
+        set_pending(user, {"type": "pump_amount", "expect": "number", "location": location})
         return ["כמה מ״ל?"]
-    add_event(user["id"], "pump", {"amount": amount})
+    location = location or STASH_DEFAULT_LOCATION
+    batch_id = stash_add(user, amount, location)
+    save_user(user)
+    add_event(user["id"], "pump", {"amount": amount, "location": location, "batch_id": batch_id})
     return [ack_text(user, "pump")]
 
 def handle_breastfeeding(user, side: str, duration: int | None):
@@ -767,12 +1919,10 @@ def handle_pending_number(user, value: int):
     clear_pending(user)
 
     if pending.get("type") == "bottle_amount":
-        add_event(user["id"], "bottle", {"amount": value})
-        return [ack_text(user, "bottle")]
+        return handle_bottle(user, value)
 
     if pending.get("type") == "pump_amount":
-        add_event(user["id"], "pump", {"amount": value})
-        return [ack_text(user, "pump")]
+        return handle_pump(user, value, pending.get("location"))
 
     # fallback: ask what it is
     return handle_number_only(user, value)
@@ -802,14 +1952,14 @@ def handle_pending_overwrite_choice(user, choice: int):
         if choice == 1:
             # overwrite start
             user[KEY_SLEEP_START] = None
-            db.upsert(user, User.id == user["id"])
+            save_user(user)
             return handle_sleep_start(user, pending.get("hhmm"))
         return ["בוטל."]
 
     if pending.get("type") == "bf_timer_overwrite":
         if choice == 1:
             user[KEY_BF_TIMER] = None
-            db.upsert(user, User.id == user["id"])
+            save_user(user)
             return handle_bf_timer_start(user, pending.get("side", "לא צוין"))
         return ["בוטל."]
 
@@ -849,34 +1999,204 @@ def registration_message_after_done(user):
     )
 
 # ====================================================
-# 11) Webhook
+# 11) Flood protection (per-sender token bucket + metrics)
+# ====================================================
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "10"))         # bucket size (messages)
+RATE_LIMIT_PER_MIN = float(os.environ.get("RATE_LIMIT_PER_MIN", "20"))     # refill rate
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "")                  # optional sqlite path shared by workers
+RATE_LIMIT_MAX_SENDERS = 50_000                                            # in-memory LRU cap
+RATE_LIMIT_SWEEP_EVERY = 600                                               # seconds between stale-bucket sweeps (sqlite)
+MAX_LINES_PER_MESSAGE = int(os.environ.get("MAX_LINES_PER_MESSAGE", "15"))
+
+THROTTLED_TEXT = "רגע אחד 🙏 קיבלתי הרבה הודעות ברצף.\nאפשר לנסות שוב בעוד דקה."
+
+def lines_overflow_text(limit: int) -> str:
+    return f"✂️ רשמתי רק את {limit} השורות הראשונות.\nאת השאר אפשר לשלוח בהודעה נפרדת 🙏"
+
+METRICS = Counter()
+_metrics_lock = threading.Lock()
+
+def metric_inc(name: str, by: int = 1):
+    with _metrics_lock:
+        METRICS[name] += by
+
+class TokenBucketLimiter:
+    """
+    Per-phone token bucket, in process memory.
+    allow() returns (allowed, notify): notify is True only for the first
+    rejection of a burst, so a flooding sender gets one reply, not hundreds.
+    """
+
+    def __init__(self, burst: float, per_min: float, max_senders: int = RATE_LIMIT_MAX_SENDERS):
+        self.burst = burst
+        self.rate = per_min / 60.0
+        self.max_senders = max_senders
+        self._buckets = OrderedDict()  # phone -> [tokens, last_ts, notified]
+        self._lock = threading.Lock()
+
+    def allow(self, phone: str, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            b = self._buckets.get(phone)
+            if b is None:
+                b = [self.burst, now, False]
+                self._buckets[phone] = b
+                if len(self._buckets) > self.max_senders:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(phone)
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+            if b[0] >= 1:
+                b[0] -= 1
+                b[2] = False
+                return True, False
+            notify = not b[2]
+            b[2] = True
+            return False, notify
+
+class SqliteTokenBucketLimiter(TokenBucketLimiter):
+    """
+    Same policy, state kept in a small sqlite file so all gunicorn workers share it.
+    One indexed row per phone -> still O(1) per request. Rows of buckets that
+    have refilled completely are no different from a missing row; they are
+    deleted every RATE_LIMIT_SWEEP_EVERY seconds so the file does not grow
+    with every sender ever seen.
+    """
+
+    def __init__(self, path: str, burst: float, per_min: float):
+        super().__init__(burst, per_min)
+        self.path = path
+        self._local = threading.local()
+        self._next_sweep = 0.0
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "phone TEXT PRIMARY KEY, tokens REAL, ts REAL, notified INTEGER)"
+            )
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            import sqlite3  # only when a shared limiter is configured
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def allow(self, phone: str, now: float | None = None):
+        import sqlite3
+        # wall clock: monotonic clocks are not comparable across processes
+        now = time.time() if now is None else now
+        conn = None
+        try:
+            conn = self._conn()
+            if now >= self._next_sweep:
+                self._sweep(conn, now)
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT tokens, ts, notified FROM buckets WHERE phone = ?", (phone,)).fetchone()
+            tokens, last, notified = row if row else (self.burst, now, 0)
+            tokens = min(self.burst, tokens + max(0.0, now - last) * self.rate)
+            if tokens >= 1:
+                result = (True, False)
+                tokens, notified = tokens - 1, 0
+            else:
+                result = (False, not notified)
+                notified = 1
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (phone, tokens, ts, notified) VALUES (?, ?, ?, ?)",
+                (phone, tokens, now, notified),
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            if conn is not None and conn.in_transaction:
+                try:
+                    conn.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+            # fail open: never block a mother because the limiter file is unhappy (locked, full disk, ...)
+            metric_inc("rate_limit_store_errors")
+            return True, False
+        return result
+
+    def _sweep(self, conn, now: float):
+        # a bucket untouched for burst / rate seconds is full again: same as no row
+        self._next_sweep = now + RATE_LIMIT_SWEEP_EVERY
+        if self.rate <= 0:
+            return
+        conn.execute("DELETE FROM buckets WHERE ts < ?", (now - self.burst / self.rate,))
+
+def make_limiter():
+    if RATE_LIMIT_STORE:
+        return SqliteTokenBucketLimiter(RATE_LIMIT_STORE, RATE_LIMIT_BURST, RATE_LIMIT_PER_MIN)
+    return TokenBucketLimiter(RATE_LIMIT_BURST, RATE_LIMIT_PER_MIN)
+
+limiter = make_limiter()
+
+startup_mark("rate limiter")
+
+# ====================================================
+# 12) Webhook
 # ====================================================
+@app.before_request
+def snapshot_clock():
+    g.now = dt.datetime.now(tz=TZ)
+
 @app.route("/", methods=["GET"])
 def health():
     return "OK", 200
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    with _metrics_lock:
+        snapshot = dict(METRICS)
+    body = "".join(f"bili_{name}_total {value}\n" for name, value in sorted(snapshot.items()))
+    if _store is not None and hasattr(_store, "metrics_lines"):
+        body += "".join(line + "\n" for line in _store.metrics_lines())
+    return body, 200, {"Content-Type": "text/plain; version=0.0.4"}
+
 @app.route("/sms", methods=["POST"])
 def whatsapp_webhook():
     msg_raw = (request.values.get("Body", "") or "").strip()
     from_raw = request.values.get("From", "") or ""
     uid = normalize_phone(from_raw)
 
-    resp = MessagingResponse()
+    resp = messaging_response()
+    metric_inc("sms_requests")
+
+    # flood protection: decided before any DB access
+    allowed, notify = limiter.allow(uid)
+    if not allowed:
+        metric_inc("sms_throttled")
+        if notify:
+            resp.message(THROTTLED_TEXT)
+        return str(resp)
 
+    # one request at a time per family, across workers: mom and partner resolve to the same owner
+    store = get_store()
+    with store.user_lock(store.lock_owner(uid)):
+        return handle_sms(uid, msg_raw, resp)
+
+# line types that only read (or only keep bookkeeping): 'בטל' skips over them
+NOT_UNDOABLE = {"help_menu", "help_item", "undo", "status", "stash_report", "comparison", "trend", "growth_report",
+                "query_last", "next_feed", "query_awake"}
+
+def handle_sms(uid: str, msg_raw: str, resp):
     # Load user
     user = get_user_by_any(uid)
 
     # reset (works even for new)
     if clean_msg(msg_raw) in ["אפס", "reset"]:
         if user:
-            db.remove(User.id == user["id"])
+            get_store().remove(user["id"])
         resp.message("איתחלנו. ❤️")
         return str(resp)
 
     # New user: stage 0 -> ask mom name
     if not user:
-        db.insert({"id": uid, KEY_STAGE: 0})
+        get_store().insert({"id": uid, KEY_STAGE: 0, KEY_TZ: zone_for_phone(uid)})
         user = get_user_by_any(uid)
+    use_user_tz(user)
 
     stage = user.get(KEY_STAGE, 0)
 
@@ -888,7 +2208,7 @@ def whatsapp_webhook():
         if t and t not in greetings:
             user[KEY_MOM_NAME] = msg_raw.strip()
             user[KEY_STAGE] = 1
-            db.upsert(user, User.id == user["id"])
+            save_user(user)
             mom = user.get(KEY_MOM_NAME, "")
             resp.message(
                 f"היי {mom} 👋\nמזל טוב!\nמה נולד?\n1) 👶 בן\n2) 👧 בת"
@@ -915,7 +2235,7 @@ def whatsapp_webhook():
             return str(resp)
 
         user[KEY_STAGE] = 2
-        db.upsert(user, User.id == user["id"])
+        save_user(user)
 
         # ask baby name (based on sex)
         sex = user.get(KEY_BABY_SEX)
@@ -929,7 +2249,7 @@ def whatsapp_webhook():
     if stage == 2:
         user[KEY_BABY_NAME] = msg_raw.strip()
         user[KEY_STAGE] = 3
-        db.upsert(user, User.id == user["id"])
+        save_user(user)
 
         pr = baby_pronouns(user)
         resp.message(f"מתי {pr['born']}?")
@@ -946,7 +2266,7 @@ def whatsapp_webhook():
 
         user[KEY_DOB] = formatted
         user[KEY_STAGE] = 4
-        db.upsert(user, User.id == user["id"])
+        save_user(user)
 
         # feeding mode question (for your tracking)
         resp.message("איך ההאכלה בדרך כלל?\n1) הנקה\n2) בקבוק\n3) משולב\n4) שאיבה")
@@ -962,7 +2282,7 @@ def whatsapp_webhook():
 
         user[KEY_FEEDING_MODE] = mapping[ans]
         user[KEY_STAGE] = 5
-        db.upsert(user, User.id == user["id"])
+        save_user(user)
 
         resp.message(registration_message_after_done(user))
         return str(resp)
@@ -977,39 +2297,71 @@ def whatsapp_webhook():
     if not lines:
         lines = [""]
 
-    for ln in lines:
+    overflow = len(lines) > MAX_LINES_PER_MESSAGE
+    if overflow:
+        metric_inc("sms_lines_truncated")
+        metric_inc("sms_lines_dropped", len(lines) - MAX_LINES_PER_MESSAGE)
+        lines = lines[:MAX_LINES_PER_MESSAGE]
+
+    for i, ln in enumerate(lines):
         parsed = parse_single(ln, user)
+        # saves made while handling this line are undone together by one 'בטל'
+        g.action = None if parsed["type"] in NOT_UNDOABLE else {"id": f"{time.time_ns():x}-{i}", "label": parsed["type"]}
 
         if parsed["type"] == "help_menu":
-            replies.append(HELP_TOPICS["menu"])
+            replies.append(HELP_MENU)
             continue
 
         if parsed["type"] == "help_item":
-            item = HELP_TOPICS.get(parsed["id"])
-            if item:
-                replies.append(item["text"] + LEGAL_DISCLAIMER)
-            else:
-                replies.append(HELP_TOPICS["menu"])
+            replies.append(HELP_KB.answer(parsed["id"]) or HELP_MENU)
             continue
 
         if parsed["type"] == "undo":
             replies.extend(handle_undo(user))
             # update user ref after DB writes
             user = get_user_by_any(uid)
+            use_user_tz(user)
+            continue
+
+        if parsed["type"] == "timezone":
+            replies.extend(handle_timezone(user, ln))
+            user = get_user_by_any(uid)
             continue
 
         if parsed["type"] == "status":
             replies.append(get_status_text(user))
             continue
 
+        if parsed["type"] == "growth":
+            replies.extend(handle_growth(user, parsed["kind"], parsed["value"]))
+            user = get_user_by_any(uid)
+            continue
+
+        if parsed["type"] == "growth_report":
+            replies.append(get_growth_text(user))
+            continue
+
+        if parsed["type"] == "stash_report":
+            replies.extend(handle_stash_report(user))
+            user = get_user_by_any(uid)
+            continue
+
         if parsed["type"] == "comparison":
             replies.append(get_comparison_text(user, days=parsed.get("days", 7)))
             continue
 
+        if parsed["type"] == "trend":
+            replies.append(get_trend_text(user, weeks=parsed.get("weeks", TREND_WEEKS_DEFAULT)))
+            continue
+
         if parsed["type"] == "query_last":
             replies.extend(handle_query_last(user, parsed))
             continue
 
+        if parsed["type"] == "next_feed":
+            replies.extend(handle_next_feed(user))
+            continue
+
         if parsed["type"] == "query_awake":
             replies.extend(handle_query_awake(user))
             continue
@@ -1040,7 +2392,7 @@ def whatsapp_webhook():
             continue
 
         if parsed["type"] == "pump":
-            replies.extend(handle_pump(user, parsed.get("amount")))
+            replies.extend(handle_pump(user, parsed.get("amount"), parsed.get("location")))
             user = get_user_by_any(uid)
             continue
 
@@ -1095,6 +2447,11 @@ def whatsapp_webhook():
             replies.append("לא בטוחה שהבנתי… 🧐\nנסי: 'סטטוס', 'עזרה', 'בקבוק 120', 'ימין', 'השוואה'")
             continue
 
+    g.action = None
+
+    if overflow:
+        replies.append(lines_overflow_text(MAX_LINES_PER_MESSAGE))
+
     # milestone check after processing all lines:
     # Only after logging actions (events count changes). If user only asked status/help, no harm.
     user = get_user_by_any(uid)
@@ -1108,9 +2465,246 @@ def whatsapp_webhook():
 
     return str(resp)
 
+startup_mark("routes")
+
 # ====================================================
-# 12) Run on Render
+# 13) Dashboard API (read-only JSON)
+#   Authorization: Bearer <token>   (token: `python manage.py api-token <phone>`)
+#   GET /api/v1/events?from=&to=&cursor=&limit=   events in [from, to), oldest first
+#   GET /api/v1/days?from=YYYY-MM-DD&to=YYYY-MM-DD  summarize_day() per day
+#   GET /api/v1/timers                             running sleep / breastfeeding timers
+# Every response carries an ETag built from the user's version counter;
+# If-None-Match answers 304 from a stat() of the shard while nothing changed.
 # ====================================================
+API_SECRET = os.environ.get("API_SECRET", "")   # unset = API off
+API_PAGE_DEFAULT = 100
+API_PAGE_MAX = 1000
+API_MAX_DAYS = 92
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+@app.errorhandler(ApiError)
+def api_error(e):
+    return {"error": e.message}, e.status
+
+def api_token(uid: str) -> str:
+    sig = hmac.new(API_SECRET.encode(), uid.encode(), hashlib.sha256).hexdigest()[:32]
+    return f"{uid}.{sig}"
+
+def api_user_id() -> str:
+    if not API_SECRET:
+        raise ApiError(503, "API disabled (API_SECRET is not set)")
+    auth = request.headers.get("Authorization", "")
+    token = auth[len("Bearer "):].strip() if auth.startswith("Bearer ") else ""
+    uid = token.partition(".")[0]
+    if not uid or not hmac.compare_digest(token, api_token(uid)):
+        raise ApiError(401, "bad or missing token")
+    return uid
+
+def api_time_arg(name: str, default: float) -> float:
+    """Unix seconds, 'YYYY-MM-DD' (midnight) or 'YYYY-MM-DD HH:MM:SS', local to the user's zone."""
+    raw = (request.args.get(name) or "").strip()
+    if not raw:
+        return default
+    if re.fullmatch(r"\d+(\.\d+)?", raw):
+        return float(raw)
+    ts = parse_local_ts(raw.replace("T", " "))
+    if ts:
+        return ts.timestamp()
+    try:
+        return local_midnight(dt.date.fromisoformat(raw)).timestamp()
+    except ValueError:
+        raise ApiError(400, f"bad '{name}'")
+
+def api_date_arg(name: str, default: dt.date) -> dt.date:
+    raw = (request.args.get(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        return dt.date.fromisoformat(raw)
+    except ValueError:
+        raise ApiError(400, f"bad '{name}' (YYYY-MM-DD)")
+
+def encode_cursor(key) -> str:
+    return base64.urlsafe_b64encode(f"{key[0]!r}:{key[1]}".encode()).decode().rstrip("=")
+
+def decode_cursor(raw: str):
+    try:
+        ep, seq = base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4)).decode().split(":")
+        return (float(ep), int(seq))
+    except Exception:
+        raise ApiError(400, "bad cursor")
+
+def api_etag(uid: str, params) -> str:
+    version = get_store().version(uid)
+    if version is None:
+        raise ApiError(404, "unknown user")
+    return f"{version}-{zlib.crc32(repr(params).encode()):08x}"
+
+def api_not_modified(etag: str):
+    """304 response if the client already has this version, else None."""
+    if request.if_none_match.contains(etag):
+        metric_inc("api_not_modified")
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        return resp
+    return None
+
+def api_load_user(uid: str):
+    user = get_store().get(uid)
+    if not user:
+        raise ApiError(404, "unknown user")
+    return user
+
+_api_zone_cache = OrderedDict()  # uid -> (version, zone name)
+
+def api_use_zone(uid: str):
+    """
+    The user's zone for parsing dates and picking "today", before the ETag
+    check: the doc is only loaded when its version moved since the last time.
+    """
+    version = get_store().version(uid)
+    if version is None:
+        raise ApiError(404, "unknown user")
+    with _user_index_lock:
+        hit = _api_zone_cache.get(uid)
+    if hit and hit[0] == version:
+        name = hit[1]
+    else:
+        name = user_tz_name(api_load_user(uid))
+        with _user_index_lock:
+            _api_zone_cache[uid] = (version, name)
+            _api_zone_cache.move_to_end(uid)
+            while len(_api_zone_cache) > USER_INDEX_CACHE_SIZE:
+                _api_zone_cache.popitem(last=False)
+    g.tz = get_zone(name)
+
+def api_response(body, etag: str, mimetype: str = "application/json"):
+    resp = app.response_class(body, mimetype=mimetype)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+def api_event(key, e):
+    return {"seq": key[1], "epoch": key[0], "type": e.get("type"),
+            "timestamp": e.get("timestamp"), "details": e.get("details") or {}}
+
+@app.route("/api/v1/events", methods=["GET"])
+def api_events():
+    metric_inc("api_requests")
+    uid = api_user_id()
+    api_use_zone(uid)
+    t1 = api_time_arg("from", 0)
+    t2 = api_time_arg("to", float("inf"))  # open-ended, so a polling URL stays the same URL (and ETag)
+    after = decode_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+    limit = max(1, min(to_int(request.args.get("limit", API_PAGE_DEFAULT)) or API_PAGE_DEFAULT, API_PAGE_MAX))
+
+    etag = api_etag(uid, ("events", t1, t2, after, limit))
+    cached = api_not_modified(etag)
+    if cached:
+        return cached
+
+    # one extra row tells whether there is a next page
+    rows = user_index(api_load_user(uid)).between(t1, t2, after=after, limit=limit + 1)
+    next_cursor = encode_cursor(rows[limit - 1][0]) if len(rows) > limit else None
+    rows = rows[:limit]
+
+    def stream():
+        yield '{"events":['
+        for i, (key, e) in enumerate(rows):
+            yield ("," if i else "") + json.dumps(api_event(key, e), ensure_ascii=False)
+        yield '],"next_cursor":' + json.dumps(next_cursor) + "}"
+
+    return api_response(stream_with_context(stream()), etag)
+
+@app.route("/api/v1/days", methods=["GET"])
+def api_days():
+    metric_inc("api_requests")
+    uid = api_user_id()
+    api_use_zone(uid)
+    today = now_local().date()
+    last = api_date_arg("to", today)
+    first = api_date_arg("from", last - timedelta(days=6))
+    if first > last:
+        raise ApiError(400, "'from' is after 'to'")
+    if (last - first).days >= API_MAX_DAYS:
+        raise ApiError(400, f"at most {API_MAX_DAYS} days per request")
+
+    etag = api_etag(uid, ("days", first, last))
+    cached = api_not_modified(etag)
+    if cached:
+        return cached
+
+    user = api_load_user(uid)
+    days = []
+    d = first
+    while d <= last:
+        days.append({"date": d.isoformat(), **summarize_day(user, d)})
+        d += timedelta(days=1)
+    return api_response(json.dumps({"days": days}, ensure_ascii=False), etag)
+
+@app.route("/api/v1/timers", methods=["GET"])
+def api_timers():
+    metric_inc("api_requests")
+    uid = api_user_id()
+    etag = api_etag(uid, ("timers",))
+    cached = api_not_modified(etag)
+    if cached:
+        return cached
+
+    user = api_load_user(uid)
+    sleep = None
+    if user.get(KEY_SLEEP_START):
+        try:
+            start = dt.datetime.fromisoformat(user[KEY_SLEEP_START])
+            sleep = {"start_ts": start.strftime(TS_FMT), "start_epoch": int(start.timestamp())}
+        except (TypeError, ValueError):
+            pass
+    bf = None
+    running = user.get(KEY_BF_TIMER) or {}
+    if running.get("start_ts"):
+        start_epoch = running.get("start_epoch")
+        if start_epoch is None:
+            start_epoch = parsed_epoch(running["start_ts"], user_tz(user))
+        bf = {"side": running.get("side"), "start_ts": running["start_ts"],
+              "start_epoch": int(start_epoch) if start_epoch is not None else None}
+    # start times only (no "elapsed"), so the body - and the ETag - only change on writes
+    return api_response(json.dumps({"sleep": sleep, "breastfeeding": bf}, ensure_ascii=False), etag)
+
+startup_mark("dashboard api")
+
+if STORE_WARMUP:
+    threading.Thread(target=get_store, name="store-warmup", daemon=True).start()
+
+# ====================================================
+# 14) Run on Render
+# ====================================================
+def print_startup_report():
+    """Import/init breakdown plus one real first request (a 'reset' from a probe number, in STARTUP_REPORT_DIR)."""
+    import_ms = (time.perf_counter() - STARTUP_T0) * 1000
+    client = app.test_client()
+    t0 = time.perf_counter()
+    r = client.post("/sms", data={"Body": "אפס", "From": "whatsapp:+0000000000"})
+    first_ms = (time.perf_counter() - t0) * 1000
+
+    print(f"{'phase':<42}{'ms':>10}")
+    for phase, ms in STARTUP_PHASES:
+        print(f"{phase:<42}{ms:>10.1f}")
+    print("-" * 52)
+    print(f"{'module import total':<42}{import_ms:>10.1f}")
+    print(f"{'first /sms request (status ' + str(r.status_code) + ')':<42}{first_ms:>10.1f}")
+    print(f"{'time to first response':<42}{import_ms + first_ms:>10.1f}")
+    print(f"(store warm-up thread: {'on' if STORE_WARMUP else 'off'}; probe store in {STARTUP_REPORT_DIR}, removed)")
+    import shutil
+    shutil.rmtree(STARTUP_REPORT_DIR, ignore_errors=True)
+
 if __name__ == "__main__":
+    if "--startup-report" in sys.argv:
+        print_startup_report()
+        sys.exit(0)
     port = int(os.environ.get("PORT", "5000"))
     app.run(host="0.0.0.0", port=port)
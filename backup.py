@@ -0,0 +1,230 @@
+"""
+Online backups of the user store.
+
+    python manage.py backup                      # full the first time, incremental after that
+    python manage.py backup --full
+    python manage.py restore --to restored.json  # latest state in BACKUP_DIR
+    python manage.py restore --upto 000004-incr-20261019T101500
+
+A backup reads a point-in-time view of every shard (ShardedStore.open_files:
+the locks are held only while the files are opened, never while they are
+parsed or compressed), so the bot keeps serving while it runs.
+
+Files in the backup dir:
+    000001-full-<utc>.jsonl.gz     header line, then {"uid", "doc"} per user
+    000002-incr-<utc>.jsonl.gz     {"uid", "doc"} | {"uid", "ops": [...]} | {"uid", "removed": true}
+    <name>.sha256                  `sha256sum -c` format
+    manifest.json                  the backups in order + the version of every user at the last one
+
+An incremental only carries users whose version moved since the previous
+backup. When the journal still holds every op since then, only those ops
+(the new events, not the whole history) are stored; otherwise the whole doc.
+Restore checks every checksum first, then replays the last full backup and
+the incrementals after it and writes each shard file once.
+"""
+import os
+import json
+import gzip
+import time
+import hashlib
+
+from journal import Journal, apply_op
+from storage import AtomicJSONStorage, ConsistentHashRing, FileLock, to_version
+
+MANIFEST = "manifest.json"
+COMPRESS_LEVEL = 6
+
+def backup_dir_for(shard_paths) -> str:
+    return os.environ.get("BACKUP_DIR") or os.path.join(os.path.dirname(os.path.abspath(shard_paths[0])), "backups")
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def load_manifest(backup_dir: str):
+    try:
+        with open(os.path.join(backup_dir, MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"backups": [], "versions": {}}
+
+def write_json_atomic(path: str, data):
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def shard_states(shard_file, journal_file, journal_length: int, version_field: str, undo_field: str):
+    """Current docs of one opened shard: its snapshots + the journal up to journal_length."""
+    raw = shard_file.read()
+    table = (json.loads(raw) if raw.strip() else {}).get("_default", {})
+    journal = Journal(shard_file.name + ".journal")
+    if journal_file:
+        journal.feed(journal_file.read(journal_length))
+    states = {}
+    for doc in table.values():
+        uid = doc.get("id")
+        if not uid:
+            continue
+        ops = journal.ops_for(uid, to_version(doc.get(version_field)))
+        for op in ops:
+            apply_op(doc, op, version_field, undo_field)
+        states[uid] = (doc, ops)
+    return states
+
+def take_backup(store, backup_dir: str, full: bool = False, log=print):
+    """
+    One backup of `store` into backup_dir (full if there is none yet or full=True).
+    Returns the manifest entry, with timings.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    vf, uf = store.version_field, store.undo_field
+    with FileLock(os.path.join(backup_dir, "backup.lock")):
+        manifest = load_manifest(backup_dir)
+        full = full or not manifest["backups"]
+        prev = {} if full else manifest["versions"]
+        seq = (manifest["backups"][-1]["seq"] + 1) if manifest["backups"] else 1
+        name = f"{seq:06d}-{'full' if full else 'incr'}-{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}"
+        path = os.path.join(backup_dir, name + ".jsonl.gz")
+        tmp = path + ".tmp"
+
+        t0 = time.perf_counter()
+        files, held_ms = store.open_files()
+        versions = {}
+        counts = {"docs": 0, "ops": 0, "removed": 0}
+        raw_bytes = 0
+        try:
+            with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=COMPRESS_LEVEL) as out:
+                header = {"backup": name, "kind": "full" if full else "incr",
+                          "base": manifest["backups"][-1]["name"] if manifest["backups"] and not full else None,
+                          "created": time.time(), "version_field": vf, "undo_field": uf,
+                          "partner_field": store.partner_field}
+                out.write(json.dumps(header, ensure_ascii=False) + "\n")
+                for _, shard_file, journal_file, length in files:
+                    states = shard_states(shard_file, journal_file, length, vf, uf)
+                    for uid, (doc, ops) in states.items():
+                        v = to_version(doc.get(vf))
+                        # mid-rebalance a doc can be in both layouts: the newer copy wins (as a whole doc)
+                        seen = uid in versions
+                        if seen and versions[uid] >= v:
+                            continue
+                        versions[uid] = v
+                        if not seen and prev.get(uid) == v:
+                            continue
+                        since = [op for op in ops if op["v"] > prev.get(uid, v)]
+                        if not seen and uid in prev and [op["v"] for op in since] == list(range(prev[uid] + 1, v + 1)):
+                            record = {"uid": uid, "ops": since}
+                            counts["ops"] += len(since)
+                        else:
+                            record = {"uid": uid, "doc": doc}
+                            counts["docs"] += 1
+                        line = json.dumps(record, ensure_ascii=False) + "\n"
+                        raw_bytes += len(line.encode("utf-8"))
+                        out.write(line)
+                for uid in prev.keys() - versions.keys():
+                    out.write(json.dumps({"uid": uid, "removed": True}) + "\n")
+                    counts["removed"] += 1
+            with open(tmp, "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        finally:
+            for _, shard_file, journal_file, _ in files:
+                shard_file.close()
+                if journal_file:
+                    journal_file.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        digest = sha256_file(path)
+        with open(path[:-len(".jsonl.gz")] + ".sha256", "w") as f:
+            f.write(f"{digest}  {os.path.basename(path)}\n")
+        seconds = time.perf_counter() - t0
+        entry = {
+            "seq": seq, "name": name, "kind": header["kind"], "base": header["base"],
+            "created": header["created"], "users": len(versions), **counts,
+            "raw_bytes": raw_bytes, "bytes": os.path.getsize(path), "sha256": digest,
+            "seconds": round(seconds, 3), "locks_held_ms": round(held_ms, 2),
+        }
+        manifest["backups"].append(entry)
+        manifest["versions"] = versions
+        write_json_atomic(os.path.join(backup_dir, MANIFEST), manifest)
+    log(f"{name}: {len(versions)} users, {counts['docs']} docs + {counts['ops']} ops + {counts['removed']} removed, "
+        f"{raw_bytes / 1e6:.2f} MB -> {entry['bytes'] / 1e6:.2f} MB gz in {seconds:.2f}s "
+        f"({raw_bytes / 1e6 / max(seconds, 1e-9):.1f} MB/s), shard locks held {held_ms:.1f} ms")
+    return entry
+
+def restore_chain(manifest, upto=None):
+    """The manifest entries to replay for `upto` (default: the latest): its full backup and the incrementals after it."""
+    backups = manifest["backups"]
+    if upto:
+        names = [b["name"] for b in backups]
+        if upto not in names:
+            raise ValueError(f"no backup named {upto}")
+        backups = backups[:names.index(upto) + 1]
+    fulls = [i for i, b in enumerate(backups) if b["kind"] == "full"]
+    if not fulls:
+        raise ValueError("no full backup to start from")
+    return backups[fulls[-1]:]
+
+def read_backups(backup_dir: str, chain):
+    """Verify every file of the chain, then replay it -> ({uid: doc}, header of the last file)."""
+    for entry in chain:
+        path = os.path.join(backup_dir, entry["name"] + ".jsonl.gz")
+        if sha256_file(path) != entry["sha256"]:
+            raise ValueError(f"checksum mismatch: {path}")
+    docs, header = {}, None
+    for entry in chain:
+        with gzip.open(os.path.join(backup_dir, entry["name"] + ".jsonl.gz"), "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            vf, uf = header["version_field"], header["undo_field"]
+            for line in f:
+                rec = json.loads(line)
+                uid = rec["uid"]
+                if rec.get("removed"):
+                    docs.pop(uid, None)
+                elif "doc" in rec:
+                    docs[uid] = rec["doc"]
+                else:
+                    doc = docs[uid]
+                    for op in rec["ops"]:
+                        apply_op(doc, op, vf, uf)
+    return docs, header
+
+def restore(backup_dir: str, shard_paths, directory_path: str, upto=None, force: bool = False, log=print):
+    """
+    Write the state of a backup as a fresh store: one snapshot write per shard,
+    no journals, directory rebuilt from the docs (indexes on first use). The bot must be stopped.
+    """
+    targets = list(shard_paths) + [directory_path]
+    existing = [p for p in targets if os.path.exists(p) and os.path.getsize(p)]
+    if existing and not force:
+        raise ValueError(f"refusing to overwrite {', '.join(existing)} (use --force)")
+
+    t0 = time.perf_counter()
+    chain = restore_chain(load_manifest(backup_dir), upto)
+    docs, header = read_backups(backup_dir, chain)
+    t_read = time.perf_counter() - t0
+
+    ring = ConsistentHashRing(shard_paths)
+    tables = {p: {} for p in shard_paths}
+    for uid, doc in docs.items():
+        table = tables[ring.node_for(uid)]
+        table[str(len(table) + 1)] = doc
+    for path, table in tables.items():
+        AtomicJSONStorage(path).write({"_default": table})
+        for stale in (path + ".journal", path + ".index"):
+            if os.path.exists(stale):
+                os.remove(stale)
+    pf = header["partner_field"]
+    entries = [{"phone": d[pf], "owner": uid} for uid, d in docs.items() if d.get(pf)]
+    AtomicJSONStorage(directory_path).write({"_default": {str(i + 1): e for i, e in enumerate(entries)}})
+
+    seconds = time.perf_counter() - t0
+    log(f"restored {len(docs)} users from {len(chain)} backups ({chain[0]['name']} .. {chain[-1]['name']}) "
+        f"into {len(shard_paths)} shards in {seconds:.2f}s (read + verify {t_read:.2f}s)")
+    return docs
@@ -0,0 +1,291 @@
+"""
+Micro-benchmarks for the bot's hot paths.
+
+    python bench.py status          # status/query latency on a year-long history
+    python bench.py shards          # write throughput vs shard count (N writer processes)
+    python bench.py cohort          # cohort analytics over ~1M events
+    python bench.py fuzzy           # unknown-intent rate with/without typo correction
+
+Runs against throwaway TinyDB files; never touches users_data.json.
+"""
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+import datetime as dt
+
+BENCH_DIR = tempfile.mkdtemp(prefix="bili-bench-")
+os.environ["TINYDB_PATH"] = os.path.join(BENCH_DIR, "users.json")
+os.environ.pop("TINYDB_SHARDS", None)
+os.environ.pop("TINYDB_DIRECTORY_PATH", None)
+os.environ.setdefault("RATE_LIMIT_BURST", "1000000")
+
+import app as bot  # noqa: E402
+from storage import ShardedStore, ConsistentHashRing  # noqa: E402
+
+BENCH_PHONE = "972500000001"
+
+def synthetic_history(days: int, seed: int = 7):
+    """~20 events/day: feeds, diapers, pumps and overnight + daytime sleeps."""
+    rng = random.Random(seed)
+    today = bot.now_local().date()
+    events = []
+
+    def ev(kind, when, details):
+        events.append({
+            "type": kind,
+            "timestamp": when.strftime(bot.TS_FMT),
+            "epoch": int(when.timestamp()),
+            "details": details,
+        })
+
+    for d in range(days, 0, -1):
+        day = today - dt.timedelta(days=d)
+        base = bot.local_midnight(day)
+        for h in range(0, 24, 3):
+            t = base + dt.timedelta(hours=h, minutes=rng.randint(0, 50))
+            if rng.random() < 0.5:
+                ev("bottle", t, {"amount": rng.choice([60, 90, 120, 150])})
+            else:
+                ev("breastfeeding", t, {"side": rng.choice(["ימין", "שמאל"]), "duration": rng.randint(5, 25)})
+        for h in (1, 5, 9, 12, 15, 18, 21):
+            ev("diaper", base + dt.timedelta(hours=h, minutes=rng.randint(0, 59)), {"type": rng.choice(["פיפי", "קקי"])})
+        for h in (10, 16):
+            ev("pump", base + dt.timedelta(hours=h, minutes=rng.randint(0, 59)), {"amount": rng.randint(60, 200)})
+        for start_h, length in ((21, 9 * 60), (13, 90)):
+            s = base + dt.timedelta(hours=start_h, minutes=rng.randint(0, 40))
+            e = s + dt.timedelta(minutes=length + rng.randint(-30, 30))
+            ev("sleep", e, {
+                "duration_min": int((e - s).total_seconds() // 60),
+                "start_ts": s.strftime(bot.TS_FMT),
+                "end_ts": e.strftime(bot.TS_FMT),
+            })
+    events.sort(key=lambda x: x["timestamp"])
+    return events
+
+def seed_user(events):
+    user = {
+        "id": BENCH_PHONE,
+        bot.KEY_STAGE: 5,
+        bot.KEY_MOM_NAME: "בנץ'",
+        bot.KEY_BABY_SEX: "f",
+        bot.KEY_BABY_NAME: "בנצ'י",
+        bot.KEY_DOB: (bot.now_local().date() - dt.timedelta(days=400)).isoformat(),
+        bot.KEY_FEEDING_MODE: "mixed",
+        bot.KEY_EVENTS: events,
+    }
+    bot.save_user(user)
+    return bot.get_user_by_any(BENCH_PHONE)
+
+def timed(fn, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {
+        "p50": statistics.median(samples),
+        "p95": samples[int(len(samples) * 0.95) - 1],
+        "max": samples[-1],
+    }
+
+def report(rows):
+    print(f"{'case':<34}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name, r in rows:
+        print(f"{name:<34}{r['p50']:>10.3f}{r['p95']:>10.3f}{r['max']:>10.3f}")
+
+def bench_status(args):
+    events = synthetic_history(args.days)
+    user = seed_user(events)
+    print(f"history: {len(events)} events over {args.days} days\n")
+
+    client = bot.app.test_client()
+    phone = "whatsapp:+" + BENCH_PHONE
+
+    def reload():
+        return bot.get_user_by_any(BENCH_PHONE)
+
+    rows = [
+        ("get_status_text", timed(lambda: bot.get_status_text(user), args.repeat)),
+        ("get_comparison_text (7d)", timed(lambda: bot.get_comparison_text(user, 7), args.repeat)),
+        ("get_trend_text (8w)", timed(lambda: bot.get_trend_text(user, 8), args.repeat)),
+        ("get_trend_text (26w)", timed(lambda: bot.get_trend_text(user, 26), args.repeat)),
+        ("handle_query_last (feed)", timed(lambda: bot.handle_query_last(
+            user, {"targets": ["bottle", "breastfeeding"], "label": "האכילה"}), args.repeat)),
+        ("handle_query_last (sleep start)", timed(lambda: bot.handle_query_last(
+            user, {"targets": ["sleep"], "sub": "start", "label": "השינה"}), args.repeat)),
+        ("handle_query_awake", timed(lambda: bot.handle_query_awake(user), args.repeat)),
+        ("status on freshly loaded doc", timed(lambda: bot.get_status_text(reload()), args.repeat)),
+        ("POST /sms 'סטטוס'", timed(lambda: client.post("/sms", data={"Body": "סטטוס", "From": phone}), args.repeat)),
+    ]
+    report(rows)
+
+def shard_writer(paths, directory, phones, ops, seed, start, out):
+    """One writer process: read-modify-write under the user lock, like the webhook."""
+    store = ShardedStore(paths, directory)
+    rng = random.Random(seed)
+    start.wait()
+    t0 = time.perf_counter()
+    for i in range(ops):
+        phone = rng.choice(phones)
+        with store.user_lock(phone):
+            user = store.get(phone)
+            user[bot.KEY_EVENTS].append({"type": "diaper", "timestamp": "2026-01-01 00:00:00", "details": {"i": i}})
+            store.save(user)
+    out.put(time.perf_counter() - t0)
+    store.close()
+
+def bench_shards(args):
+    history = synthetic_history(args.days)
+    rng = random.Random(11)
+    phones = [f"9725{rng.randrange(10**7, 10**8)}" for _ in range(args.users)]
+    cpus = os.cpu_count() or 1
+    print(f"{args.users} users x {len(history)} events, {args.writers} writer processes x {args.ops} "
+          f"read-modify-write ops per run, {cpus} CPUs\n")
+    print(f"{'shards':>6}{'ops/s':>10}{'speedup':>10}")
+
+    ctx = multiprocessing.get_context("fork")
+    base = None
+    for n in args.counts:
+        run_dir = tempfile.mkdtemp(dir=BENCH_DIR)
+        paths = [os.path.join(run_dir, f"shard{i}.json") for i in range(n)]
+        directory = os.path.join(run_dir, "directory.json")
+        store = ShardedStore(paths, directory)
+        for phone in phones:
+            store.save({"id": phone, bot.KEY_STAGE: 5, bot.KEY_EVENTS: history})
+        store.close()
+
+        start, out = ctx.Event(), ctx.Queue()
+        procs = [ctx.Process(target=shard_writer, args=(paths, directory, phones, args.ops, 100 * n + w, start, out))
+                 for w in range(args.writers)]
+        for p in procs:
+            p.start()
+        t0 = time.perf_counter()
+        start.set()
+        for _ in procs:
+            out.get()
+        wall = time.perf_counter() - t0
+        for p in procs:
+            p.join()
+        rate = args.writers * args.ops / wall
+        base = base or rate
+        store = ShardedStore(paths, directory)
+        written = sum(len(store.get(phone)[bot.KEY_EVENTS]) - len(history) for phone in phones)
+        store.close()
+        lost = args.writers * args.ops - written
+        print(f"{n:>6}{rate:>10.1f}{rate / base:>10.2f}" + (f"  LOST {lost} writes" if lost else ""))
+    if cpus < args.writers:
+        print(f"\nnote: {args.writers} writers on {cpus} CPUs: the writers mostly take turns on the CPU, "
+              "so the speed-up shows less lock contention and smaller files, not parallel writes")
+
+def bench_cohort(args):
+    import analytics
+
+    history = synthetic_history(args.days)
+    rng = random.Random(13)
+    today = bot.now_local().date()
+    modes = ["breast", "bottle", "mixed", "pumping"]
+    paths = [os.path.join(BENCH_DIR, f"cohort{i}.json") for i in range(args.shards)]
+    ring = ConsistentHashRing(paths)
+    tables = {p: {} for p in paths}
+    for n in range(args.users):
+        phone = f"9725{rng.randrange(10**7, 10**8)}"
+        # history runs from `days` ago; babies born 0-60 days before it starts
+        dob = today - dt.timedelta(days=args.days + rng.randint(0, 60))
+        table = tables[ring.node_for(phone)]
+        table[str(len(table) + 1)] = {
+            "id": phone, bot.KEY_STAGE: 5, bot.KEY_DOB: dob.isoformat(),
+            bot.KEY_FEEDING_MODE: rng.choice(modes), bot.KEY_EVENTS: history,
+        }
+    for p, table in tables.items():
+        with open(p, "w", encoding="utf-8") as f:
+            json.dump({"_default": table}, f, ensure_ascii=False)
+    tables = None
+    total = args.users * len(history)
+    print(f"{args.users} users x {len(history)} events = {total} events in {args.shards} shards\n")
+    print(f"{'workers':>7}{'seconds':>10}{'events/s':>12}")
+
+    for w in args.workers:
+        t0 = time.perf_counter()
+        rows = analytics.cohort_rows(analytics.collect(paths, workers=w))
+        took = time.perf_counter() - t0
+        print(f"{w:>7}{took:>10.2f}{total / took:>12.0f}")
+    print(f"\n{len(rows)} output rows")
+
+def bench_fuzzy(args):
+    corpus = []
+    with open(args.corpus, encoding="utf-8") as f:
+        for line in f:
+            if line.strip() and not line.startswith("#"):
+                expected, msg = line.rstrip("\n").split("\t", 1)
+                corpus.append((expected, msg))
+    user = {"id": BENCH_PHONE}
+    exact = [bot.parse_clean(bot.clean_msg(msg), user)["type"] for _, msg in corpus]
+    fuzzy = [bot.parse_single(msg, user)["type"] for _, msg in corpus]
+
+    def unknown_rate(types):
+        return 100 * sum(t == "unknown" for t in types) / len(types)
+
+    print(f"{len(corpus)} lines from {args.corpus}\n")
+    print(f"{'parser':<22}{'unknown %':>10}{'as expected':>13}")
+    for name, types in (("exact keywords", exact), ("+ FUZZY_INDEX", fuzzy)):
+        right = sum(t == e for t, (e, _) in zip(types, corpus))
+        print(f"{name:<22}{unknown_rate(types):>10.1f}{right:>9}/{len(corpus)}")
+
+    tokens = [tok for _, msg in corpus for tok in bot.clean_msg(msg).split()]
+    lookups = timed(lambda: [bot.FUZZY_INDEX.lookup(tok) for tok in tokens], args.repeat)
+    print(f"\nlookup p50 {lookups['p50'] * 1000 / len(tokens):.1f} us per token")
+
+    missed = [(e, msg) for t, (e, msg) in zip(fuzzy, corpus) if t == "unknown" and e != "unknown"]
+    wrong = [(e, t, msg) for t, (e, msg) in zip(fuzzy, corpus) if t not in ("unknown", e)]
+    for e, msg in missed:
+        print(f"missed: {msg!r} (expected {e})")
+    for e, t, msg in wrong:
+        print(f"WRONG:  {msg!r} parsed as {t}, expected {e}")
+    # a wrong guess is worse than an unknown: fail the run
+    return 1 if wrong else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("status", help="status/query latency on a long history")
+    p.add_argument("--days", type=int, default=365)
+    p.add_argument("--repeat", type=int, default=50)
+    p.set_defaults(func=bench_status)
+
+    p = sub.add_parser("shards", help="read-modify-write throughput vs shard count")
+    p.add_argument("--users", type=int, default=64)
+    p.add_argument("--days", type=int, default=30)
+    p.add_argument("--ops", type=int, default=50, help="ops per writer process")
+    p.add_argument("--writers", type=int, default=8, help="concurrent writer processes")
+    p.add_argument("--counts", type=lambda s: [int(x) for x in s.split(",")], default=[1, 2, 4, 8])
+    p.set_defaults(func=bench_shards)
+
+    p = sub.add_parser("cohort", help="cohort analytics throughput vs worker count")
+    p.add_argument("--users", type=int, default=400)
+    p.add_argument("--days", type=int, default=125)
+    p.add_argument("--shards", type=int, default=8)
+    p.add_argument("--workers", type=lambda s: [int(x) for x in s.split(",")], default=[1, 2, 4, 8])
+    p.set_defaults(func=bench_cohort)
+
+    p = sub.add_parser("fuzzy", help="unknown-intent rate on a test corpus, with and without typo correction")
+    p.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "intent_corpus.tsv"))
+    p.add_argument("--repeat", type=int, default=50)
+    p.set_defaults(func=bench_fuzzy)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Growth percentiles from the WHO Child Growth Standards (LMS method).
+
+data/who_lms.csv holds the published WHO L, M, S parameters, weekly for the
+first 13 weeks and monthly after that: weight-for-age up to 5 years and
+recumbent length-for-age up to 2 years. On first use each indicator is
+expanded once into a float array indexed [sex, age in days] (linear
+between the published ages), so a lookup is an array index plus a few
+multiplications; the CSV is never read per request.
+
+    z = ((x / M) ** L - 1) / (L * S)
+
+Beyond +-3 SD, z is extended linearly from the 2-3 SD distance, as in the
+WHO's restricted application of the LMS method (this only matters when L != 1).
+"""
+import os
+import csv
+import threading
+
+import numpy as np
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "who_lms.csv")
+
+WEIGHT = "wfa"   # weight-for-age, kg
+LENGTH = "lhfa"  # length-for-age, cm
+SEXES = {"m": 0, "f": 1}
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+def _load_knots(path: str = DATA_PATH):
+    knots = {}
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            key = (row["indicator"], SEXES[row["sex"]])
+            knots.setdefault(key, []).append(
+                (float(row["age_days"]), float(row["L"]), float(row["M"]), float(row["S"])))
+    return knots
+
+def lms_table(indicator: str) -> np.ndarray:
+    """float64 array [sex, age_days, (L, M, S)] for one indicator, built once per process."""
+    table = _tables.get(indicator)
+    if table is None:
+        with _tables_lock:
+            table = _tables.get(indicator)
+            if table is None:
+                knots = _load_knots()
+                rows = {sex: sorted(k) for (ind, sex), k in knots.items() if ind == indicator}
+                if not rows:
+                    raise KeyError(indicator)
+                days = int(min(r[-1][0] for r in rows.values())) + 1
+                ages = np.arange(days, dtype=np.float64)
+                table = np.zeros((len(SEXES), days, 3))
+                for sex, k in rows.items():
+                    k = np.array(k)
+                    for j in range(3):
+                        table[sex, :, j] = np.interp(ages, k[:, 0], k[:, j + 1])
+                _tables[indicator] = table
+    return table
+
+def max_age_days(indicator: str) -> int:
+    return lms_table(indicator).shape[1] - 1
+
+def z_scores(indicator: str, sex: str, age_days, values):
+    """Vectorized z-scores; NaN where the age is out of the table's range or the value is not positive."""
+    table = lms_table(indicator)
+    age = np.asarray(age_days, dtype=np.int64)
+    x = np.asarray(values, dtype=np.float64)
+    ok = (age >= 0) & (age < table.shape[1]) & (x > 0)
+    lms = table[SEXES[sex], np.clip(age, 0, table.shape[1] - 1)]
+    L, M, S = lms[..., 0], lms[..., 1], lms[..., 2]
+    xs = np.where(ok, x, M)
+
+    z = ((xs / M) ** L - 1) / (L * S)
+
+    def sd(k):
+        return M * (1 + L * S * k) ** (1 / L)
+
+    sd3, sd2, sd2n, sd3n = sd(3), sd(2), sd(-2), sd(-3)
+    z = np.where(z > 3, 3 + (xs - sd3) / (sd3 - sd2), z)
+    z = np.where(z < -3, -3 + (xs - sd3n) / (sd2n - sd3n), z)
+    return np.where(ok, z, np.nan)
+
+def _erf(x):
+    # Abramowitz & Stegun 7.1.26 (|error| < 1.5e-7), vectorized
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1 / (1 + 0.3275911 * x)
+    y = 1 - (((((1.061405429 * t - 1.453152027) * t) + 1.421413741) * t - 0.284496736) * t + 0.254829592) * t * np.exp(-x * x)
+    return sign * y
+
+def percentiles(z):
+    """z-scores -> percentiles 0-100 (NaN stays NaN)."""
+    z = np.asarray(z, dtype=np.float64)
+    return 50 * (1 + _erf(z / np.sqrt(2)))
+
+def percentile(indicator: str, sex: str, age_days: int, value: float):
+    """One measurement -> percentile, or None when it cannot be placed."""
+    p = float(percentiles(z_scores(indicator, sex, [age_days], [value]))[0])
+    return None if np.isnan(p) else p
@@ -0,0 +1,200 @@
+"""
+Help articles behind an inverted keyword index.
+
+Every article is a text file in data/help/: a few header lines, a "---"
+line, then the body, which is sent as is:
+
+    title: טיפול בחלב אם (שאוב)
+    menu: 1
+    keywords: חלב, טיפול, אחסון, שאוב, שאיבה, הקפאה, מקרר
+    ---
+    כמה דברים חשובים על אחסון וטיפול בחלב אם 🍼
+    ...
+
+"menu" is optional: articles that have one are listed in the help menu and
+answer to that number.
+
+index.json (`python manage.py help-index`) is built from the headers only:
+titles, menu numbers, where each body starts, and the postings
+token -> [[article, weight], ...], where weight is the token's idf over the
+articles divided by sqrt(number of keyword tokens of the article). Loading
+it parses no article. A message is scored by walking the postings of its
+own tokens only, so matching costs about the same with 5 articles or 500.
+A body is read (one seek) the first time its article is answered, and the
+rendered answers stay in an LRU cache.
+
+index.json is committed next to the articles and records the sha256 of
+each one, so a fresh checkout or deploy uses it as is (file times don't
+matter). When an article was added, removed or edited without running
+help-index, the index is rebuilt in memory on load, with a warning; it is
+never written from the app. `manage.py help-index --check` (and the tests)
+fail while the committed index is stale.
+"""
+import os
+import re
+import json
+import sys
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+
+INDEX_NAME = "index.json"
+INDEX_FORMAT = 2
+ARTICLE_SUFFIX = ".txt"
+HEADER_END = "---"
+ANSWER_CACHE_SIZE = 256
+
+# one-letter Hebrew prefixes (ו ה ב ל מ ש כ): "במקרר" also matches the keyword "מקרר"
+PREFIXES = "והבלמשכ"
+MAX_PREFIXES = 2
+MIN_STEM_LEN = 2
+
+def tokens(text: str):
+    text = re.sub(r"[^\w\s\u0590-\u05FF]", " ", text.lower())
+    return text.split()
+
+def parse_header(f):
+    """Header fields of an open article file (binary), leaving it at the start of the body."""
+    fields = {}
+    for raw in f:
+        line = raw.decode("utf-8").strip()
+        if line == HEADER_END:
+            return fields, f.tell()
+        key, sep, value = line.partition(":")
+        if sep:
+            fields[key.strip().lower()] = value.strip()
+    raise ValueError(f"{f.name}: no '{HEADER_END}' line after the header")
+
+def scan_sources(path: str) -> dict:
+    """{file name: sha256} of the article files, by name."""
+    sources = {}
+    with os.scandir(path) as it:
+        names = sorted(entry.name for entry in it if entry.name.endswith(ARTICLE_SUFFIX) and entry.is_file())
+    for name in names:
+        with open(os.path.join(path, name), "rb") as f:
+            sources[name] = hashlib.sha256(f.read()).hexdigest()
+    return sources
+
+def read_index(path: str):
+    """The index in `path` while it matches the articles, else None."""
+    try:
+        with open(os.path.join(path, INDEX_NAME), encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get("format") != INDEX_FORMAT or index.get("sources") != scan_sources(path):
+        return None
+    return index
+
+def build_index(path: str) -> dict:
+    sources = scan_sources(path)
+    articles, article_tokens = {}, {}
+    for name in sorted(sources):
+        with open(os.path.join(path, name), "rb") as f:
+            fields, offset = parse_header(f)
+        aid = name[:-len(ARTICLE_SUFFIX)]
+        articles[aid] = {"file": name, "offset": offset, "title": fields.get("title", aid),
+                         "menu": fields.get("menu") or None}
+        toks = []
+        for kw in fields.get("keywords", "").split(","):
+            toks.extend(t for t in tokens(kw) if t not in toks)
+        article_tokens[aid] = toks
+
+    df = {}
+    for toks in article_tokens.values():
+        for t in toks:
+            df[t] = df.get(t, 0) + 1
+    n = max(len(articles), 1)
+    postings = {}
+    for aid, toks in article_tokens.items():
+        norm = math.sqrt(len(toks)) or 1.0
+        for t in toks:
+            postings.setdefault(t, []).append([aid, round(math.log(1 + n / df[t]) / norm, 6)])
+
+    # menu articles first (by number), then by name: the tie-break order of match()
+    order = sorted(articles, key=lambda a: (articles[a]["menu"] is None, int(articles[a]["menu"] or 0), a))
+    for rank, aid in enumerate(order):
+        articles[aid]["rank"] = rank
+    return {"format": INDEX_FORMAT, "sources": sources, "articles": articles, "postings": postings}
+
+def write_index(path: str, index: dict) -> str:
+    out = os.path.join(path, INDEX_NAME)
+    tmp = f"{out}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+        f.write("\n")
+    os.replace(tmp, out)
+    return out
+
+class HelpKB:
+    def __init__(self, path: str, footer: str = "", cache_size: int = ANSWER_CACHE_SIZE):
+        self.path = path
+        self.footer = footer
+        self.cache_size = cache_size
+        self._answers = OrderedDict()  # article id -> rendered answer
+        self._lock = threading.Lock()
+        self.rebuilt = False
+        self._load()
+
+    def _load(self):
+        index = read_index(self.path)
+        if index is None:
+            index = build_index(self.path)
+            self.rebuilt = True
+            print(f"helpkb: {os.path.join(self.path, INDEX_NAME)} is missing or stale, "
+                  "rebuilt in memory (run `python manage.py help-index` and commit it)", file=sys.stderr)
+        self.articles = index["articles"]
+        self.postings = index["postings"]
+        self.menu = {a["menu"]: aid for aid, a in self.articles.items() if a["menu"]}
+
+    def vocabulary(self):
+        return list(self.postings)
+
+    def menu_entries(self):
+        """[(number, title)] in menu order."""
+        return sorted(((n, self.articles[aid]["title"]) for n, aid in self.menu.items()), key=lambda e: int(e[0]))
+
+    def _stem(self, tok: str):
+        # the word itself, else the word without up to two prefix letters
+        for i in range(MAX_PREFIXES + 1):
+            if i and (tok[i - 1] not in PREFIXES or len(tok) - i < MIN_STEM_LEN):
+                return None
+            if tok[i:] in self.postings:
+                return tok[i:]
+        return None
+
+    def match(self, msg: str, min_hits: int = 2):
+        """Best article for a message, or None when no article has min_hits of its keywords in it."""
+        hits, scores = {}, {}
+        for t in {s for s in map(self._stem, tokens(msg)) if s}:
+            for aid, w in self.postings[t]:
+                hits[aid] = hits.get(aid, 0) + 1
+                scores[aid] = scores.get(aid, 0.0) + w
+        best = [aid for aid, n in hits.items() if n >= min_hits]
+        if not best:
+            return None
+        return min(best, key=lambda a: (-scores[a], -hits[a], self.articles[a]["rank"]))
+
+    def body(self, aid: str) -> str:
+        a = self.articles[aid]
+        with open(os.path.join(self.path, a["file"]), "rb") as f:
+            f.seek(a["offset"])
+            text = f.read().decode("utf-8")
+        return text[:-1] if text.endswith("\n") else text  # the file's own last newline
+
+    def answer(self, aid: str):
+        """Body + footer, or None for an unknown article."""
+        if aid not in self.articles:
+            return None
+        with self._lock:
+            text = self._answers.get(aid)
+            if text is not None:
+                self._answers.move_to_end(aid)
+                return text
+        text = self.body(aid) + self.footer
+        with self._lock:
+            self._answers[aid] = text
+            while len(self._answers) > self.cache_size:
+                self._answers.popitem(last=False)
+        return text
@@ -0,0 +1,107 @@
+"""
+Per-shard secondary indexes.
+
+"<shard>.index" is a JSON-lines log next to the shard's journal: the store
+appends {"uid", field: value, ...} whenever one of a user's indexed values
+changes, and {"uid", "remove": true} when the user goes. The last line of a
+uid wins; compact() rewrites the file with one line per user.
+
+In memory every field is a sorted list of (value, uid) (users whose value
+is None are kept in a set), so equality and range lookups are a bisect plus
+the matches, whatever the number of users.
+
+The file only holds derived data: appends are not fsync'd, and a missing
+file is rebuilt from the shard (ShardedStore.rebuild_indexes).
+"""
+import os
+import json
+import time
+from bisect import bisect_left, insort
+
+from journal import Journal
+
+INDEX_SAVED_RESOLUTION = 3600  # "saved" is kept per hour: saves within the hour add no index line
+
+def index_entry(indexes, doc: dict) -> dict:
+    """{"uid", field: fn(doc) for each index, "saved": this hour}."""
+    entry = {"uid": doc["id"]}
+    for field, fn in indexes.items():
+        entry[field] = fn(doc)
+    now = int(time.time())
+    entry["saved"] = now - now % INDEX_SAVED_RESOLUTION
+    return entry
+
+class FieldIndex(Journal):
+    """Indexes of one shard over `fields`. Like the journal, callers hold the shard lock."""
+    fsync = False
+
+    def __init__(self, path: str, fields):
+        self.fields = tuple(fields)
+        super().__init__(path)
+
+    def _restart(self):
+        self.entries = {}                              # uid -> {"uid", field: value, ...}
+        self.sorted = {f: [] for f in self.fields}     # field -> [(value, uid), ...]
+        self.missing = {f: set() for f in self.fields}
+
+    def _index(self, entry: dict):
+        uid = entry["uid"]
+        old = self.entries.pop(uid, None)
+        if old is not None:
+            for f in self.fields:
+                v = old.get(f)
+                if v is None:
+                    self.missing[f].discard(uid)
+                    continue
+                keys = self.sorted[f]
+                i = bisect_left(keys, (v, uid))
+                if i < len(keys) and keys[i] == (v, uid):
+                    del keys[i]
+        if entry.get("remove"):
+            return
+        self.entries[uid] = entry
+        for f in self.fields:
+            v = entry.get(f)
+            if v is None:
+                self.missing[f].add(uid)
+            else:
+                insort(self.sorted[f], (v, uid))
+
+    def _span(self, field: str, lo, hi):
+        keys = self.sorted[field]
+        i = 0 if lo is None else bisect_left(keys, (lo,))
+        j = len(keys) if hi is None else bisect_left(keys, (hi,))
+        return keys, i, max(i, j)
+
+    def range(self, field: str, lo=None, hi=None):
+        """Entries with lo <= value < hi (None: unbounded), in value order."""
+        keys, i, j = self._span(field, lo, hi)
+        return [self.entries[uid] for _, uid in keys[i:j]]
+
+    def count(self, field: str, lo=None, hi=None) -> int:
+        _, i, j = self._span(field, lo, hi)
+        return j - i
+
+    def equal(self, field: str, value):
+        if value is None:
+            return [self.entries[uid] for uid in self.missing[field]]
+        keys = self.sorted[field]
+        i = j = bisect_left(keys, (value,))
+        while j < len(keys) and keys[j][0] == value:
+            j += 1
+        return [self.entries[uid] for _, uid in keys[i:j]]
+
+    def compact(self, entries=None):
+        """Rewrite the file with one line per user (the given entries, or the current ones)."""
+        if entries is None:
+            self.refresh()
+            entries = list(self.entries.values())
+        tmp = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+        self.offset, self.torn = 0, False
+        self.ino = None
+        self._restart()
+        self.refresh()
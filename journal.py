@@ -0,0 +1,240 @@
+"""
+Per-shard operation journal.
+
+Every save of a user doc is written as a small operation (what changed, and
+how to change it back) appended to "<shard>.journal". The shard itself only
+holds snapshots: a user's doc is rewritten there every SNAPSHOT_EVERY ops,
+and the whole journal is folded into the shard once it passes
+JOURNAL_MAX_BYTES. Loading a user = snapshot + replay of at most
+SNAPSHOT_EVERY ops, however long the history is.
+
+An op is one JSON line:
+    {"uid": .., "v": version, "diff": {...}}                           plain write
+    {"uid": .., "v": .., "diff": {...}, "action": {"id", "label"}, "inv": {...} | null}
+    {"uid": .., "v": .., "undo": [inverse diffs, in apply order]}
+    {"uid": .., "remove": true}
+
+A diff is {"set": {k: v}, "unset": [k], "append": {k: [items]}, "trunc": {k: n}}.
+Lists that only grew or shrank at the end are stored as append/trunc, so
+"added one event" costs one event and undoing it is a truncate.
+
+Ops that carry an action push their inverse on the doc's undo stack; ops
+of the same action (one message line can save several times) share one
+entry. An undo op pops the top entry. Replaying the journal therefore
+rebuilds the undo stack too.
+"""
+import os
+import copy
+import json
+
+SNAPSHOT_EVERY = 50
+JOURNAL_MAX_BYTES = 4 * 1024 * 1024
+UNDO_DEPTH = 20
+UNDO_MAX_LIST = 200   # an inverse that would copy a longer list is not kept (undo stops there)
+
+def to_version(value) -> int:
+    return value if isinstance(value, int) else 0
+
+def doc_diff(before: dict, after: dict, skip=()):
+    """(diff, inverse) that turn `before` into `after` and back, ignoring `skip` keys."""
+    diff, inv = {}, {}
+    for k in before.keys() | after.keys():
+        if k in skip:
+            continue
+        if k not in after:
+            diff.setdefault("unset", []).append(k)
+            inv.setdefault("set", {})[k] = before[k]
+            continue
+        new = after[k]
+        if k not in before:
+            diff.setdefault("set", {})[k] = new
+            inv.setdefault("unset", []).append(k)
+            continue
+        old = before[k]
+        if old == new:
+            continue
+        if isinstance(old, list) and isinstance(new, list):
+            n, m = len(old), len(new)
+            if m > n and new[:n] == old:
+                diff.setdefault("append", {})[k] = new[n:]
+                inv.setdefault("trunc", {})[k] = n
+                continue
+            if m < n and old[:m] == new:
+                diff.setdefault("trunc", {})[k] = m
+                inv.setdefault("append", {})[k] = old[m:]
+                continue
+        diff.setdefault("set", {})[k] = new
+        inv.setdefault("set", {})[k] = old
+    return diff, inv
+
+def inverse_too_big(inv) -> bool:
+    values = list((inv.get("set") or {}).values()) + list((inv.get("append") or {}).values())
+    return any(isinstance(v, list) and len(v) > UNDO_MAX_LIST for v in values)
+
+def save_op(uid: str, before: dict, after: dict, version_field: str, undo_field: str,
+            volatile_fields=(), action=None):
+    """
+    The op that turns the stored doc `before` ({} if none) into `after`:
+    (op, changed). The version is counted from what is stored, not from the
+    caller's copy. With an action the inverse goes on the undo stack, minus
+    the volatile fields; an action with nothing left to roll back is not an undo step.
+    """
+    diff, inv = doc_diff(before, after, skip=(version_field, undo_field))
+    version = max(to_version(before.get(version_field)), to_version(after.get(version_field))) + 1
+    op = {"uid": uid, "v": version, "diff": diff}
+    if action:
+        for part in inv.values():
+            if isinstance(part, dict):
+                for k in volatile_fields:
+                    part.pop(k, None)
+            else:
+                part[:] = [k for k in part if k not in volatile_fields]
+        inv = {k: v for k, v in inv.items() if v}
+        if inv:
+            op["action"] = {"id": action["id"], "label": action.get("label")}
+            op["inv"] = None if inverse_too_big(inv) else inv
+    return op, bool(diff)
+
+def undo_op(state: dict, version_field: str, undo_field: str):
+    """(op, label) that rolls back the top of the doc's undo stack, or None if it is empty."""
+    stack = (state or {}).get(undo_field) or []
+    if not stack:
+        return None
+    entry = stack[-1]
+    op = {"uid": state["id"], "v": to_version(state.get(version_field)) + 1, "undo": list(reversed(entry["inv"]))}
+    return op, entry.get("label") or ""
+
+def apply_diff(doc: dict, diff: dict):
+    """In place; values are copied so the doc never shares objects with an op."""
+    for k, v in (diff.get("set") or {}).items():
+        doc[k] = copy.deepcopy(v)
+    for k in diff.get("unset") or []:
+        doc.pop(k, None)
+    for k, n in (diff.get("trunc") or {}).items():
+        if isinstance(doc.get(k), list):
+            del doc[k][n:]
+    for k, items in (diff.get("append") or {}).items():
+        if not isinstance(doc.get(k), list):
+            doc[k] = []
+        doc[k].extend(copy.deepcopy(items))
+
+def apply_op(doc: dict, op: dict, version_field: str, undo_field: str):
+    if "undo" in op:
+        for d in op["undo"]:
+            apply_diff(doc, d)
+        doc[undo_field] = (doc.get(undo_field) or [])[:-1]
+    else:
+        apply_diff(doc, op["diff"])
+        action = op.get("action")
+        if action:
+            stack = doc.get(undo_field) or []
+            if op.get("inv") is None:
+                stack = []
+            elif stack and stack[-1]["id"] == action["id"]:
+                stack[-1]["inv"].append(op["inv"])
+            else:
+                stack.append({"id": action["id"], "label": action.get("label"), "inv": [op["inv"]]})
+                del stack[:-UNDO_DEPTH]
+            doc[undo_field] = stack
+    doc[version_field] = op["v"]
+
+class Journal:
+    """
+    The journal file of one shard, plus the ops not yet in a snapshot, per uid.
+    Appends by other workers are picked up by reading on from the last offset;
+    a rewrite (new inode or shorter file) starts over. Callers hold the shard lock.
+    """
+    fsync = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0        # end of the last complete line read
+        self.ino = None
+        self.torn = False      # file ends in a partial line (a writer died mid-append)
+        self._restart()
+
+    def _restart(self):
+        self.pending = {}      # uid -> [op, ...] in version order
+
+    def refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        if st is None or st.st_ino != self.ino or st.st_size < self.offset:
+            self.offset, self.torn = 0, False
+            self._restart()
+            self.ino = st.st_ino if st else None
+        if st is None or st.st_size == self.offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        self.feed(chunk)
+
+    def feed(self, chunk: bytes):
+        """Index the complete lines of the bytes that follow self.offset."""
+        end = chunk.rfind(b"\n") + 1
+        for line in chunk[:end].splitlines():
+            try:
+                self._index(json.loads(line))
+            except ValueError:
+                continue  # the remains of a torn append
+        self.offset += end
+        self.torn = end < len(chunk)
+
+    def _index(self, op: dict):
+        if op.get("remove"):
+            self.pending.pop(op["uid"], None)
+        else:
+            self.pending.setdefault(op["uid"], []).append(op)
+
+    def append(self, op: dict) -> dict:
+        """Write one op (fsync'd) and return the copy that is kept in memory."""
+        return self.append_many([op])[0]
+
+    def append_many(self, ops) -> list:
+        """Write several ops with one write + fsync; returns the kept copies."""
+        self.refresh()
+        lines = [json.dumps(op, ensure_ascii=False) + "\n" for op in ops]
+        data = (b"\n" if self.torn else b"") + "".join(lines).encode("utf-8")
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+        if self.ino is None:
+            self.ino = st.st_ino
+        self.offset = st.st_size
+        self.torn = False
+        kept = [json.loads(line) for line in lines]
+        for op in kept:
+            self._index(op)
+        return kept
+
+    def ops_for(self, uid: str, after_version: int):
+        """Pending ops of uid newer than a snapshot at after_version (older ones are dropped)."""
+        ops = self.pending.get(uid)
+        if not ops:
+            return []
+        if ops[0].get("v", 0) <= after_version:
+            ops = [op for op in ops if op.get("v", 0) > after_version]
+            if ops:
+                self.pending[uid] = ops
+            else:
+                self.pending.pop(uid, None)
+        return ops
+
+    def size(self) -> int:
+        return self.offset
+
+    def reset(self):
+        """Start an empty journal (new inode, so other workers notice)."""
+        tmp = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp, "wb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.offset, self.torn = 0, False
+        self.ino = os.stat(self.path).st_ino
+        self._restart()
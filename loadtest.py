@@ -0,0 +1,401 @@
+"""
+Soak/load test for /sms against a local gunicorn with several workers.
+
+    python loadtest.py                                  # 4 workers, 50 msg/s for 30s
+    python loadtest.py --workers 8 --rate 200 --duration 120 --shards 4
+    python loadtest.py --replay traffic.jsonl           # recorded bodies, {"from": .., "body": ..} per line
+    python loadtest.py --backup-every 5                 # online backups while the load runs
+
+Families (a mom plus her partner_phone) are seeded into throwaway TinyDB files.
+Both phones write to the same user at the same time. The server gets the same
+env as production, except that the rate limit is lifted. Runs fully offline.
+
+Every write in the synthetic mix can be traced back to the message that made
+it: bottle/pump amounts are unique per family and diapers are counted. After
+the run the server is stopped and the store is read back. Every write that
+got a 200 + TwiML reply must be there exactly once. A write whose request
+failed may be there at most once. Recorded bodies are replayed next to these
+writes and count toward the latency and error figures only.
+
+With --backup-every, backups (full, then incremental) are taken from this
+process while the server is writing. After the run one more is taken, the
+chain is restored into fresh files and every restored doc must equal the
+store's.
+
+Exit status is 1 when an acked event is missing or duplicated, or when the
+restored backup differs from the store.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+LOAD_DIR = tempfile.mkdtemp(prefix="bili-load-")
+
+# the seeding below goes through the app's own store, pointed at LOAD_DIR
+os.environ.pop("TINYDB_PATH", None)
+os.environ.pop("TINYDB_SHARDS_PREVIOUS", None)
+os.environ["STORE_WARMUP"] = "0"
+
+# (weight, body) - untracked reads/queries
+QUERY_MIX = [
+    (15, "סטטוס"),
+    (10, "מתי אכל"),
+    (5, "השוואה"),
+    (5, "מלאי"),
+    (5, "מתי הבא"),
+]
+# (weight, kind) - traced writes
+WRITE_MIX = [
+    (30, "bottle"),
+    (10, "pump"),
+    (20, "diaper"),
+]
+DIAPER_TYPES = ["קקי", "פיפי"]
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def shard_env(shards: int):
+    paths = [os.path.join(LOAD_DIR, f"shard{i}.json") for i in range(shards)]
+    return {
+        "TINYDB_SHARDS": ",".join(paths),
+        "TINYDB_DIRECTORY_PATH": os.path.join(LOAD_DIR, "directory.json"),
+    }
+
+def seed_families(bot, count: int, rng):
+    families = []
+    for _ in range(count):
+        mom = f"9725{rng.randrange(10**7, 10**8)}"
+        partner = f"9725{rng.randrange(10**7, 10**8)}"
+        bot.save_user({
+            "id": mom,
+            bot.KEY_PARTNER_PHONE: partner,
+            bot.KEY_STAGE: 5,
+            bot.KEY_MOM_NAME: "אמא",
+            bot.KEY_BABY_SEX: "f",
+            bot.KEY_BABY_NAME: "בייבי",
+            bot.KEY_DOB: bot.now_local().date().isoformat(),
+            bot.KEY_FEEDING_MODE: "mixed",
+            bot.KEY_EVENTS: [],
+        })
+        families.append((mom, partner))
+    return families
+
+def load_replay(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                rec = json.loads(line)
+                yield rec.get("from", ""), rec.get("body", "")
+
+class Plan:
+    """The message sequence: (sender, body, trace) where trace = (owner, key) or None."""
+
+    def __init__(self, families, rng, replay=None):
+        self.families = families
+        self.rng = rng
+        self.next_amount = defaultdict(int)
+        self.replay = list(replay) if replay else None
+        self.replay_pos = 0
+        self.replay_senders = {}
+        self.mix = [(w, ("query", b)) for w, b in QUERY_MIX] + [(w, ("write", k)) for w, k in WRITE_MIX]
+        self.write_share = sum(w for w, _ in WRITE_MIX) / sum(w for w, _ in self.mix)
+
+    def _sender(self, mom, partner):
+        return mom if self.rng.random() < 0.5 else partner
+
+    def _write(self, kind):
+        mom, partner = self.rng.choice(self.families)
+        sender = self._sender(mom, partner)
+        if kind == "diaper":
+            t = self.rng.choice(DIAPER_TYPES)
+            return sender, t, (mom, ("diaper", t))
+        self.next_amount[(mom, kind)] += 1
+        amount = self.next_amount[(mom, kind)]
+        if amount > 9999:
+            raise SystemExit("too many writes per family for unique amounts; add --families")
+        body = f"בקבוק {amount}" if kind == "bottle" else f"שאבתי {amount}"
+        return sender, body, (mom, (kind, amount))
+
+    def next(self):
+        if self.replay is not None:
+            if self.rng.random() < self.write_share:
+                return self._write(self.rng.choice([k for _, k in WRITE_MIX]))
+            src, body = self.replay[self.replay_pos % len(self.replay)]
+            self.replay_pos += 1
+            if src not in self.replay_senders:
+                mom, partner = self.families[len(self.replay_senders) % len(self.families)]
+                self.replay_senders[src] = self._sender(mom, partner)
+            return self.replay_senders[src], body, None
+
+        kind, what = self.rng.choices([m for _, m in self.mix], weights=[w for w, _ in self.mix])[0]
+        if kind == "write":
+            return self._write(what)
+        mom, partner = self.rng.choice(self.families)
+        return self._sender(mom, partner), what, None
+
+def start_server(workers: int, port: int, env: dict):
+    cmd = [sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", f"127.0.0.1:{port}",
+           "--timeout", "120", "--log-level", "warning", "app:app"]
+    log = open(os.path.join(LOAD_DIR, "server.log"), "wb")
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited early, see {log.name}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as r:
+                if r.status == 200:
+                    return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("server did not come up in 30s")
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def post(url: str, sender: str, body: str, timeout: float):
+    data = urllib.parse.urlencode({"From": "whatsapp:+" + sender, "Body": body}).encode("utf-8")
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, data=data, timeout=timeout) as r:
+            text = r.read().decode("utf-8", "replace")
+            ok = r.status == 200 and "<Message>" in text
+            outcome = "ok" if ok else "bad_reply"
+    except urllib.error.HTTPError as e:
+        outcome = f"http_{e.code}"
+    except (urllib.error.URLError, OSError):
+        outcome = "timeout_or_conn"
+    return outcome, (time.perf_counter() - t0) * 1000
+
+def run_load(url: str, plan: Plan, rate: float, duration: float, concurrency: int, timeout: float):
+    """Open loop: message i is due at i/rate whether or not earlier ones finished."""
+    results = []
+    lock = threading.Lock()
+    lag = []
+
+    def one(due, sender, body, trace):
+        outcome, service_ms = post(url, sender, body, timeout)
+        # latency counts from when the message was due, so queueing behind a slow server shows up
+        total_ms = (time.perf_counter() - due) * 1000
+        with lock:
+            results.append((outcome, total_ms, service_ms, trace))
+
+    total = int(rate * duration)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        t0 = time.perf_counter()
+        for i in range(total):
+            due = t0 + i / rate
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                lag.append(-wait * 1000)
+            pool.submit(one, due, *plan.next())
+    elapsed = time.perf_counter() - t0
+    return results, elapsed, lag
+
+def verify(bot, results):
+    """Acked traced writes present exactly once; failed ones at most once."""
+    acked = defaultdict(Counter)
+    failed = defaultdict(Counter)
+    for outcome, _, _, trace in results:
+        if trace:
+            owner, key = trace
+            (acked if outcome == "ok" else failed)[owner][key] += 1
+
+    missing = duplicated = unacked_present = 0
+    for owner in set(acked) | set(failed):
+        try:
+            user = bot.get_user_by_any(owner) or {}
+        except ValueError as e:  # a torn write left the shard unreadable
+            return {"store readable": f"NO ({e})", "acked but missing": "all", "duplicated": "?"}
+        stored = Counter()
+        for e in user.get(bot.KEY_EVENTS) or []:
+            d = e.get("details") or {}
+            if e.get("type") in ("bottle", "pump"):
+                stored[(e["type"], d.get("amount"))] += 1
+            elif e.get("type") == "diaper":
+                stored[("diaper", d.get("type"))] += 1
+        for key in set(acked[owner]) | set(failed[owner]):
+            want, maybe, got = acked[owner][key], failed[owner][key], stored[key]
+            if got < want:
+                missing += want - got
+            elif got > want + maybe:
+                duplicated += got - want - maybe
+            elif got > want:
+                unacked_present += got - want
+    return {
+        "store readable": "yes",
+        "traced writes acked": sum(sum(c.values()) for c in acked.values()),
+        "traced writes failed": sum(sum(c.values()) for c in failed.values()),
+        "acked but missing": missing,
+        "duplicated": duplicated,
+        "failed but stored (ok)": unacked_present,
+    }
+
+class BackupRunner:
+    """Takes a backup every `every` seconds in a thread while the load runs."""
+
+    def __init__(self, bot, every: float):
+        import backup
+        self.backup = backup
+        self.bot = bot
+        self.every = every
+        self.dir = os.path.join(LOAD_DIR, "backups")
+        self.entries = []
+        self.errors = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="backups", daemon=True)
+
+    def take(self):
+        try:
+            self.entries.append(self.backup.take_backup(self.bot.get_store(), self.dir, log=lambda *_: None))
+        except Exception as e:  # reported, and fails the run
+            self.errors.append(repr(e))
+
+    def _run(self):
+        while not self._stop.wait(self.every):
+            self.take()
+
+    def start(self):
+        self.take()  # the full one, right as the load starts
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def verify(self):
+        """One last backup, then restore the chain into fresh files and compare with the store."""
+        self.take()
+        restore_dir = os.path.join(LOAD_DIR, "restored")
+        os.makedirs(restore_dir, exist_ok=True)
+        t0 = time.perf_counter()
+        try:
+            restored = self.backup.restore(self.dir, [os.path.join(restore_dir, "shard0.json")],
+                                           os.path.join(restore_dir, "directory.json"), log=lambda *_: None)
+        except ValueError as e:
+            return {"backups taken": len(self.entries), "backup restore": f"FAILED ({e})"}
+        restore_s = time.perf_counter() - t0
+        live = {doc["id"]: doc for doc in self.bot.get_store().iter_users()}
+        differ = sum(1 for uid in live.keys() | restored.keys() if live.get(uid) != restored.get(uid))
+        incr = [e for e in self.entries if e["kind"] == "incr"]
+        return {
+            "backups taken": f"{len(self.entries)} ({len(self.errors)} failed)",
+            "full backup s / MB/s": f"{self.entries[0]['seconds']:.2f} / "
+                                    f"{self.entries[0]['raw_bytes'] / 1e6 / max(self.entries[0]['seconds'], 1e-9):.1f}",
+            "incremental p50 s / KB": f"{statistics.median(e['seconds'] for e in incr):.3f} / "
+                                      f"{statistics.median(e['bytes'] for e in incr) / 1e3:.1f}" if incr else "-",
+            "shard locks held max ms": f"{max(e['locks_held_ms'] for e in self.entries):.1f}",
+            "restore s": f"{restore_s:.2f} ({len(restored)} users)",
+            "restored != store": differ,
+        }
+
+def pct(sorted_ms, p):
+    return sorted_ms[min(len(sorted_ms) - 1, int(len(sorted_ms) * p / 100))] if sorted_ms else 0.0
+
+def report(args, results, elapsed, lag, checks):
+    outcomes = Counter(r[0] for r in results)
+    ms = sorted(r[1] for r in results)
+    service = sorted(r[2] for r in results)
+    n = len(results)
+    print(f"workers={args.workers} shards={args.shards} families={args.families} "
+          f"target={args.rate:g}/s concurrency={args.concurrency}\n")
+    print(f"{'sent':<28}{n}")
+    print(f"{'elapsed s':<28}{elapsed:.1f}")
+    print(f"{'throughput msg/s':<28}{n / elapsed:.1f}")
+    for outcome, count in sorted(outcomes.items()):
+        print(f"{'  ' + outcome:<28}{count} ({100 * count / n:.2f}%)")
+    print(f"{'latency p50/p95/p99 ms':<28}{pct(ms, 50):.0f} / {pct(ms, 95):.0f} / {pct(ms, 99):.0f}")
+    print(f"{'latency max ms':<28}{ms[-1] if ms else 0:.0f}")
+    print(f"{'service p50/p95/p99 ms':<28}{pct(service, 50):.0f} / {pct(service, 95):.0f} / {pct(service, 99):.0f}")
+    if lag:
+        print(f"{'sender behind schedule':<28}{len(lag)} msgs, median {statistics.median(lag):.0f} ms late")
+    print()
+    for name, value in checks.items():
+        print(f"{name:<28}{value}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker processes")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--families", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=50, help="messages per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=32, help="max requests in flight")
+    parser.add_argument("--timeout", type=float, default=30, help="per-request timeout, seconds")
+    parser.add_argument("--replay", help="JSON lines of recorded {\"from\", \"body\"} to replay")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--backup-every", type=float, help="take an online backup every N seconds during the load")
+    parser.add_argument("--keep", action="store_true", help=f"keep the store and server log ({LOAD_DIR})")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ, **shard_env(args.shards))
+    env.update({"RATE_LIMIT_BURST": "1000000000", "RATE_LIMIT_PER_MIN": "1000000000"})
+    env.pop("RATE_LIMIT_STORE", None)
+    os.environ.update(shard_env(args.shards))
+
+    import app as bot
+
+    rng = random.Random(args.seed)
+    try:
+        families = seed_families(bot, args.families, rng)
+        bot.get_store().close()
+        replay = load_replay(args.replay) if args.replay else None
+        plan = Plan(families, rng, replay)
+
+        port = free_port()
+        proc = start_server(args.workers, port, env)
+        backups = BackupRunner(bot, args.backup_every) if args.backup_every else None
+        try:
+            if backups:
+                backups.start()
+            results, elapsed, lag = run_load(f"http://127.0.0.1:{port}/sms", plan, args.rate,
+                                             args.duration, args.concurrency, args.timeout)
+        finally:
+            if backups:
+                backups.stop()
+            stop_server(proc)
+
+        checks = verify(bot, results)
+        if backups:
+            checks.update(backups.verify())
+        report(args, results, elapsed, lag, checks)
+        failed = checks["acked but missing"] or checks["duplicated"]
+        if backups:
+            failed = failed or backups.errors or checks.get("restored != store", 1) != 0
+        return 1 if failed else 0
+    finally:
+        if args.keep:
+            print(f"\nkept {LOAD_DIR}")
+        else:
+            shutil.rmtree(LOAD_DIR, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
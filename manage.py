@@ -0,0 +1,381 @@
+"""
+Operator commands.
+
+    python manage.py rebalance --from a.json --to a.json,b.json
+    python manage.py rebuild-directory
+    python manage.py rebuild-feed-stats
+    python manage.py cohort --out cohort.csv
+    python manage.py api-token 972501234567
+    python manage.py checkpoint
+    python manage.py backup [--full]
+    python manage.py restore --to restored.json [--upto NAME]
+    python manage.py users --stage 2 | --inactive-days 30 | --active-days 1 --count
+    python manage.py sweep --registration-days 14 --inactive-days 180 [--purge]
+    python manage.py shadow-sync [--to sql]
+    python manage.py shadow-status [--reset]
+    python manage.py help-index [--query "איך מאחסנים חלב"]
+
+Storage paths come from the same env vars the bot uses (TINYDB_PATH,
+TINYDB_SHARDS, TINYDB_DIRECTORY_PATH) unless given explicitly.
+"""
+import os
+import sys
+import time
+import argparse
+
+def split_paths(value: str):
+    return [p.strip() for p in value.split(",") if p.strip()]
+
+def cmd_rebalance(args):
+    from storage import rebalance
+    import app as bot
+
+    old_paths = split_paths(args.from_paths)
+    new_paths = split_paths(args.to_paths) if args.to_paths else bot.SHARD_PATHS
+    t0 = time.perf_counter()
+    moved = rebalance(old_paths, new_paths, args.directory or bot.DIRECTORY_PATH)
+    print(f"moved {moved} users from {len(old_paths)} to {len(new_paths)} shards in {time.perf_counter() - t0:.2f}s")
+    print("once done, drop TINYDB_SHARDS_PREVIOUS from the bot's environment")
+
+def cmd_rebuild_directory(args):
+    import app as bot
+
+    n = bot.get_store().rebuild_directory()
+    print(f"directory: {n} partner phones")
+
+def cmd_rebuild_feed_stats(args):
+    import app as bot
+
+    store = bot.get_store()
+    n = 0
+    for listed in store.iter_users():
+        uid = listed["id"]
+        # same lock as the webhook, and a fresh read inside it: an event logged since
+        # iter_users() read the doc must not be diffed away by this save
+        with store.user_lock(store.lock_owner(uid)):
+            user = store.get(uid)
+            if user is None:
+                continue
+            bot.rebuild_feed_stats(user)
+            bot.save_user(user)
+        n += 1
+    print(f"feed stats rebuilt for {n} users")
+
+def cmd_checkpoint(args):
+    import app as bot
+
+    t0 = time.perf_counter()
+    bot.get_store().checkpoint()
+    print(f"journals folded into {len(bot.SHARD_PATHS)} shards in {time.perf_counter() - t0:.2f}s")
+
+def cmd_api_token(args):
+    import app as bot
+
+    if not bot.API_SECRET:
+        return "API_SECRET is not set"
+    user = bot.get_user_by_any(bot.normalize_phone(args.phone))
+    if not user:
+        return f"no user for {args.phone}"
+    # partners get the owner's token: the dashboard shows the family's data
+    print(bot.api_token(user["id"]))
+
+def cmd_cohort(args):
+    import analytics
+    import app as bot
+
+    paths = split_paths(args.paths) if args.paths else bot.SHARD_PATHS
+    t0 = time.perf_counter()
+    if not args.paths:
+        # the workers read the shard files directly: fold the journals in first
+        bot.get_store().checkpoint()
+    columns = analytics.collect(paths, workers=args.workers, max_age=args.max_age, default_tz=bot.DEFAULT_TZ_NAME)
+    rows = analytics.cohort_rows(columns)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8", newline="") as f:
+            analytics.write_rows(rows, args.format, f)
+    else:
+        analytics.write_rows(rows, args.format, sys.stdout)
+    print(f"cohort: {len(columns['age'])} user-days from {len(paths)} shards -> {len(rows)} rows "
+          f"in {time.perf_counter() - t0:.2f}s", file=sys.stderr)
+
+def cmd_backup(args):
+    import backup
+    import app as bot
+
+    store = bot.get_store()
+    if not hasattr(store, "open_files"):
+        return "backup reads the TinyDB shards: with STORE_PRIMARY=sql use the database's own backups"
+    backup.take_backup(store, args.dir or backup.backup_dir_for(bot.SHARD_PATHS), full=args.full)
+
+def cmd_restore(args):
+    import backup
+    import app as bot
+
+    paths = split_paths(args.to) if args.to else bot.SHARD_PATHS
+    directory = args.directory or (os.path.splitext(paths[0])[0] + ".directory.json" if args.to else bot.DIRECTORY_PATH)
+    try:
+        backup.restore(args.dir or backup.backup_dir_for(bot.SHARD_PATHS), paths, directory,
+                       upto=args.upto, force=args.force)
+    except (ValueError, FileNotFoundError) as e:
+        return f"restore failed: {e}"
+
+def sweep_match(entry, cutoff: int, registered: bool) -> bool:
+    import app as bot
+
+    if (entry["stage"] >= bot.REGISTRATION_DONE) != registered:
+        return False
+    return entry["saved"] < cutoff and (entry.get("last") or 0) < cutoff
+
+def inactive_since(store, cutoff: int, registered: bool):
+    """
+    Index entries of users with no save and no event since `cutoff`: finished
+    registrations, or (registered=False) registrations that stopped midway.
+    Only the index matches are looked at, never every user.
+    """
+    import app as bot
+
+    if registered:
+        candidates = store.find("last", None, cutoff) + store.find_equal("last", None)
+    else:
+        candidates = store.find("stage", None, bot.REGISTRATION_DONE)
+    return [e for e in candidates if sweep_match(e, cutoff, registered)]
+
+def print_entries(entries):
+    for e in entries:
+        last = time.strftime("%Y-%m-%d %H:%M", time.localtime(e["last"])) if e.get("last") else "-"
+        print(f"{e['uid']}\tstage={e['stage']}\tlast={last}\tdob={e.get('dob') or '-'}")
+
+def cmd_users(args):
+    import app as bot
+
+    store = bot.get_store()
+    now = int(time.time())
+    t0 = time.perf_counter()
+    if args.stage is not None:
+        entries = store.find_equal("stage", args.stage)
+    elif args.inactive_days:
+        entries = inactive_since(store, now - args.inactive_days * 86400, registered=True)
+    elif args.active_days:
+        lo = now - args.active_days * 86400
+        if args.count:
+            print(store.count("last", lo))
+            return
+        entries = store.find("last", lo)
+    elif args.born_from or args.born_to:
+        entries = store.find("dob", args.born_from, args.born_to)
+    else:
+        return "give --stage, --inactive-days, --active-days or --born-from/--born-to"
+    if args.count:
+        print(len(entries))
+    else:
+        print_entries(entries)
+    print(f"{len(entries)} users in {(time.perf_counter() - t0) * 1000:.1f} ms", file=sys.stderr)
+
+def cmd_sweep(args):
+    import app as bot
+
+    store = bot.get_store()
+    now = int(time.time())
+    sweeps = []
+    if args.registration_days:
+        sweeps.append(("abandoned registrations", now - args.registration_days * 86400, False))
+    if args.inactive_days:
+        sweeps.append(("inactive users", now - args.inactive_days * 86400, True))
+    if not sweeps:
+        return "give --registration-days and/or --inactive-days"
+
+    removed = 0
+    for label, cutoff, registered in sweeps:
+        t0 = time.perf_counter()
+        entries = inactive_since(store, cutoff, registered)
+        print(f"{label}: {len(entries)} (listed in {(time.perf_counter() - t0) * 1000:.1f} ms)")
+        if not args.purge:
+            print_entries(entries)
+            continue
+        uids = [e["uid"] for e in entries]
+        t0 = time.perf_counter()
+        for i in range(0, len(uids), args.batch):
+            # re-checked under the shard lock: someone may have written since the listing
+            n = len(store.remove_many(uids[i:i + args.batch],
+                                      check=lambda e: sweep_match(e, cutoff, registered)))
+            removed += n
+            print(f"  batch {i // args.batch + 1}: removed {n} of {len(uids[i:i + args.batch])}")
+        print(f"  purged in {time.perf_counter() - t0:.2f}s")
+    if args.purge:
+        t0 = time.perf_counter()
+        before, after = store.compact()
+        print(f"removed {removed} users; compacted {before / 1e6:.2f} MB -> {after / 1e6:.2f} MB "
+              f"in {time.perf_counter() - t0:.2f}s")
+    else:
+        print("dry run: add --purge to remove them (take a backup first: manage.py backup)")
+
+def cmd_rebuild_index(args):
+    import app as bot
+
+    t0 = time.perf_counter()
+    bot.get_store().rebuild_indexes()
+    print(f"indexes rebuilt for {len(bot.SHARD_PATHS)} shards in {time.perf_counter() - t0:.2f}s")
+
+def cmd_shadow_sync(args):
+    import app as bot
+
+    target_name = args.to or bot.STORE_SHADOW
+    if not target_name or target_name == bot.STORE_PRIMARY:
+        return "give --to (or set STORE_SHADOW) to a backend other than STORE_PRIMARY"
+    source = bot.open_backend(bot.STORE_PRIMARY)
+    target = bot.open_backend(target_name)
+    source.checkpoint()
+    t0 = time.perf_counter()
+    n, batch = 0, []
+    for doc in source.iter_users():
+        batch.append(doc)
+        if len(batch) >= args.batch:
+            target.put_many(batch)
+            n += len(batch)
+            batch = []
+    target.put_many(batch)
+    n += len(batch)
+    print(f"copied {n} users from {bot.STORE_PRIMARY} to {target_name} in {time.perf_counter() - t0:.2f}s")
+
+def cmd_shadow_status(args):
+    import shutil
+    import shadow
+    import app as bot
+
+    if args.reset:
+        shutil.rmtree(bot.SHADOW_STATUS_DIR, ignore_errors=True)
+        print(f"cleared {bot.SHADOW_STATUS_DIR}: the clean period starts over")
+        return
+    pairs = shadow.read_status(bot.SHADOW_STATUS_DIR)
+    if not pairs:
+        return f"no shadow status in {bot.SHADOW_STATUS_DIR}"
+    for (primary, shadow_name), m in sorted(pairs.items()):
+        print(f"{primary} -> shadow {shadow_name}: {m['processes']} processes running ({m['stuck']} stuck), "
+              f"{m['exited']} exited, mirroring since {time.strftime('%Y-%m-%d %H:%M', time.localtime(m['started']))}, "
+              f"last status {time.time() - m['updated']:.0f} s ago")
+        print(f"  replayed {m['replayed']}, compared {m['compared']} docs + {m['reports']} reports, "
+              f"divergences {m['divergences']}, resynced {m['resynced']}, lag {m['lag']}, "
+              f"dropped {m['dropped']}, errors {m['errors']}, queued {m['queued']}")
+        print(f"  clean for {m['clean_hours']:.1f} h")
+        if m["last_fault"]:
+            print(f"  last lost write (error / dropped / exited with jobs queued) "
+                  f"{time.strftime('%m-%d %H:%M:%S', time.localtime(m['last_fault']))}")
+        for d in m["recent"][-5:]:
+            print(f"  {time.strftime('%m-%d %H:%M:%S', time.localtime(d['time']))} {d['op']} {d['uid']}: {', '.join(d['what'])}")
+        print(f"  {'op':<24}{'n':>8}{'mean ms':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for key, h in sorted(m["hist"].items(), key=lambda kv: (kv[0].split('/')[1], kv[0])):
+            counts = h[:-1]
+            n = sum(counts)
+            side, op = key.split("/")
+            label = f"{op} ({primary if side == 'primary' else shadow_name})"
+            q = [shadow.quantile_ms(counts, x) for x in (0.5, 0.95, 0.99)]
+            print(f"  {label:<24}{n:>8}{h[-1] / max(n, 1):>10.2f}" + "".join(f"{v:>9g}" for v in q))
+    for name in ("sql", "tinydb"):
+        if any(s == name for _, s in pairs):
+            ok, reason = shadow.ready_to_switch(bot.SHADOW_STATUS_DIR, name, bot.SHADOW_MIN_CLEAN_HOURS)
+            print(f"switch STORE_PRIMARY={name}: {'ready' if ok else 'not yet'} - {reason}")
+
+def cmd_help_index(args):
+    import helpkb
+    import app as bot
+
+    if args.check:
+        if helpkb.read_index(bot.HELP_DIR) is None:
+            return f"{os.path.join(bot.HELP_DIR, helpkb.INDEX_NAME)} is missing or stale: run `python manage.py help-index`"
+        print("help index is current")
+        return
+    t0 = time.perf_counter()
+    index = helpkb.build_index(bot.HELP_DIR)
+    path = helpkb.write_index(bot.HELP_DIR, index)
+    print(f"{len(index['articles'])} articles, {len(index['postings'])} keywords -> {path} "
+          f"in {(time.perf_counter() - t0) * 1000:.1f} ms")
+    if args.query:
+        kb = helpkb.HelpKB(bot.HELP_DIR)
+        msg = bot.clean_msg(args.query)
+        t0 = time.perf_counter()
+        aid = kb.match(msg, bot.HELP_MIN_HITS)
+        ms = (time.perf_counter() - t0) * 1000
+        print(f"{args.query!r} -> {aid or 'no article'} ({ms:.3f} ms)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("rebalance", help="move users to their owner shard after adding/removing shards")
+    p.add_argument("--from", dest="from_paths", required=True, help="previous shard paths, comma separated")
+    p.add_argument("--to", dest="to_paths", help="new shard paths (default: TINYDB_SHARDS)")
+    p.add_argument("--directory", help="partner directory path (default: TINYDB_DIRECTORY_PATH)")
+    p.set_defaults(func=cmd_rebalance)
+
+    p = sub.add_parser("rebuild-directory", help="rebuild the partner phone directory from the shards")
+    p.set_defaults(func=cmd_rebuild_directory)
+
+    p = sub.add_parser("rebuild-feed-stats", help="recompute feeding statistics from each user's history")
+    p.set_defaults(func=cmd_rebuild_feed_stats)
+
+    p = sub.add_parser("rebuild-index", help="rebuild the secondary indexes (stage, last event, birth date) from the shards")
+    p.set_defaults(func=cmd_rebuild_index)
+
+    p = sub.add_parser("checkpoint", help="fold the operation journals into the shard snapshots")
+    p.set_defaults(func=cmd_checkpoint)
+
+    p = sub.add_parser("api-token", help="print the dashboard API token for a phone (mom or partner)")
+    p.add_argument("phone")
+    p.set_defaults(func=cmd_api_token)
+
+    p = sub.add_parser("cohort", help="per-day curves grouped by baby age and feeding mode (CSV/JSON)")
+    p.add_argument("--paths", help="shard paths, comma separated (default: TINYDB_SHARDS)")
+    p.add_argument("--format", choices=["csv", "json"], default="csv")
+    p.add_argument("--out", help="output file (default: stdout)")
+    p.add_argument("--workers", type=int, help="worker processes (default: one per shard, up to the CPU count)")
+    p.add_argument("--max-age", type=int, default=365, help="oldest baby age to report, in days")
+    p.set_defaults(func=cmd_cohort)
+
+    p = sub.add_parser("backup", help="online backup: full the first time, then only what changed (gzip + sha256)")
+    p.add_argument("--dir", help="backup directory (default: BACKUP_DIR or backups/ next to the shards)")
+    p.add_argument("--full", action="store_true", help="start a new chain with a full backup")
+    p.set_defaults(func=cmd_backup)
+
+    p = sub.add_parser("restore", help="write a backup out as a fresh store (stop the bot first)")
+    p.add_argument("--dir", help="backup directory (default: BACKUP_DIR or backups/ next to the shards)")
+    p.add_argument("--upto", help="restore the state of this backup (default: the latest)")
+    p.add_argument("--to", help="shard paths to write, comma separated (default: TINYDB_SHARDS)")
+    p.add_argument("--directory", help="partner directory to write (default: next to the first --to shard)")
+    p.add_argument("--force", action="store_true", help="overwrite existing store files")
+    p.set_defaults(func=cmd_restore)
+
+    p = sub.add_parser("users", help="list users from the secondary indexes")
+    p.add_argument("--stage", type=int, help="registration stage (5 = done)")
+    p.add_argument("--inactive-days", type=int, help="registered, nothing logged or saved for N days")
+    p.add_argument("--active-days", type=int, help="logged an event in the last N days")
+    p.add_argument("--born-from", help="birth date from (YYYY-MM-DD)")
+    p.add_argument("--born-to", help="birth date before (YYYY-MM-DD)")
+    p.add_argument("--count", action="store_true", help="print only the number of users")
+    p.set_defaults(func=cmd_users)
+
+    p = sub.add_parser("sweep", help="list (or --purge) abandoned registrations and long-inactive users")
+    p.add_argument("--registration-days", type=int, help="registrations untouched for N days")
+    p.add_argument("--inactive-days", type=int, help="registered users inactive for N days")
+    p.add_argument("--purge", action="store_true", help="remove them, in batches, then compact the store")
+    p.add_argument("--batch", type=int, default=500, help="users removed per shard write")
+    p.set_defaults(func=cmd_sweep)
+
+    p = sub.add_parser("shadow-sync", help="copy every user from the primary store into the shadow backend")
+    p.add_argument("--to", choices=["tinydb", "sql"], help="backend to fill (default: STORE_SHADOW)")
+    p.add_argument("--batch", type=int, default=500, help="users per write")
+    p.set_defaults(func=cmd_shadow_sync)
+
+    p = sub.add_parser("shadow-status", help="shadow store comparison: divergences, latency, ready to switch")
+    p.add_argument("--reset", action="store_true", help="forget the collected status (restarts the clean period)")
+    p.set_defaults(func=cmd_shadow_status)
+
+    p = sub.add_parser("help-index", help="rebuild the help articles' keyword index (data/help/index.json)")
+    p.add_argument("--query", help="then show which article a message would get")
+    p.add_argument("--check", action="store_true", help="only fail when the committed index is missing or stale (CI)")
+    p.set_defaults(func=cmd_help_index)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
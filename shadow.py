@@ -0,0 +1,436 @@
+"""
+Shadow mode for moving the user store to another backend.
+
+    STORE_PRIMARY=tinydb STORE_SHADOW=sql     # serve from TinyDB, mirror into SQL
+    python manage.py shadow-sync              # copy the primary's docs into the shadow once
+    python manage.py shadow-status            # divergences, latency, ready to switch?
+    STORE_PRIMARY=sql STORE_SHADOW=tinydb     # the switch (refused until the shadow matched long enough)
+
+ShadowStore answers every call from the primary. Writes, and a sample of
+reads, are queued and replayed on the shadow by one background thread per
+process, which compares the outcome:
+
+  save   the shadow's doc after the same save equals the primary's
+         (content, version counter and undo stack)
+  undo   same label, then the same doc
+  read   equal docs at equal versions; another version is lag (a write of
+         another worker not replayed yet), not a divergence
+  report every REPORT_EVERY-th matching doc is also rendered by report(doc, now)
+         from both stores' copies and the outputs must be equal
+
+A shadow doc that is behind (out-of-order replay between workers, a
+dropped job) or that diverged is overwritten with the primary's (resync),
+so one bug is reported once and not on every later write.
+
+Every call is timed on both stores into per-operation latency histograms.
+Each process keeps its own counters in <status dir>/shadow-<pid>.json,
+rewritten every STATUS_EVERY seconds while it runs; read_status() merges them.
+
+The clean period that ready_to_switch() measures starts at the latest of:
+the start of the current uninterrupted run of shadow processes (no gap
+longer than STATUS_STALE between one status and the next start), the last
+divergence, and the last fault - a replay that raised, a job dropped on a
+full queue, or a process that exited with jobs still queued. Each of those
+means some write never reached the shadow. The switch is only allowed while
+the shadow is running (or just stopped): status older than STATUS_STALE is
+not evidence about the shadow's current state. Once a switch passed the
+guard it is recorded in switched-<backend>.json, so workers started later
+by the same deploy don't need the (by then stopped) shadow's status.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import socket
+import threading
+from bisect import bisect_left
+
+from journal import to_version
+
+BUCKETS_MS = (0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+QUEUE_MAX = 10000
+REPORT_EVERY = 20
+RECENT_DIVERGENCES = 20
+STATUS_EVERY = 10.0  # seconds between status file writes
+STATUS_STALE = 5 * STATUS_EVERY  # a status older than this no longer says the process is mirroring
+HOST = socket.gethostname()
+
+def quantile_ms(counts, q: float):
+    """Upper bound of the bucket holding the q-quantile (None without samples)."""
+    total = sum(counts)
+    if not total:
+        return None
+    seen = 0
+    for i, n in enumerate(counts):
+        seen += n
+        if seen >= q * total:
+            return BUCKETS_MS[i] if i < len(BUCKETS_MS) else float("inf")
+    return float("inf")
+
+def json_copy(doc):
+    return json.loads(json.dumps(doc)) if doc is not None else None
+
+class ShadowStore:
+    def __init__(self, primary, shadow, names=("primary", "shadow"), status_dir=None,
+                 read_sample: float = 0.1, report=None, report_every: int = REPORT_EVERY, log=None):
+        self.primary = primary
+        self.shadow = shadow
+        self.names = tuple(names)
+        self.status_dir = status_dir
+        self.read_sample = read_sample
+        self.report = report
+        self.report_every = report_every
+        self.log = log or (lambda msg: print(msg, file=sys.stderr, flush=True))
+        self.vf = primary.version_field
+        self.uf = primary.undo_field
+
+        self._queue = queue.Queue(maxsize=QUEUE_MAX)
+        self._thread = None
+        self._thread_pid = None
+        self._stats_lock = threading.Lock()
+        self._last_status = 0.0
+        self.stats = {
+            "pid": os.getpid(), "host": HOST, "primary": self.names[0], "shadow": self.names[1], "started": time.time(),
+            "replayed": 0, "compared": 0, "reports": 0, "divergences": 0, "resynced": 0, "lag": 0,
+            "dropped": 0, "errors": 0, "last_divergence": None, "last_fault": None, "recent": [],
+        }
+        self.hist = {}  # "primary/save" -> [count per bucket] + [sum ms]
+        atexit.register(self.flush)
+
+    def __getattr__(self, name):
+        # everything that is not mirrored (locks, index queries, maintenance) is the primary's
+        return getattr(self.primary, name)
+
+    def warm(self):
+        self.primary.warm()
+        self.shadow.warm()
+
+    # ---------- timing ----------
+    def _observe(self, side: str, op: str, ms: float):
+        key = f"{side}/{op}"
+        with self._stats_lock:
+            h = self.hist.get(key)
+            if h is None:
+                h = self.hist[key] = [0] * (len(BUCKETS_MS) + 2)
+            h[bisect_left(BUCKETS_MS, ms)] += 1
+            h[-1] += ms
+
+    def _timed(self, side: str, op: str, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._observe(side, op, (time.perf_counter() - t0) * 1000)
+
+    def _count(self, name: str, by: int = 1):
+        with self._stats_lock:
+            self.stats[name] += by
+
+    def _fault(self, name: str):
+        # a write that did not reach the shadow: the clean period starts over
+        with self._stats_lock:
+            self.stats[name] += 1
+            self.stats["last_fault"] = time.time()
+
+    # ---------- mirrored calls ----------
+    def _enqueue(self, *job):
+        if self._thread is None or self._thread_pid != os.getpid():
+            with self._stats_lock:
+                if self._thread is None or self._thread_pid != os.getpid():
+                    self._thread = threading.Thread(target=self._run, name="shadow-store", daemon=True)
+                    self._thread_pid = os.getpid()
+                    self.stats["pid"] = os.getpid()
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self._fault("dropped")
+
+    def _sampled(self) -> bool:
+        return random.random() < self.read_sample
+
+    def get(self, uid: str):
+        doc = self._timed("primary", "get", self.primary.get, uid)
+        if self._sampled():
+            self._enqueue("get", uid, json_copy(doc))
+        return doc
+
+    def get_by_any(self, uid: str):
+        doc = self._timed("primary", "get_by_any", self.primary.get_by_any, uid)
+        if self._sampled():
+            self._enqueue("get_by_any", uid, json_copy(doc))
+        return doc
+
+    def version(self, uid: str):
+        v = self._timed("primary", "version", self.primary.version, uid)
+        if self._sampled():
+            self._enqueue("version", uid, v)
+        return v
+
+    def save(self, user: dict, action=None):
+        before = user.get(self.vf)
+        self._timed("primary", "save", self.primary.save, user, action)
+        if user.get(self.vf) != before:  # something was written
+            self._enqueue("save", json_copy(user), before, action)
+
+    def insert(self, doc: dict):
+        self.save(doc)
+
+    def undo(self, uid: str):
+        label = self._timed("primary", "undo", self.primary.undo, uid)
+        if label is not None:
+            self._enqueue("undo", uid, label, self.primary.get(uid))
+        return label
+
+    def remove(self, uid: str):
+        self.remove_many([uid])
+
+    def remove_many(self, uids, check=None):
+        removed = self._timed("primary", "remove", self.primary.remove_many, uids, check)
+        if removed:
+            self._enqueue("remove", sorted(removed))
+        return removed
+
+    # ---------- replay + compare (background thread) ----------
+    def _run(self):
+        while True:
+            try:
+                job = self._queue.get(timeout=STATUS_EVERY)
+            except queue.Empty:
+                job = None  # idle: still write the status, it says this process is alive
+            if job is not None:
+                try:
+                    self._replay(*job)
+                    self._count("replayed")
+                except Exception as e:
+                    self._fault("errors")
+                    self.log(f"shadow: {job[0]} failed on the shadow store: {e!r}")
+                finally:
+                    self._queue.task_done()
+            if time.monotonic() - self._last_status > STATUS_EVERY:
+                self.write_status()
+
+    def _replay(self, kind: str, *args):
+        if kind == "save":
+            expected, version_before, action = args
+            doc = dict(expected)
+            doc[self.vf] = version_before
+            self._timed("shadow", "save", self.shadow.save, doc, action)
+            self._check(expected["id"], "save", expected, self.shadow.get(expected["id"]))
+        elif kind == "undo":
+            uid, label, expected = args
+            got = self._timed("shadow", "undo", self.shadow.undo, uid)
+            if got != label:
+                self._diverged(uid, "undo", [f"label {label!r} != {got!r}"])
+            self._check(uid, "undo", expected, self.shadow.get(uid))
+        elif kind == "remove":
+            (uids,) = args
+            self._timed("shadow", "remove", self.shadow.remove_many, uids)
+        elif kind in ("get", "get_by_any"):
+            uid, expected = args
+            got = self._timed("shadow", kind, getattr(self.shadow, kind), uid)
+            if expected is None:
+                if got is not None:
+                    self._count("lag")
+                return
+            self._check(expected["id"], kind, expected, got)
+        elif kind == "version":
+            uid, expected = args
+            if self._timed("shadow", "version", self.shadow.version, uid) != expected:
+                self._count("lag")
+
+    def _check(self, uid: str, op: str, expected, got):
+        if expected is None:
+            return
+        mine = to_version(got.get(self.vf)) if got else -1
+        theirs = to_version(expected.get(self.vf))
+        if mine > theirs:
+            self._count("lag")  # another worker's newer write already got there
+            return
+        if mine < theirs:
+            self.shadow.put(expected)
+            self._count("resynced")
+            return
+        # the caller's dict always gets an undo stack, a stored doc may have none
+        expected = dict(expected, **{self.uf: expected.get(self.uf) or []})
+        got = dict(got, **{self.uf: got.get(self.uf) or []})
+        if got != expected:
+            keys = sorted(k for k in expected.keys() | got.keys() if expected.get(k) != got.get(k))
+            self._diverged(uid, op, keys)
+            self.shadow.put(expected)
+            self._count("resynced")
+            return
+        self._count("compared")
+        if self.report and self.stats["compared"] % self.report_every == 0:
+            now = time.time()
+            shadow_out, primary_out = self.report(got, now), self.report(expected, now)
+            self._count("reports")
+            bad = sorted(name for name in primary_out if shadow_out.get(name) != primary_out[name])
+            if bad:
+                self._diverged(uid, "report", bad)
+
+    def _diverged(self, uid: str, op: str, what):
+        with self._stats_lock:
+            self.stats["divergences"] += 1
+            self.stats["last_divergence"] = time.time()
+            self.stats["recent"] = (self.stats["recent"] + [
+                {"time": time.time(), "uid": uid, "op": op, "what": list(what)[:10]}])[-RECENT_DIVERGENCES:]
+        self.log(f"shadow: {self.names[1]} diverged from {self.names[0]} on {op} of {uid}: {', '.join(map(str, what))}")
+
+    # ---------- status ----------
+    def snapshot(self) -> dict:
+        with self._stats_lock:
+            return dict(self.stats, queued=self._queue.qsize(), updated=time.time(),
+                        hist={k: list(v) for k, v in self.hist.items()})
+
+    def write_status(self):
+        self._last_status = time.monotonic()
+        if not self.status_dir:
+            return
+        os.makedirs(self.status_dir, exist_ok=True)
+        path = os.path.join(self.status_dir, f"shadow-{os.getpid()}.json")
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def flush(self, timeout: float = 10.0):
+        """Wait (up to timeout) for the queued jobs, then write the status file."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and self._thread is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.write_status()
+
+    def metrics_lines(self, prefix: str = "bili_store"):
+        """Prometheus text lines: op latency histograms per backend + the shadow counters."""
+        snap = self.snapshot()
+        lines = []
+        for key, h in sorted(snap["hist"].items()):
+            side, op = key.split("/")
+            labels = f'backend="{self.names[0] if side == "primary" else self.names[1]}",role="{side}",op="{op}"'
+            seen = 0
+            for bound, n in zip(BUCKETS_MS, h):
+                seen += n
+                lines.append(f'{prefix}_op_seconds_bucket{{{labels},le="{bound / 1000:g}"}} {seen}')
+            lines.append(f'{prefix}_op_seconds_bucket{{{labels},le="+Inf"}} {seen + h[len(BUCKETS_MS)]}')
+            lines.append(f"{prefix}_op_seconds_sum{{{labels}}} {h[-1] / 1000:.6f}")
+            lines.append(f"{prefix}_op_seconds_count{{{labels}}} {sum(h[:-1])}")
+        for name in ("replayed", "compared", "reports", "divergences", "resynced", "lag", "dropped", "errors"):
+            lines.append(f"{prefix}_shadow_{name}_total {snap[name]}")
+        return lines
+
+def pid_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # exists, another user's
+    return True
+
+def read_status(status_dir: str, now: float = None):
+    """
+    The status files of every process, merged per (primary, shadow) pair.
+    Besides the summed counters: processes (still running), stuck (running,
+    but no status for STATUS_STALE), exited, updated (the newest status),
+    last_start (of the newest process), started (start of the current
+    uninterrupted run), last_fault, clean_since and clean_hours.
+    """
+    now = time.time() if now is None else now
+    pairs = {}
+    try:
+        names = sorted(os.listdir(status_dir))
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not (name.startswith("shadow-") and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(status_dir, name), encoding="utf-8") as f:
+                s = json.load(f)
+        except (OSError, ValueError):
+            continue
+        key = (s["primary"], s["shadow"])
+        m = pairs.setdefault(key, {"primary": s["primary"], "shadow": s["shadow"], "processes": 0, "stuck": 0,
+                                   "exited": 0, "runs": [], "last_start": 0, "last_divergence": None, "last_fault": None,
+                                   "updated": 0, "recent": [], "hist": {}})
+        updated = s.get("updated", 0)
+        fresh = now - updated <= STATUS_STALE
+        # the pid only says something on the host that wrote the file
+        running = pid_running(s["pid"]) if s.get("host") == HOST else fresh
+        if running:
+            m["processes"] += 1
+            m["stuck"] += not fresh
+        else:
+            m["exited"] += 1
+        m["runs"].append((s["started"], updated))
+        m["last_start"] = max(m["last_start"], s["started"])
+        m["updated"] = max(m["updated"], updated)
+        if s.get("last_divergence"):
+            m["last_divergence"] = max(m["last_divergence"] or 0, s["last_divergence"])
+        faults = [s.get("last_fault") or 0]
+        if not running and s.get("queued"):
+            faults.append(updated)  # exited before replaying everything
+        if max(faults):
+            m["last_fault"] = max(m["last_fault"] or 0, *faults)
+        for k in ("replayed", "compared", "reports", "divergences", "resynced", "lag", "dropped", "errors", "queued"):
+            m[k] = m.get(k, 0) + s.get(k, 0)
+        m["recent"] = sorted(m["recent"] + s.get("recent", []), key=lambda d: d["time"])[-RECENT_DIVERGENCES:]
+        for k, h in s.get("hist", {}).items():
+            acc = m["hist"].setdefault(k, [0] * len(h))
+            m["hist"][k] = [a + b for a, b in zip(acc, h)]
+    for m in pairs.values():
+        start, end = None, None
+        for started, updated in sorted(m.pop("runs")):
+            if start is None or started > end + STATUS_STALE:
+                start, end = started, updated  # a gap: nothing mirrored in between
+            else:
+                end = max(end, updated)
+        m["started"] = start
+        m["clean_since"] = max(start, m["last_divergence"] or 0, m["last_fault"] or 0)
+        m["clean_hours"] = max(m["updated"] - m["clean_since"], 0) / 3600
+    return pairs
+
+def mark_switched(status_dir: str, new_primary: str, now: float = None):
+    """Record that `new_primary` passed ready_to_switch() and now serves."""
+    os.makedirs(status_dir, exist_ok=True)
+    path = os.path.join(status_dir, f"switched-{new_primary}.json")
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"time": time.time() if now is None else now, "pid": os.getpid(), "host": HOST}, f)
+    os.replace(tmp, path)
+
+def switched_at(status_dir: str, new_primary: str):
+    try:
+        with open(os.path.join(status_dir, f"switched-{new_primary}.json"), encoding="utf-8") as f:
+            return json.load(f)["time"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def ready_to_switch(status_dir: str, new_primary: str, min_hours: float, now: float = None):
+    """(ok, reason): is `new_primary` running as a shadow that has matched, without faults, for min_hours?"""
+    now = time.time() if now is None else now
+    pairs = [m for (_, shadow), m in read_status(status_dir, now).items() if shadow == new_primary]
+    switched = switched_at(status_dir, new_primary)
+    # the switch stands until the backend runs as a shadow again
+    if switched is not None and all(m["last_start"] <= switched for m in pairs):
+        return True, f"switched to {new_primary} at {time.strftime('%Y-%m-%d %H:%M', time.localtime(switched))}"
+    if not pairs:
+        return False, f"{new_primary} never ran as a shadow (no status in {status_dir})"
+    m = max(pairs, key=lambda m: (m["updated"], m["clean_hours"]))
+    if m["stuck"]:
+        return False, (f"{m['stuck']} processes running the {new_primary} shadow have not written "
+                       f"their status for over {STATUS_STALE:g} s")
+    if now - m["updated"] > STATUS_STALE:
+        return False, (f"the {new_primary} shadow last reported {(now - m['updated']) / 3600:.1f} h ago: "
+                       "switch while it is running")
+    if not m["compared"]:
+        return False, f"the {new_primary} shadow has not compared any doc yet"
+    if m["clean_hours"] < min_hours:
+        return False, (f"the {new_primary} shadow has matched for {m['clean_hours']:.1f} h "
+                       f"of the required {min_hours:g} h ({m['divergences']} divergences, {m['errors']} errors, "
+                       f"{m['dropped']} dropped so far)")
+    return True, f"the {new_primary} shadow has matched for {m['clean_hours']:.1f} h ({m['compared']} compared)"
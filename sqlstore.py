@@ -0,0 +1,270 @@
+"""
+User documents in a SQL database (SQLAlchemy Core), with the same interface
+as storage.ShardedStore, so the bot can run on either (STORE_PRIMARY) and
+one can shadow the other (see shadow.py).
+
+One row per user: the doc as JSON text, its version, the partner phone (the
+directory lookup) and one indexed column per secondary index, kept on
+every write. Saves and undo build the same ops as the journal does
+(journal.save_op / undo_op), so both stores give a doc the same version
+counter and undo stack.
+
+    SQL_STORE_URL=sqlite:////var/lib/bili/users.sqlite3
+    SQL_STORE_URL=postgresql+psycopg2://bili@db/bili
+
+user_lock() is the same striped file lock as the TinyDB store: it covers
+the workers of one host.
+"""
+import os
+import json
+
+import sqlalchemy as sa
+
+from journal import apply_op, save_op, undo_op, to_version
+from indexes import index_entry
+from storage import UserLocks
+
+# index value kind -> column type
+INDEX_TYPES = {"int": sa.BigInteger, "str": sa.String(64)}
+
+class SQLStore:
+    def __init__(self, url: str, partner_field: str = "partner_phone", version_field: str = "version",
+                 undo_field: str = "undo", volatile_fields=(), indexes=None, index_types=None, lock_dir=None):
+        self.url = url
+        self.partner_field = partner_field
+        self.version_field = version_field
+        self.undo_field = undo_field
+        self.volatile_fields = set(volatile_fields)
+        self.indexes = dict(indexes or {})
+        self.engine = sa.create_engine(url, pool_pre_ping=True)
+        if self.engine.dialect.name == "sqlite":
+            self._sqlite_setup()
+
+        types = dict(index_types or {})
+        meta = sa.MetaData()
+        self.users = sa.Table(
+            "users", meta,
+            sa.Column("id", sa.String(32), primary_key=True),
+            sa.Column("doc", sa.Text, nullable=False),
+            sa.Column("version", sa.BigInteger, nullable=False),
+            sa.Column("partner", sa.String(32), index=True),
+            sa.Column("ix_saved", sa.BigInteger, index=True),
+            *[sa.Column(f"ix_{field}", INDEX_TYPES[types.get(field, "str")], index=True) for field in self.indexes],
+        )
+        with self._tx() as conn:  # several workers may start on a new database at once
+            meta.create_all(conn)
+        self.lock_dir = lock_dir or self._default_lock_dir()
+        self._user_locks = UserLocks(self.lock_dir)
+
+    def _sqlite_setup(self):
+        # WAL: readers do not wait for the writer; BEGIN IMMEDIATE (writes only, see _tx): a save
+        # takes the write lock before it reads, so two workers cannot both read the old doc
+        @sa.event.listens_for(self.engine, "connect")
+        def on_connect(dbapi_conn, _):
+            dbapi_conn.isolation_level = None
+            dbapi_conn.execute("PRAGMA busy_timeout=30000")
+            dbapi_conn.execute("PRAGMA journal_mode=WAL")
+            dbapi_conn.execute("PRAGMA synchronous=NORMAL")
+
+        @sa.event.listens_for(self.engine, "begin")
+        def on_begin(conn):
+            conn.exec_driver_sql("BEGIN IMMEDIATE" if conn.get_execution_options().get("write") else "BEGIN")
+
+    def _tx(self):
+        """A write transaction."""
+        return self.engine.execution_options(write=True).begin()
+
+    def _default_lock_dir(self) -> str:
+        db = self.engine.url.database
+        if self.engine.dialect.name == "sqlite" and db and db != ":memory:":
+            return os.path.splitext(db)[0] + ".locks"
+        return os.path.join(os.getcwd(), "sqlstore.locks")
+
+    # ---------- rows ----------
+    def _columns(self, doc: dict) -> dict:
+        entry = index_entry(self.indexes, doc)
+        cols = {f"ix_{field}": entry[field] for field in self.indexes}
+        cols["ix_saved"] = entry["saved"]
+        cols["partner"] = doc.get(self.partner_field) or None
+        cols["version"] = to_version(doc.get(self.version_field))
+        cols["doc"] = json.dumps(doc, ensure_ascii=False)
+        return cols
+
+    def _entry(self, row) -> dict:
+        entry = {"uid": row.id}
+        for field in list(self.indexes) + ["saved"]:
+            entry[field] = getattr(row, f"ix_{field}")
+        return entry
+
+    def _write(self, conn, doc: dict, exists: bool):
+        cols = self._columns(doc)
+        if exists:
+            conn.execute(self.users.update().where(self.users.c.id == doc["id"]).values(**cols))
+        else:
+            conn.execute(self.users.insert().values(id=doc["id"], **cols))
+
+    def _load(self, conn, uid: str, for_update: bool = False):
+        q = sa.select(self.users.c.doc).where(self.users.c.id == uid)
+        if for_update:
+            q = q.with_for_update()
+        row = conn.execute(q).first()
+        return json.loads(row.doc) if row else None
+
+    # ---------- documents ----------
+    def get(self, uid: str):
+        with self.engine.connect() as conn:
+            return self._load(conn, uid)
+
+    def get_by_partner(self, phone: str):
+        q = sa.select(self.users.c.doc).where(self.users.c.partner == phone).order_by(self.users.c.ix_saved.desc()).limit(1)
+        with self.engine.connect() as conn:
+            row = conn.execute(q).first()
+        return json.loads(row.doc) if row else None
+
+    def get_by_any(self, uid: str):
+        return self.get(uid) or self.get_by_partner(uid)
+
+    def save(self, user: dict, action=None):
+        """Same contract as ShardedStore.save: version bump, undo stack, caller's dict updated."""
+        uid = user["id"]
+        with self._tx() as conn:
+            state = self._load(conn, uid, for_update=True)
+            op, changed = save_op(uid, state or {}, user, self.version_field, self.undo_field,
+                                  self.volatile_fields, action)
+            if not changed and state is not None:
+                return
+            new_state = state if state is not None else {"id": uid}
+            apply_op(new_state, json.loads(json.dumps(op)), self.version_field, self.undo_field)
+            self._write(conn, new_state, exists=state is not None)
+        user[self.version_field] = new_state[self.version_field]
+        user[self.undo_field] = new_state.get(self.undo_field) or []
+
+    def undo(self, uid: str):
+        with self._tx() as conn:
+            state = self._load(conn, uid, for_update=True)
+            undo = undo_op(state, self.version_field, self.undo_field)
+            if undo is None:
+                return None
+            op, label = undo
+            apply_op(state, json.loads(json.dumps(op)), self.version_field, self.undo_field)
+            self._write(conn, state, exists=True)
+        return label
+
+    def insert(self, doc: dict):
+        self.save(doc)
+
+    def put(self, doc: dict):
+        """Store a doc exactly as given (version and undo stack included)."""
+        self.put_many([doc])
+
+    def put_many(self, docs):
+        docs = list(docs)
+        if not docs:
+            return
+        with self._tx() as conn:
+            conn.execute(self.users.delete().where(self.users.c.id.in_([d["id"] for d in docs])))
+            conn.execute(self.users.insert(), [dict(id=d["id"], **self._columns(d)) for d in docs])
+
+    def version(self, uid: str):
+        with self.engine.connect() as conn:
+            return conn.execute(sa.select(self.users.c.version).where(self.users.c.id == uid)).scalar()
+
+    def remove(self, uid: str):
+        self.remove_many([uid])
+
+    def remove_many(self, uids, check=None):
+        """Same contract as ShardedStore.remove_many; check(entry) runs on the locked rows."""
+        uids = list(uids)
+        if not uids:
+            return set()
+        with self._tx() as conn:
+            if check:
+                rows = conn.execute(sa.select(self.users).where(self.users.c.id.in_(uids)).with_for_update())
+                uids = [row.id for row in rows if check(self._entry(row))]
+            if uids:
+                conn.execute(self.users.delete().where(self.users.c.id.in_(uids)))
+        return set(uids)
+
+    def iter_users(self, chunk: int = 500):
+        last = ""
+        while True:
+            q = sa.select(self.users.c.id, self.users.c.doc).where(self.users.c.id > last).order_by(self.users.c.id).limit(chunk)
+            with self.engine.connect() as conn:
+                rows = conn.execute(q).all()
+            if not rows:
+                return
+            for row in rows:
+                yield json.loads(row.doc)
+            last = rows[-1].id
+
+    # ---------- locks / directory ----------
+    def user_lock(self, uid: str):
+        return self._user_locks.get(uid)
+
+    def lock_owner(self, phone: str) -> str:
+        q = sa.select(self.users.c.id).where(self.users.c.partner == phone).order_by(self.users.c.ix_saved.desc()).limit(1)
+        with self.engine.connect() as conn:
+            owner = conn.execute(q).scalar()
+        return owner or phone
+
+    def rebuild_directory(self) -> int:
+        # the partner column is written with the doc: nothing to rebuild
+        with self.engine.connect() as conn:
+            return conn.execute(sa.select(sa.func.count()).where(self.users.c.partner.is_not(None))).scalar()
+
+    # ---------- secondary indexes ----------
+    def find(self, field: str, lo=None, hi=None):
+        col = self.users.c[f"ix_{field}"]
+        q = sa.select(self.users).where(col.is_not(None))
+        if lo is not None:
+            q = q.where(col >= lo)
+        if hi is not None:
+            q = q.where(col < hi)
+        with self.engine.connect() as conn:
+            return [self._entry(row) for row in conn.execute(q.order_by(col, self.users.c.id))]
+
+    def find_equal(self, field: str, value):
+        col = self.users.c[f"ix_{field}"]
+        q = sa.select(self.users).where(col.is_(None) if value is None else col == value)
+        with self.engine.connect() as conn:
+            return [self._entry(row) for row in conn.execute(q)]
+
+    def count(self, field: str, lo=None, hi=None) -> int:
+        col = self.users.c[f"ix_{field}"]
+        q = sa.select(sa.func.count()).where(col.is_not(None))
+        if lo is not None:
+            q = q.where(col >= lo)
+        if hi is not None:
+            q = q.where(col < hi)
+        with self.engine.connect() as conn:
+            return conn.execute(q).scalar()
+
+    def rebuild_indexes(self, chunk: int = 500):
+        batch = []
+        for doc in self.iter_users(chunk):
+            batch.append(doc)
+            if len(batch) >= chunk:
+                self.put_many(batch)
+                batch = []
+        self.put_many(batch)
+
+    # ---------- maintenance ----------
+    def checkpoint(self, paths=None):
+        pass  # no journal: every save is already in its row
+
+    def compact(self):
+        """VACUUM (sqlite only); returns (bytes before, after), 0 when not a file."""
+        db = self.engine.url.database
+        if self.engine.dialect.name != "sqlite" or not db or db == ":memory:":
+            return 0, 0
+        before = os.path.getsize(db)
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("VACUUM")
+        return before, os.path.getsize(db)
+
+    def warm(self):
+        with self.engine.connect() as conn:
+            conn.execute(sa.select(sa.func.count()).select_from(self.users)).scalar()
+
+    def close(self):
+        self.engine.dispose()
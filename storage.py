@@ -0,0 +1,659 @@
+"""
+User document storage.
+
+Users are spread over N TinyDB shard files by a consistent-hash ring on their
+normalized phone. Partner phones resolve to the owning user through a small
+global directory file, so a lookup never has to scan every shard.
+
+With a single shard (the default: TINYDB_PATH) this is the same one-file
+layout the bot always had.
+
+Several gunicorn workers share the files: every shard access holds an flock
+on "<shard>.lock", and a request's read-modify-write of one user holds
+user_lock(owner id), so mom and partner writing at once cannot drop events.
+
+Saves go to the shard's operation journal (see journal.py); the shard file
+holds snapshots and is only ever replaced whole (temp file + rename), so a
+crash mid-write leaves the previous version, never half a file.
+
+Secondary indexes (see indexes.py): with indexes={field: fn(doc)} every save
+also records the changed values in "<shard>.index", so find()/count() answer
+operator questions ("stuck in registration", "inactive for 30 days") from
+the matches alone instead of loading every doc.
+"""
+import os
+import json
+import time
+import bisect
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack
+
+try:
+    import fcntl
+except ImportError:  # no flock (Windows): locks only cover threads of one process
+    fcntl = None
+
+from tinydb import TinyDB, Query
+from tinydb.storages import Storage
+
+from journal import Journal, SNAPSHOT_EVERY, JOURNAL_MAX_BYTES, apply_op, save_op, undo_op, to_version
+from indexes import FieldIndex, index_entry
+
+User = Query()
+Entry = Query()
+
+RING_VNODES = 64
+USER_LOCK_STRIPES = 64
+VERSION_CACHE_SIZE = 10000
+VERSION_RACY_NS = 2 * 10**9
+
+def shard_stat(paths):
+    """(mtime_ns, size, inode) per path, None for a missing file."""
+    out = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            out.append((st.st_mtime_ns, st.st_size, st.st_ino))
+        except OSError:
+            out.append(None)
+    return tuple(out)
+
+class AtomicJSONStorage(Storage):
+    """tinydb storage that writes a temp file, fsyncs it and renames it over the old one."""
+
+    def __init__(self, path: str, **kwargs):
+        self.path = path
+        if not os.path.exists(path):
+            open(path, "a").close()
+
+    def read(self):
+        with open(self.path, encoding="utf-8") as f:
+            data = f.read()
+        return json.loads(data) if data.strip() else None
+
+    def write(self, data):
+        tmp = f"{self.path}.tmp{os.getpid()}"
+        text = json.dumps(data)  # one string: json.dump() to a file writes in small chunks, ~3x slower
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def close(self):
+        pass
+
+class FileLock:
+    """
+    Re-entrant lock across threads (RLock) and processes (flock on `path`).
+    The lock file is opened per acquisition, so a forked child never shares it.
+    """
+
+    def __init__(self, path: str, on_acquire=None):
+        self.path = path
+        self.on_acquire = on_acquire
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._rlock.acquire()
+        if self._depth == 0 and fcntl:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except:
+                self._rlock.release()
+                raise
+            self._fd = fd
+        if self._depth == 0 and self.on_acquire:
+            self.on_acquire()
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            os.close(self._fd)  # drops the flock
+            self._fd = None
+        self._rlock.release()
+
+class UserLocks:
+    """Striped FileLocks in lock_dir: serialize read-modify-write of one user across threads and workers."""
+
+    def __init__(self, lock_dir: str, stripes: int = USER_LOCK_STRIPES):
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self._locks = {}
+        self._open_lock = threading.Lock()
+
+    def get(self, uid: str) -> FileLock:
+        stripe = ring_hash(uid) % self.stripes
+        lock = self._locks.get(stripe)
+        if lock is None:
+            with self._open_lock:
+                lock = self._locks.get(stripe)
+                if lock is None:
+                    os.makedirs(self.lock_dir, exist_ok=True)
+                    lock = FileLock(os.path.join(self.lock_dir, f"{stripe}.lock"))
+                    self._locks[stripe] = lock
+        return lock
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+class ConsistentHashRing:
+    """Maps keys to nodes; adding a node only moves ~1/N of the keys."""
+
+    def __init__(self, nodes, vnodes: int = RING_VNODES):
+        self.nodes = list(nodes)
+        points = []
+        for node in self.nodes:
+            for i in range(vnodes):
+                points.append((ring_hash(f"{node}#{i}"), node))
+        points.sort()
+        self._hashes = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+
+    def node_for(self, key: str):
+        i = bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)
+        return self._nodes[i]
+
+class ShardedStore:
+    """
+    get/save/remove user documents by id across shard files.
+
+    previous_paths: the shard layout before a rebalance. While set, reads fall
+    back to the old owner and writes move the doc to its new owner, so the
+    bot keeps working while `manage.py rebalance` copies the rest.
+
+    indexes: {field: fn(doc) -> value or None}, kept per shard on every write,
+    plus "saved" (the hour of the last save). Values of one field must be
+    comparable (all ints, all strings, ...).
+    """
+
+    def __init__(self, shard_paths, directory_path: str, previous_paths=None,
+                 partner_field: str = "partner_phone", version_field: str = "version",
+                 undo_field: str = "undo", volatile_fields=(), indexes=None):
+        if not shard_paths:
+            raise ValueError("at least one shard path is required")
+        self.paths = list(shard_paths)
+        self.ring = ConsistentHashRing(self.paths)
+        self.previous_ring = ConsistentHashRing(previous_paths) if previous_paths else None
+        self.partner_field = partner_field
+        self.version_field = version_field
+        self.undo_field = undo_field
+        # journaled, but not rolled back by undo (conversation state, bookkeeping)
+        self.volatile_fields = set(volatile_fields)
+        self.directory_path = directory_path
+        self.indexes = dict(indexes or {})
+
+        self._dbs = {}
+        self._locks = {}
+        self._journals = {}
+        self._field_indexes = {}
+        self._versions = OrderedDict()  # uid -> (shard stat, version)
+        self._open_lock = threading.Lock()
+        self.lock_dir = os.path.splitext(directory_path)[0] + ".locks"
+        self._user_locks = UserLocks(self.lock_dir)
+
+    # ---------- shards ----------
+    def _db(self, path: str) -> TinyDB:
+        db = self._dbs.get(path)
+        if db is None:
+            with self._open_lock:
+                db = self._dbs.get(path)
+                if db is None:
+                    db = TinyDB(path, storage=AtomicJSONStorage)
+                    self._locks[path] = FileLock(path + ".lock", on_acquire=lambda db=db: self._forget(db))
+                    self._journals[path] = Journal(path + ".journal")
+                    self._dbs[path] = db
+        return db
+
+    def _journal(self, path: str) -> Journal:
+        self._db(path)
+        return self._journals[path]
+
+    @staticmethod
+    def _forget(db: TinyDB):
+        # another process may have written since we last held the lock:
+        # drop tinydb's cached next doc id and query results
+        table = db.table(db.default_table_name)
+        table._next_id = None
+        table.clear_cache()
+
+    def _lock(self, path: str):
+        self._db(path)
+        return self._locks[path]
+
+    def _index(self, path: str) -> FieldIndex:
+        """The shard's secondary indexes, rebuilt from the shard if the file is missing. Caller holds the lock."""
+        self._db(path)
+        index = self._field_indexes.get(path)
+        if index is None:
+            with self._open_lock:
+                index = self._field_indexes.setdefault(
+                    path, FieldIndex(path + ".index", list(self.indexes) + ["saved"]))
+        if os.path.exists(index.path):
+            index.refresh()
+        else:
+            self._rebuild_index(path, index)
+        return index
+
+    def index_entry(self, doc: dict) -> dict:
+        return index_entry(self.indexes, doc)
+
+    def _update_index(self, path: str, doc: dict):
+        if not self.indexes:
+            return
+        index = self._index(path)
+        entry = self.index_entry(doc)
+        if index.entries.get(doc["id"]) != entry:
+            index.append(entry)
+
+    def _rebuild_index(self, path: str, index: FieldIndex):
+        # the save time of existing docs is unknown: they count as saved now
+        journal = self._journal(path)
+        journal.refresh()
+        docs = [self._replay(path, doc) for doc in self._db(path).all() if doc.get("id")]
+        index.compact([self.index_entry(doc) for doc in docs])
+
+    def user_lock(self, uid: str) -> FileLock:
+        """Serializes read-modify-write of one user across threads and workers (striped)."""
+        return self._user_locks.get(uid)
+
+    def lock_owner(self, phone: str) -> str:
+        """
+        Which user_lock() a sender takes: the owner a partner phone maps to, else the phone.
+        Only reads the (small) directory; any given phone always maps to one lock, so
+        everyone who writes a doc serializes on the same stripe.
+        """
+        with self._lock(self.directory_path):
+            entry = self._db(self.directory_path).get(Entry.phone == phone)
+        return entry["owner"] if entry else phone
+
+    def owner_path(self, uid: str) -> str:
+        return self.ring.node_for(uid)
+
+    def _previous_path(self, uid: str):
+        if not self.previous_ring:
+            return None
+        old = self.previous_ring.node_for(uid)
+        return old if old != self.owner_path(uid) else None
+
+    # ---------- documents ----------
+    def _state(self, path: str, uid: str):
+        """Snapshot + journaled ops = the current doc (a fresh dict), or None. Caller holds the lock."""
+        doc = self._db(path).get(User.id == uid)
+        return self._replay(path, doc) if doc is not None else None
+
+    def _replay(self, path: str, snapshot) -> dict:
+        doc = dict(snapshot)
+        journal = self._journal(path)
+        journal.refresh()
+        for op in journal.ops_for(doc.get("id"), to_version(doc.get(self.version_field))):
+            apply_op(doc, op, self.version_field, self.undo_field)
+        return doc
+
+    def _snapshot(self, path: str, state: dict):
+        uid = state["id"]
+
+        def replace(doc):
+            doc.clear()
+            doc.update(state)
+
+        db = self._db(path)
+        if not db.update(replace, User.id == uid):
+            db.insert(dict(state))
+        self._journal(path).ops_for(uid, to_version(state.get(self.version_field)))
+
+    def get(self, uid: str):
+        path = self.owner_path(uid)
+        with self._lock(path):
+            doc = self._state(path, uid)
+        if doc is None:
+            old = self._previous_path(uid)
+            if old:
+                with self._lock(old):
+                    doc = self._state(old, uid)
+        return doc
+
+    def get_by_partner(self, phone: str):
+        with self._lock(self.directory_path):
+            entry = self._db(self.directory_path).get(Entry.phone == phone)
+        if not entry:
+            return None
+        doc = self.get(entry["owner"])
+        if doc is None or doc.get(self.partner_field) != phone:
+            # stale entry (partner changed / user removed)
+            with self._lock(self.directory_path):
+                self._db(self.directory_path).remove(Entry.phone == phone)
+            return None
+        return doc
+
+    def get_by_any(self, uid: str):
+        return self.get(uid) or self.get_by_partner(uid)
+
+    def save(self, user: dict, action=None):
+        """
+        Journal what changed since the stored doc and bump its version counter
+        (counted from what is stored, not from the caller's copy).
+        action = {"id", "label"} makes the change undoable; saves sharing an id
+        are undone together. The caller's dict gets the new version + undo stack.
+        """
+        uid = user["id"]
+        path = self.owner_path(uid)
+        old = self._previous_path(uid)
+        with self._lock(path):
+            state = self._state(path, uid)
+            moving = False
+            if state is None and old:
+                with self._lock(old):
+                    state = self._state(old, uid)
+                moving = state is not None
+
+            before = state or {}
+            op, changed = save_op(uid, before, user, self.version_field, self.undo_field,
+                                  self.volatile_fields, action)
+            if not changed and state is not None and not moving:
+                return
+
+            if state is None or moving:
+                # new doc (or first write after a rebalance): straight to a snapshot
+                new_state = dict(before, id=uid)
+                apply_op(new_state, json.loads(json.dumps(op)), self.version_field, self.undo_field)
+                self._snapshot(path, new_state)
+            else:
+                journal = self._journal(path)
+                kept = journal.append(op)
+                new_state = before
+                apply_op(new_state, kept, self.version_field, self.undo_field)
+                if len(journal.pending.get(uid, ())) >= SNAPSHOT_EVERY:
+                    self._snapshot(path, new_state)
+                if journal.size() > JOURNAL_MAX_BYTES:
+                    self._checkpoint(path)
+            user[self.version_field] = new_state[self.version_field]
+            user[self.undo_field] = new_state.get(self.undo_field) or []
+            self._update_index(path, new_state)
+
+        if moving:
+            with self._lock(old):
+                self._db(old).remove(User.id == uid)
+                if self.indexes:
+                    self._index(old).append({"uid": uid, "remove": True})
+        partner = user.get(self.partner_field)
+        if partner:
+            self._link_partner(partner, uid)
+
+    def undo(self, uid: str):
+        """Roll back the latest undoable action; returns its label, or None if there is none."""
+        path = self.owner_path(uid)
+        with self._lock(path):
+            state = self._state(path, uid)
+            undo = undo_op(state, self.version_field, self.undo_field)
+            if undo is None:
+                return None
+            op, label = undo
+            journal = self._journal(path)
+            kept = journal.append(op)
+            apply_op(state, kept, self.version_field, self.undo_field)
+            if len(journal.pending.get(uid, ())) >= SNAPSHOT_EVERY:
+                self._snapshot(path, state)
+            self._update_index(path, state)
+        return label
+
+    def _checkpoint(self, path: str):
+        """Fold every journaled op of one shard into the snapshots, then empty its journal."""
+        with self._lock(path):
+            journal = self._journal(path)
+            journal.refresh()
+            states = [self._replay(path, doc) for doc in self._db(path).all() if doc.get("id") in journal.pending]
+            updates = []
+            for state in states:
+                def replace(doc, state=state):
+                    doc.clear()
+                    doc.update(state)
+                updates.append((replace, User.id == state["id"]))
+            if updates:
+                self._db(path).update_multiple(updates)
+            journal.reset()
+            if self.indexes:
+                self._index(path).compact()
+
+    def checkpoint(self, paths=None):
+        """Snapshot everything (e.g. before reading shard files directly)."""
+        for path in paths or self.paths:
+            self._checkpoint(path)
+
+    def open_files(self):
+        """
+        A point-in-time view of the store for backups: every shard file and its
+        journal (plus the old layout's during a rebalance), opened while all of
+        their locks are held. Shards are only ever replaced by rename and
+        journals only appended to or replaced, so the open handles keep showing
+        that moment after the locks are released; writers wait for the opens only.
+        Returns ([(path, shard file, journal file or None, journal length)], ms the locks were held).
+        The caller closes the files.
+        """
+        # current layout first: a moving save holds its new shard, then takes the old one
+        paths = sorted(self.paths) + sorted(set(self.previous_ring.nodes if self.previous_ring else ()) - set(self.paths))
+        files = []
+        with ExitStack() as locks:
+            t0 = time.perf_counter()
+            for path in paths:
+                locks.enter_context(self._lock(path))
+            for path in paths:
+                shard = open(path, "rb")
+                try:
+                    journal = open(path + ".journal", "rb")
+                    length = os.fstat(journal.fileno()).st_size
+                except FileNotFoundError:
+                    journal, length = None, 0
+                files.append((path, shard, journal, length))
+            held_ms = (time.perf_counter() - t0) * 1000
+        return files, held_ms
+
+    def version(self, uid: str):
+        """
+        Version counter of a user's doc (None if there is no doc). Answered from
+        stat() alone while the shard files are unchanged since we last read them;
+        files modified in the last VERSION_RACY_NS are always re-read (mtime granularity).
+        """
+        shards = [p for p in (self.owner_path(uid), self._previous_path(uid)) if p]
+        paths = shards + [p + ".journal" for p in shards]
+        hit = self._versions.get(uid)
+        if hit and hit[0] == shard_stat(paths):
+            return hit[1]
+        with self._lock(shards[0]):
+            stat = shard_stat(paths)
+            doc = self.get(uid)
+        v = to_version(doc.get(self.version_field)) if doc else None
+        if all(s is None or time.time_ns() - s[0] > VERSION_RACY_NS for s in stat):
+            with self._open_lock:
+                self._versions[uid] = (stat, v)
+                self._versions.move_to_end(uid)
+                while len(self._versions) > VERSION_CACHE_SIZE:
+                    self._versions.popitem(last=False)
+        return v
+
+    def insert(self, doc: dict):
+        self.save(doc)
+
+    def put(self, doc: dict):
+        """Store a doc exactly as given (version and undo stack included), e.g. copied from another store."""
+        self.put_many([doc])
+
+    def put_many(self, docs):
+        """put() for many docs: one journal append + one shard write per shard."""
+        by_path = {}
+        for doc in docs:
+            by_path.setdefault(self.owner_path(doc["id"]), []).append(json.loads(json.dumps(doc)))
+        for path, batch in by_path.items():
+            uids = [doc["id"] for doc in batch]
+            with self._lock(path):
+                # pending ops of the docs being replaced must not be replayed on top of them
+                self._journal(path).append_many([{"uid": uid, "remove": True} for uid in uids])
+                db = self._db(path)
+                db.remove(User.id.one_of(uids))
+                db.insert_multiple(batch)
+                if self.indexes:
+                    self._index(path).append_many([self.index_entry(doc) for doc in batch])
+            for doc in batch:
+                if doc.get(self.partner_field):
+                    self._link_partner(doc[self.partner_field], doc["id"])
+
+    def remove(self, uid: str):
+        self.remove_many([uid])
+
+    def remove_many(self, uids, check=None):
+        """
+        Remove a batch of users: one shard write + one journal append per shard,
+        one directory write. check(entry), when given, is run on the user's
+        current index entry under the shard lock and users failing it are kept
+        (someone who came back since a sweep listed them). Returns the removed uids.
+        """
+        by_path = {}
+        for uid in uids:
+            for path in filter(None, (self.owner_path(uid), self._previous_path(uid))):
+                by_path.setdefault(path, []).append(uid)
+        removed = set()
+        for path, batch in by_path.items():
+            with self._lock(path):
+                if check:
+                    entries = self._index(path).entries
+                    batch = [uid for uid in batch if uid in entries and check(entries[uid])]
+                if not batch:
+                    continue
+                self._db(path).remove(User.id.one_of(batch))
+                ops = [{"uid": uid, "remove": True} for uid in batch]
+                self._journal(path).append_many(ops)
+                if self.indexes:
+                    self._index(path).append_many(ops)
+            removed.update(batch)
+        if removed:
+            with self._lock(self.directory_path):
+                self._db(self.directory_path).remove(Entry.owner.one_of(list(removed)))
+        return removed
+
+    # ---------- secondary indexes ----------
+    def find(self, field: str, lo=None, hi=None):
+        """Index entries ({"uid", field: value, ..., "saved"}) with lo <= field < hi (None: unbounded)."""
+        out = []
+        for path in self.paths:
+            with self._lock(path):
+                out.extend(self._index(path).range(field, lo, hi))
+        return out
+
+    def find_equal(self, field: str, value):
+        """Index entries with field == value (value=None: users that have no value)."""
+        out = []
+        for path in self.paths:
+            with self._lock(path):
+                out.extend(self._index(path).equal(field, value))
+        return out
+
+    def count(self, field: str, lo=None, hi=None) -> int:
+        n = 0
+        for path in self.paths:
+            with self._lock(path):
+                n += self._index(path).count(field, lo, hi)
+        return n
+
+    def rebuild_indexes(self):
+        for path in self.paths:
+            with self._lock(path):
+                self._rebuild_index(path, self._index(path))
+
+    def compact(self):
+        """Fold the journals into the snapshots and rewrite the index files; returns (bytes before, after)."""
+        files = [p + ext for p in self.paths for ext in ("", ".journal", ".index")] + [self.directory_path]
+
+        def size():
+            return sum(os.path.getsize(f) for f in files if os.path.exists(f))
+
+        before = size()
+        self.checkpoint()
+        return before, size()
+
+    def _link_partner(self, phone: str, owner: str):
+        with self._lock(self.directory_path):
+            directory = self._db(self.directory_path)
+            entry = directory.get(Entry.phone == phone)
+            if not entry or entry.get("owner") != owner:
+                directory.upsert({"phone": phone, "owner": owner}, Entry.phone == phone)
+
+    def warm(self):
+        """Open every shard + the directory and pull the files into the page cache (no JSON parse)."""
+        for path in self.paths + [self.directory_path]:
+            self._db(path)
+            with open(path, "rb") as f:
+                while f.read(1 << 20):
+                    pass
+
+    def iter_users(self):
+        """All user docs (journal applied), one shard at a time."""
+        for path in self.paths:
+            with self._lock(path):
+                docs = [self._replay(path, doc) for doc in self._db(path).all()]
+            yield from docs
+
+    def rebuild_directory(self) -> int:
+        entries = {}
+        for doc in self.iter_users():
+            partner = doc.get(self.partner_field)
+            if partner:
+                entries[partner] = doc["id"]
+        with self._lock(self.directory_path):
+            directory = self._db(self.directory_path)
+            directory.truncate()
+            directory.insert_multiple({"phone": p, "owner": o} for p, o in entries.items())
+        return len(entries)
+
+    def close(self):
+        with self._open_lock:
+            for db in self._dbs.values():
+                db.close()
+            self._dbs.clear()
+            self._locks.clear()
+            self._journals.clear()
+            self._field_indexes.clear()
+
+def rebalance(old_paths, new_paths, directory_path: str, log=print) -> int:
+    """
+    Move every doc whose owner changed from old_paths to new_paths.
+    Safe to run while the bot is up with TINYDB_SHARDS=new and
+    TINYDB_SHARDS_PREVIOUS=old: a doc the bot already moved is not overwritten.
+    """
+    store = ShardedStore(new_paths, directory_path, previous_paths=old_paths)
+    moved = 0
+    try:
+        # docs are copied as stored: fold the journals in first
+        store.checkpoint(list(old_paths) + list(new_paths))
+        for src in old_paths:
+            src_lock = store._lock(src)
+            with src_lock:
+                docs = store._db(src).all()
+            for doc in docs:
+                uid = doc.get("id")
+                if not uid:
+                    continue
+                dst = store.owner_path(uid)
+                if dst == src:
+                    continue
+                with store._lock(dst):
+                    if store._db(dst).get(User.id == uid) is None:
+                        store._db(dst).insert(dict(doc))
+                with src_lock:
+                    store._db(src).remove(User.id == uid)
+                moved += 1
+            log(f"{src}: moved {moved} so far")
+        # docs were moved under the indexes' feet: they are rebuilt on next use
+        for path in set(old_paths) | set(new_paths):
+            with store._lock(path):
+                if os.path.exists(path + ".index"):
+                    os.remove(path + ".index")
+    finally:
+        store.close()
+    return moved
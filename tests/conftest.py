@@ -0,0 +1,18 @@
+"""
+Shared setup: app.py reads its storage paths at import, so point them at a
+throwaway directory before any test imports it.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEST_DIR = tempfile.mkdtemp(prefix="bili-tests-")
+for name in ("TINYDB_SHARDS", "TINYDB_SHARDS_PREVIOUS", "TINYDB_DIRECTORY_PATH", "RATE_LIMIT_STORE",
+             "SQL_STORE_URL", "SHADOW_STATUS_DIR", "STORE_PRIMARY", "STORE_SHADOW"):
+    os.environ.pop(name, None)
+os.environ["TINYDB_PATH"] = os.path.join(TEST_DIR, "users.json")
+os.environ["RATE_LIMIT_BURST"] = "1000000"
+os.environ["STORE_WARMUP"] = "0"
@@ -0,0 +1,66 @@
+"""
+Cohort analytics: byte-range reading of a shard gives the same rows as one
+pass, and days are the user's local days, as in summarize_day().
+"""
+import datetime as dt
+import json
+
+import numpy as np
+import pytest
+
+import analytics
+import app
+from test_dst import dst_user
+
+def rows(columns):
+    order = np.lexsort([columns[k] for k in ("sleep_min", "diapers", "bottle_ml", "age", "mode")])
+    return {k: v[order] for k, v in columns.items()}
+
+def write_shard(path, docs):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"_default": {str(i + 1): d for i, d in enumerate(docs)}}))
+
+def baby(n):
+    events = [{"type": "bottle", "timestamp": f"2026-01-{1 + i % 20:02d} 10:00:00", "details": {"amount": 30 + n}}
+              for i in range(n % 7 + 1)]
+    events.append({"type": "diaper", "timestamp": "2026-01-02 11:00:00", "details": {}})
+    return {
+        "id": f"97250{n:07d}", "dob": "2025-12-20", "feeding_mode": analytics.MODES[n % 4],
+        "events": events,
+        # a nested `"<digits>": {` looks like a table entry to the range splitter
+        "day_milestone": {"12": {"next": 1}, "13": {"next": 2, "x": {"14": {"a": "}, \"15\": {"}}}},
+        # ... even one with an "id"
+        "notes": {"16": {"id": "note", "text": "x" * n}} if n % 5 == 0 else {},
+    }
+
+@pytest.mark.parametrize("range_bytes", [97, 400, 5000])
+def test_ranges_match_one_pass(tmp_path, range_bytes):
+    path = str(tmp_path / "users.json")
+    write_shard(path, [baby(n) for n in range(60)])
+    whole = rows(analytics.shard_columns(path))
+    assert len(whole["age"])
+    for workers in (1, 2):
+        split = rows(analytics.collect([path], workers=workers, range_bytes=range_bytes))
+        for k in whole:
+            assert np.array_equal(whole[k], split[k]), k
+
+def test_empty_and_missing_shards(tmp_path):
+    empty = tmp_path / "empty.json"
+    empty.write_text("")
+    table = tmp_path / "table.json"
+    table.write_text('{"_default": {}}')
+    columns = analytics.collect([str(empty), str(table), str(tmp_path / "missing.json")], workers=1)
+    assert len(columns["age"]) == 0
+
+@pytest.mark.parametrize("zone", ["Asia/Jerusalem", "America/New_York"])
+def test_days_match_summarize_day(zone, tmp_path):
+    user = dict(dst_user(zone), dob="2026-01-01", feeding_mode="bottle")
+    path = str(tmp_path / "users.json")
+    write_shard(path, [user])
+    c = analytics.collect([path], workers=1)
+    dob = dt.date(2026, 1, 1)
+    got = {dob + dt.timedelta(days=int(a)): (c["bottle_ml"][i], c["sleep_min"][i]) for i, a in enumerate(c["age"])}
+    assert got
+    for day, (ml, sleep) in got.items():
+        s = app.summarize_day(user, day)
+        assert (ml, sleep) == (s["bottles_ml"], s["sleep_mins"]), day
@@ -0,0 +1,80 @@
+"""
+Day boundaries and daily summaries across DST changes (the reports work on
+local days of the user's zone, whatever their length).
+"""
+import datetime as dt
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import app
+
+JERUSALEM = ZoneInfo("Asia/Jerusalem")
+
+@pytest.mark.parametrize("zone, day, hours", [
+    ("Asia/Jerusalem", dt.date(2026, 3, 27), 23),    # spring forward 02:00 -> 03:00
+    ("Asia/Jerusalem", dt.date(2026, 10, 25), 25),   # fall back 02:00 -> 01:00
+    ("Asia/Jerusalem", dt.date(2026, 10, 24), 24),
+    ("America/New_York", dt.date(2026, 3, 8), 23),
+    ("America/New_York", dt.date(2026, 11, 1), 25),
+])
+def test_day_length(zone, day, hours):
+    start, end = app.day_bounds(zone, day)
+    assert end - start == hours * 3600
+
+def event(kind, ts, details, epoch=None):
+    e = {"type": kind, "timestamp": ts, "details": details}
+    if epoch is not None:
+        e["epoch"] = int(epoch)
+    return e
+
+def dst_user(zone):
+    # the second 01:30 of 2026-10-25 (after the clocks went back), anchored by its epoch
+    repeated_0130 = dt.datetime(2026, 10, 25, 1, 30, tzinfo=JERUSALEM, fold=1).timestamp()
+    return {
+        "id": f"dst-{zone}",
+        app.KEY_TZ: zone,
+        app.KEY_EVENTS: [
+            event("bottle", "2026-10-24 23:59:00", {"amount": 60}),
+            event("bottle", "2026-10-25 01:30:00", {"amount": 90}, repeated_0130),
+            event("sleep", "2026-10-25 06:00:00", {"duration_min": 540, "start_ts": "2026-10-24 22:00:00",
+                                                   "end_ts": "2026-10-25 06:00:00"}),
+            event("bottle", "2026-10-25 23:59:00", {"amount": 30}),
+            event("sleep", "2026-03-27 04:00:00", {"duration_min": 240, "start_ts": "2026-03-26 23:00:00",
+                                                   "end_ts": "2026-03-27 04:00:00"}),
+        ],
+    }
+
+def test_sleep_across_fall_back_is_split_by_real_minutes():
+    user = dst_user("Asia/Jerusalem")
+    # 22:00 -> 06:00 over a 25h day is 9 real hours: 2h before midnight, 7h after
+    assert app.summarize_day(user, dt.date(2026, 10, 24))["sleep_mins"] == 120
+    assert app.summarize_day(user, dt.date(2026, 10, 25))["sleep_mins"] == 420
+
+def test_sleep_across_spring_forward():
+    user = dst_user("Asia/Jerusalem")
+    # 23:00 -> 04:00 with 02:00-03:00 missing: 1h on the 26th, 3h on the 27th
+    assert app.summarize_day(user, dt.date(2026, 3, 26))["sleep_mins"] == 60
+    assert app.summarize_day(user, dt.date(2026, 3, 27))["sleep_mins"] == 180
+
+def test_bottle_in_repeated_hour_lands_on_the_25th():
+    user = dst_user("Asia/Jerusalem")
+    assert app.summarize_day(user, dt.date(2026, 10, 24))["bottles_ml"] == 60
+    assert app.summarize_day(user, dt.date(2026, 10, 25))["bottles_ml"] == 90 + 30
+
+def test_same_events_in_new_york():
+    user = dst_user("America/New_York")
+    # local timestamps are read in the user's zone; the epoch-anchored bottle is
+    # 2026-10-24 18:30 in New York, so it moves to the 24th
+    day24 = app.summarize_day(user, dt.date(2026, 10, 24))
+    day25 = app.summarize_day(user, dt.date(2026, 10, 25))
+    assert (day24["bottles_ml"], day24["sleep_mins"]) == (60 + 90, 120)
+    assert (day25["bottles_ml"], day25["sleep_mins"]) == (30, 360)
+
+def test_day_events_follow_the_zone():
+    ny = app.user_index(dst_user("America/New_York"))
+    jlm = app.user_index(dst_user("Asia/Jerusalem"))
+    amounts = lambda idx, day: sorted(e["details"]["amount"] for e in idx.day_events(day) if e["type"] == "bottle")
+    assert amounts(jlm, dt.date(2026, 10, 25)) == [30, 90]
+    assert amounts(ny, dt.date(2026, 10, 24)) == [60, 90]
+    assert amounts(ny, dt.date(2026, 10, 25)) == [30]
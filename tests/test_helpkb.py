@@ -0,0 +1,32 @@
+"""
+The committed help index: current for the committed articles, used as is
+on a fresh checkout, rebuilt in memory (never written) when an article changed.
+"""
+import os
+import shutil
+
+import app
+import helpkb
+
+def test_committed_index_is_current():
+    assert helpkb.read_index(app.HELP_DIR) is not None, "run `python manage.py help-index` and commit data/help/index.json"
+
+def test_fresh_checkout_uses_the_index(tmp_path):
+    # new file times, same contents
+    path = shutil.copytree(app.HELP_DIR, tmp_path / "help", copy_function=shutil.copy)
+    for name in os.listdir(path):
+        os.utime(os.path.join(path, name), (1, 1))
+    kb = helpkb.HelpKB(str(path))
+    assert not kb.rebuilt
+    assert kb.menu_entries() == app.HELP_KB.menu_entries()
+
+def test_edited_article_is_rebuilt_in_memory_only(tmp_path, capsys):
+    path = shutil.copytree(app.HELP_DIR, tmp_path / "help")
+    index_file = os.path.join(path, helpkb.INDEX_NAME)
+    before = open(index_file, "rb").read()
+    with open(os.path.join(path, "milk-storage.txt"), "a", encoding="utf-8") as f:
+        f.write("שורה חדשה\n")
+    kb = helpkb.HelpKB(str(path))
+    assert kb.rebuilt and "stale" in capsys.readouterr().err
+    assert kb.answer("milk-storage").endswith("שורה חדשה")
+    assert open(index_file, "rb").read() == before
@@ -0,0 +1,98 @@
+"""
+The guard on switching STORE_PRIMARY to the shadow backend: only a shadow
+that is still running and has matched, with no lost write, for long enough.
+"""
+import os
+import json
+import subprocess
+import sys
+import time
+
+import shadow
+from storage import ShardedStore
+
+HOUR = 3600
+NOW = 1_800_000_000.0
+
+def dead_pid() -> int:
+    p = subprocess.Popen([sys.executable, "-c", "pass"])
+    p.wait()
+    return p.pid
+
+def write_status(status_dir, pid, host=shadow.HOST, **fields):
+    os.makedirs(status_dir, exist_ok=True)
+    s = {"pid": pid, "host": host, "primary": "tinydb", "shadow": "sql", "started": NOW - 100 * HOUR,
+         "updated": NOW, "replayed": 5, "compared": 5, "reports": 0, "divergences": 0, "resynced": 0,
+         "lag": 0, "dropped": 0, "errors": 0, "last_divergence": None, "last_fault": None,
+         "recent": [], "queued": 0, "hist": {}}
+    s.update(fields)
+    with open(os.path.join(status_dir, f"shadow-{pid}.json"), "w", encoding="utf-8") as f:
+        json.dump(s, f)
+
+def test_running_clean_shadow_is_ready(tmp_path):
+    write_status(tmp_path, os.getpid())
+    ok, reason = shadow.ready_to_switch(str(tmp_path), "sql", 72, now=NOW + 5)
+    assert ok, reason
+
+def test_shadow_that_stopped_long_ago_is_refused(tmp_path):
+    # the reported case: 300 h without a status, thousands of lost writes, 5 docs compared
+    write_status(tmp_path, dead_pid(), started=NOW - 400 * HOUR, updated=NOW - 300 * HOUR,
+                 errors=9000, dropped=5000)
+    ok, reason = shadow.ready_to_switch(str(tmp_path), "sql", 72, now=NOW)
+    assert not ok and "switch while it is running" in reason
+
+def test_errors_and_dropped_jobs_restart_the_clean_period(tmp_path):
+    write_status(tmp_path, os.getpid(), errors=1, last_fault=NOW - 2 * HOUR)
+    ok, reason = shadow.ready_to_switch(str(tmp_path), "sql", 72, now=NOW)
+    assert not ok and "matched for 2.0 h" in reason
+
+def test_exit_with_queued_jobs_is_a_fault(tmp_path):
+    write_status(tmp_path, os.getpid())
+    write_status(tmp_path, dead_pid(), started=NOW - 50 * HOUR, updated=NOW - HOUR, queued=3)
+    m = shadow.read_status(str(tmp_path), now=NOW)[("tinydb", "sql")]
+    assert (m["processes"], m["exited"], m["last_fault"]) == (1, 1, NOW - HOUR)
+    assert not shadow.ready_to_switch(str(tmp_path), "sql", 72, now=NOW)[0]
+
+def test_gap_without_a_shadow_restarts_the_clean_period(tmp_path):
+    write_status(tmp_path, dead_pid(), started=NOW - 200 * HOUR, updated=NOW - 20 * HOUR)
+    write_status(tmp_path, os.getpid(), started=NOW - 10 * HOUR)
+    m = shadow.read_status(str(tmp_path), now=NOW)[("tinydb", "sql")]
+    assert m["started"] == NOW - 10 * HOUR
+    assert not shadow.ready_to_switch(str(tmp_path), "sql", 72, now=NOW)[0]
+
+def test_stuck_process_is_refused(tmp_path):
+    # alive, but its shadow thread stopped writing status
+    write_status(tmp_path, os.getpid(), updated=NOW - HOUR)
+    write_status(tmp_path, dead_pid())
+    ok, reason = shadow.ready_to_switch(str(tmp_path), "sql", 72, now=NOW)
+    assert not ok and "1 processes" in reason
+
+def test_other_host_status_counts_while_fresh(tmp_path):
+    write_status(tmp_path, 1, host="elsewhere")
+    assert shadow.ready_to_switch(str(tmp_path), "sql", 72, now=NOW + 5)[0]
+    assert not shadow.ready_to_switch(str(tmp_path), "sql", 72, now=NOW + shadow.STATUS_STALE + 5)[0]
+
+def test_switch_is_remembered_until_it_shadows_again(tmp_path):
+    write_status(tmp_path, dead_pid(), updated=NOW)
+    assert shadow.ready_to_switch(str(tmp_path), "sql", 72, now=NOW + 5)[0]
+    shadow.mark_switched(str(tmp_path), "sql", now=NOW + 5)
+    # a worker started a day later, the shadow's status long stale
+    assert shadow.ready_to_switch(str(tmp_path), "sql", 72, now=NOW + 24 * HOUR)[0]
+    # switched back: sql is a shadow again and has to earn it again
+    write_status(tmp_path, os.getpid(), started=NOW + 30 * HOUR, updated=NOW + 31 * HOUR)
+    assert not shadow.ready_to_switch(str(tmp_path), "sql", 72, now=NOW + 31 * HOUR)[0]
+
+class BrokenStore:
+    def save(self, user, action=None):
+        raise RuntimeError("shadow down")
+
+def test_replay_error_is_recorded_as_fault(tmp_path):
+    primary = ShardedStore([str(tmp_path / "shard.json")], str(tmp_path / "directory.json"))
+    st = shadow.ShadowStore(primary, BrokenStore(), names=("tinydb", "sql"),
+                            status_dir=str(tmp_path / "status"), log=lambda msg: None)
+    t0 = time.time()
+    st.save({"id": "972501234567", "events": []})
+    st.flush()
+    m = shadow.read_status(str(tmp_path / "status"))[("tinydb", "sql")]
+    assert m["errors"] == 1 and m["last_fault"] >= t0
+    assert m["clean_since"] == m["last_fault"]
@@ -0,0 +1,120 @@
+"""
+Long-range trend series for one user ('מגמה').
+
+The bot hands over one user's events in the report range as flat arrays
+(epochs, metric codes, amounts, sleep sessions) plus the local day marks
+(midnight, night end, night start, next midnight) of every day in the
+range. Everything here is vectorized over those arrays: events are
+assigned to days with one searchsorted, sleep is merged once into
+disjoint stretches and every day/night boundary is answered from a
+cumulative coverage curve, so the cost does not grow with the number of
+days times the history.
+
+A day counts once something was logged on it (like analytics.py); weeks
+without such days are NaN and show as a gap in the sparkline.
+"""
+import numpy as np
+
+M_BOTTLE, M_BREAST, M_OTHER = 0, 1, 2
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+SPARK_GAP = "·"
+
+def merge_sessions(starts, ends):
+    """Sorted, possibly overlapping sessions -> disjoint (starts, ends)."""
+    if not len(starts):
+        return starts, ends
+    order = np.argsort(starts, kind="stable")
+    s, e = starts[order], ends[order]
+    reach = np.maximum.accumulate(e)
+    new = np.ones(len(s), bool)
+    new[1:] = s[1:] > reach[:-1]
+    first = np.flatnonzero(new)
+    return s[first], np.maximum.reduceat(e, first)
+
+def coverage(starts, ends, t):
+    """Seconds covered by disjoint sorted sessions before each time in t."""
+    if not len(starts):
+        return np.zeros(len(t))
+    before = np.concatenate([[0.0], np.cumsum(ends - starts)])
+    i = np.searchsorted(starts, t, side="right") - 1
+    inside = np.clip(t - starts[np.maximum(i, 0)], 0, (ends - starts)[np.maximum(i, 0)])
+    return np.where(i >= 0, before[np.maximum(i, 0)] + inside, 0.0)
+
+def daily_series(marks, ev_epoch, ev_metric, ev_value, sl_start, sl_end, legacy_epoch, legacy_min):
+    """
+    marks: (days, 4) epochs [midnight, night end, night start, next midnight].
+    Returns per-day arrays: bottle_ml, feeds, sleep_min, night_min, day_min,
+    longest_min and the `active` mask.
+    """
+    n = len(marks)
+    edges = np.append(marks[:, 0], marks[-1, 3])
+
+    day = np.searchsorted(edges, ev_epoch, side="right") - 1
+    ok = (day >= 0) & (day < n)
+    day, metric, value = day[ok], ev_metric[ok], ev_value[ok]
+    out = {
+        "bottle_ml": np.bincount(day, weights=np.where(metric == M_BOTTLE, value, 0.0), minlength=n),
+        "feeds": np.bincount(day, weights=(metric <= M_BREAST).astype(float), minlength=n),
+    }
+    active = np.bincount(day, minlength=n) > 0
+
+    s, e = merge_sessions(sl_start, sl_end)
+    c = coverage(s, e, marks.ravel()).reshape(n, 4) / 60.0
+    night = (c[:, 1] - c[:, 0]) + (c[:, 3] - c[:, 2])
+    daytime = c[:, 2] - c[:, 1]
+
+    # legacy duration-only sleep entries: total only, on the day they were logged (like summarize_day)
+    lday = np.searchsorted(edges, legacy_epoch, side="right") - 1
+    lok = (lday >= 0) & (lday < n)
+    legacy = np.bincount(lday[lok], weights=legacy_min[lok], minlength=n)
+
+    # longest stretch: merged stretches, credited to the day they started on
+    longest = np.zeros(n)
+    sday = np.searchsorted(edges, s, side="right") - 1
+    sok = (sday >= 0) & (sday < n)
+    np.maximum.at(longest, sday[sok], (e - s)[sok] / 60.0)
+
+    out["night_min"] = night
+    out["day_min"] = daytime
+    out["sleep_min"] = night + daytime + legacy
+    out["longest_min"] = longest
+    out["active"] = active | (out["sleep_min"] > 0)
+    return out
+
+def rolling_mean(values, active, window: int = 7):
+    """Mean over the active days of each trailing window (NaN when none)."""
+    v = np.where(active, values, 0.0)
+    csum = np.concatenate([[0.0], np.cumsum(v)])
+    ccnt = np.concatenate([[0], np.cumsum(active)])
+    lo = np.maximum(np.arange(1, len(v) + 1) - window, 0)
+    hi = np.arange(1, len(v) + 1)
+    cnt = ccnt[hi] - ccnt[lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(cnt > 0, (csum[hi] - csum[lo]) / cnt, np.nan)
+
+def weekly(values, active):
+    """Per-week mean of the active days; the series length must be a multiple of 7."""
+    return rolling_mean(values, active, 7)[6::7]
+
+def slope_per_week(values, active):
+    """Least-squares change per week over the active days (0 with fewer than two)."""
+    x = np.flatnonzero(active).astype(float)
+    if len(x) < 2:
+        return 0.0
+    y = values[active]
+    dx = x - x.mean()
+    var = (dx * dx).sum()
+    return float((dx * (y - y.mean())).sum() / var * 7) if var else 0.0
+
+def sparkline(values) -> str:
+    v = np.asarray(values, float)
+    ok = ~np.isnan(v)
+    if not ok.any():
+        return SPARK_GAP * len(v)
+    lo, hi = v[ok].min(), v[ok].max()
+    if hi - lo < 1e-9:
+        levels = np.full(len(v), len(SPARK_CHARS) // 2)
+    else:
+        levels = np.round((np.nan_to_num(v, nan=lo) - lo) / (hi - lo) * (len(SPARK_CHARS) - 1)).astype(int)
+    return "".join(SPARK_CHARS[lv] if good else SPARK_GAP for lv, good in zip(levels, ok))